@@ -7,6 +7,7 @@ except ImportError:
     import aioredis
 
 from . import _async, _server
+from ._helpers import pack_fields
 
 
 class FakeSocket(_async.AsyncFakeSocket):
@@ -39,11 +40,28 @@ class FakeWriter:
 
 
 class FakeConnection(aioredis.Connection):
+    """Connection to a `FakeServer`.
+
+    As with the synchronous connection, commands skip the redis protocol
+    unless ``direct=False`` is passed.
+    """
+
     def __init__(self, *args, **kwargs):
         self._server = kwargs.pop('server')
+        self._direct = kwargs.pop('direct', True)
         self._sock = None
         super().__init__(*args, **kwargs)
 
+    def pack_command(self, *args):
+        if not self._direct:
+            return super().pack_command(*args)
+        return [pack_fields(self.encoder, args)]
+
+    def pack_commands(self, commands):
+        if not self._direct:
+            return super().pack_commands(commands)
+        return [pack_fields(self.encoder, args) for args in commands]
+
     async def _connect(self):
         if not self._server.connected:
             raise aioredis.ConnectionError(_server.CONNECTION_ERROR_MSG)
@@ -58,20 +76,15 @@ class FakeConnection(aioredis.Connection):
     async def can_read(self, timeout: float = 0):
         if not self.is_connected:
             await self.connect()
+        if not self._sock.responses.empty():
+            return True
         if timeout == 0:
-            return not self._sock.responses.empty()
-        # asyncio.Queue doesn't have a way to wait for the queue to be
-        # non-empty without consuming an item, so kludge it with a sleep/poll
-        # loop.
-        loop = asyncio.get_event_loop()
-        start = loop.time()
-        while True:
-            if not self._sock.responses.empty():
-                return True
-            await asyncio.sleep(0.01)
-            now = loop.time()
-            if timeout is not None and now > start + timeout:
-                return False
+            return False
+        try:
+            await asyncio.wait_for(self._sock.wait_for_response(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
 
     def _decode(self, response):
         if isinstance(response, list):
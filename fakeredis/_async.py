@@ -10,43 +10,56 @@ class AsyncFakeSocket(_fakesocket.FakeSocket):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.responses = asyncio.Queue()
+        # Set when a response is queued, to wake up wait_for_response
+        self._response_event = asyncio.Event()
 
     def put_response(self, msg):
         self.responses.put_nowait(msg)
+        self._response_event.set()
 
-    async def _async_blocking(self, timeout, func, event, callback):
+    async def wait_for_response(self):
+        """Wait until there is a response to read, without consuming it."""
+        while self.responses.empty():
+            self._response_event.clear()
+            await self._response_event.wait()
+
+    async def _async_blocking(self, timeout, db, keys, event, result, serve):
         try:
-            result = None
             async with async_timeout.timeout(timeout if timeout else None):
-                while True:
-                    await event.wait()
-                    event.clear()
-                    # This is a coroutine outside the normal control flow that
-                    # locks the server, so we have to take our own lock.
-                    with self._server.lock:
-                        ret = func(False)
-                        if ret is not None:
-                            result = self._decode_result(ret)
-                            self.put_response(result)
-                            break
+                await event.wait()
         except asyncio.TimeoutError:
-            result = None
+            pass
         finally:
+            # This is a coroutine outside the normal control flow that
+            # locks the server, so we have to take our own lock.
             with self._server.lock:
-                self._db.remove_change_callback(callback)
-            self.put_response(result)
-            self.resume()
+                db.remove_waiter(keys, serve)
+        self.put_response(self._decode_result(result[0]) if result else None)
+        self.resume()
 
-    def _blocking(self, timeout, func):
+    def _blocking(self, timeout, func, keys):
         loop = asyncio.get_event_loop()
         ret = func(True)
         if ret is not None or self._in_transaction:
             return ret
+        db = self._db
         event = asyncio.Event()
+        result = []
 
-        def callback():
+        def serve():
+            # Called by the client that wrote the key, with the lock held
+            try:
+                ret = func(False)
+            except _helpers.SimpleError as exc:
+                ret = exc
+            if ret is None:
+                return False
+            result.append(ret)
+            db.remove_waiter(keys, serve)
             loop.call_soon_threadsafe(event.set)
-        self._db.add_change_callback(callback)
+            return True
+
+        db.add_waiter(keys, serve)
         self.pause()
-        loop.create_task(self._async_blocking(timeout, func, event, callback))
+        loop.create_task(self._async_blocking(timeout, db, keys, event, result, serve))
         return _helpers.NoResponse()
@@ -1,5 +1,6 @@
-import itertools
+import collections
 import queue
+import threading
 import time
 import weakref
 
@@ -7,10 +8,10 @@ import redis
 
 from . import _msgs as msgs
 from ._commands import (
-    Int)
+    Int, List, STRING_TYPES)
 from ._helpers import (
     SimpleError, valid_response_type, SimpleString, NoResponse, casematch,
-    compile_pattern, QUEUED)
+    compile_pattern, split_glob_prefix, QUEUED)
 from ._zset import ZSet
 
 
@@ -32,9 +33,12 @@ class BaseFakeSocket:
         # but set by aioredis module to prevent new commands being processed
         # while handling a blocking command.
         self._paused = False
+        # Commands received through `sendall` as field lists while paused
+        self._pending_commands = collections.deque()
         self._parser = self._parse_commands()
         self._parser.send(None)
         self.version = server.version
+        self._commands = server.command_table(type(self))
 
     def put_response(self, msg):
         # redis.Connection.__del__ might call self.close at any time, which
@@ -49,6 +53,8 @@ class BaseFakeSocket:
 
     def resume(self):
         self._paused = False
+        while self._pending_commands and not self._paused:
+            self._process_command(self._pending_commands.popleft())
         self._parser.send(b'')
 
     def shutdown(self, flags):
@@ -83,38 +89,55 @@ class BaseFakeSocket:
         self.responses = None
 
     @staticmethod
-    def _extract_line(buf):
-        pos = buf.find(b'\n') + 1
-        assert pos > 0
-        line = buf[:pos]
-        buf = buf[pos:]
-        assert line.endswith(b'\r\n')
-        return line, buf
+    def _compact(buf, pos):
+        """Discard the consumed part of `buf` if it makes up most of it.
+
+        Returns the new offset of the unconsumed data.
+        """
+        if pos and pos * 2 >= len(buf):
+            del buf[:pos]
+            return 0
+        return pos
+
+    @staticmethod
+    def _parse_length(buf, start, end, prefix):
+        """Parse the length from a header line (such as ``$3``) in ``buf[start:end]``"""
+        assert buf[start:start + 1] == prefix
+        assert buf[end - 2:end] == b'\r\n'
+        return int(buf[start + 1:end - 2])
 
     def _parse_commands(self):
         """Generator that parses commands.
 
         It is fed pieces of redis protocol data (via `send`) and calls
-        `_process_command` whenever it has a complete one.
+        `_process_command` whenever it has a complete one. The data is
+        appended to a single buffer that is consumed by advancing an offset,
+        so parsing takes time linear in the amount of data, and each bulk
+        string is copied out of the buffer exactly once.
         """
-        buf = b''
+        buf = bytearray()
+        pos = 0  # Start of the data not parsed yet
         while True:
-            while self._paused or b'\n' not in buf:
+            while self._paused or buf.find(b'\n', pos) == -1:
+                pos = self._compact(buf, pos)
                 buf += yield
-            line, buf = self._extract_line(buf)
-            assert line[:1] == b'*'  # array
-            n_fields = int(line[1:-2])
+            end = buf.find(b'\n', pos) + 1
+            n_fields = self._parse_length(buf, pos, end, b'*')  # array
+            pos = end
             fields = []
             for i in range(n_fields):
-                while b'\n' not in buf:
+                while buf.find(b'\n', pos) == -1:
+                    pos = self._compact(buf, pos)
                     buf += yield
-                line, buf = self._extract_line(buf)
-                assert line[:1] == b'$'  # string
-                length = int(line[1:-2])
-                while len(buf) < length + 2:
+                end = buf.find(b'\n', pos) + 1
+                length = self._parse_length(buf, pos, end, b'$')  # string
+                pos = end
+                while len(buf) - pos < length + 2:
+                    pos = self._compact(buf, pos)
                     buf += yield
-                fields.append(buf[:length])
-                buf = buf[length + 2:]  # +2 to skip the CRLF
+                with memoryview(buf) as view:
+                    fields.append(bytes(view[pos:pos + length]))
+                pos += length + 2  # +2 to skip the CRLF
             self._process_command(fields)
 
     def _run_command(self, func, sig, args, from_script):
@@ -136,7 +159,7 @@ class BaseFakeSocket:
                     'quit'
                 ]:
                     raise SimpleError(msgs.BAD_COMMAND_IN_PUBSUB_MSG)
-                result = func(*args)
+                result = func(self, *args)
                 assert valid_response_type(result)
         except SimpleError as exc:
             result = exc
@@ -158,13 +181,14 @@ class BaseFakeSocket:
         else:
             return result
 
-    def _blocking(self, timeout, func):
+    def _blocking(self, timeout, func, keys):
         """Run a function until it succeeds or timeout is reached.
 
         The timeout must be an integer, and 0 means infinite. The function
         is called with a boolean to indicate whether this is the first call.
-        If it returns None it is considered to have "failed" and is retried
-        each time the condition variable is notified, until the timeout is
+        If it returns None it is considered to have "failed", and the client
+        blocks on `keys`. It is retried whenever one of them is written, in
+        turn with the other clients blocked on that key, until the timeout is
         reached.
 
         Returns the function return value, or None if the timeout was reached.
@@ -176,66 +200,157 @@ class BaseFakeSocket:
             deadline = time.time() + timeout
         else:
             deadline = None
-        while True:
-            timeout = deadline - time.time() if deadline is not None else None
-            if timeout is not None and timeout <= 0:
-                return None
-            # Python <3.2 doesn't return a status from wait. On Python 3.2+
-            # we bail out early on False.
-            if self._db.condition.wait(timeout=timeout) is False:
-                return None  # Timeout expired
-            ret = func(False)
-            if ret is not None:
-                return ret
+        db = self._db
+        condition = threading.Condition(self._server.lock)
+        result = []
+
+        def serve():
+            # Called by the client that wrote the key, with the lock held
+            try:
+                ret = func(False)
+            except SimpleError as exc:
+                ret = exc
+            if ret is None:
+                return False
+            result.append(ret)
+            db.remove_waiter(keys, serve)
+            condition.notify()
+            return True
+
+        db.add_waiter(keys, serve)
+        try:
+            while not result:
+                timeout = deadline - time.time() if deadline is not None else None
+                if timeout is not None and timeout <= 0:
+                    return None
+                condition.wait(timeout=timeout)
+        finally:
+            db.remove_waiter(keys, serve)
+        if isinstance(result[0], SimpleError):
+            raise result[0]
+        return result[0]
+
+    def _serve_blocked(self):
+        """Serve the clients blocked on keys written by the last command."""
+        ready_dbs = self._server.ready_dbs
+        while ready_dbs:
+            ready_dbs.pop(0).serve_waiters()
 
     def _name_to_func(self, name):
-        name = (name.decode(encoding='utf-8', errors='replace')
-                if isinstance(name, bytes)
-                else str(name).encode(encoding='utf-8', errors='replace'))
-        func_name = name.lower()
-        func = getattr(self, func_name, None)
-        if name.startswith('_') or not func or not hasattr(func, '_fakeredis_sig'):
+        """Look up a command by name, returning the handler and its signature."""
+        if not isinstance(name, bytes):
+            name = str(name).encode(encoding='utf-8', errors='replace')
+        try:
+            return self._commands[name.lower()]
+        except KeyError:
+            name = name.decode(encoding='utf-8', errors='replace')
             # redis remaps \r or \n in an error to ' ' to make it legal protocol
             clean_name = name.replace('\r', ' ').replace('\n', ' ')
             raise SimpleError(msgs.UNKNOWN_COMMAND_MSG.format(clean_name))
-        return func, func_name
 
     def sendall(self, data):
         if not self._server.connected:
             raise self._connection_error_class(msgs.CONNECTION_ERROR_MSG)
+        if isinstance(data, list):
+            # An already parsed command, from a FakeConnection that skips
+            # the redis protocol.
+            if self._paused or self._pending_commands:
+                self._pending_commands.append(data)
+            else:
+                self._process_command(data)
+            return
         if isinstance(data, str):
             data = data.encode('ascii')
         self._parser.send(data)
 
+    def _shares_server_lock(self, sig):
+        """Whether a command runs under the shared server lock.
+
+        With the server's `concurrent_reads`, commands that only read run
+        concurrently with each other. Other commands (including those that
+        change the connection's state, such as MULTI) take the lock exclusively.
+        """
+        if not self._server.concurrent_reads or self._transaction is not None:
+            return False
+        flags = sig.flags
+        return msgs.FLAG_READ_ONLY in flags or (
+            msgs.FLAG_WRITE not in flags and msgs.FLAG_NO_SCRIPT not in flags)
+
+    def _acquire_server_lock(self, shared=False):
+        """Acquire the server lock to run a command.
+
+        If a script has been holding it for longer than the server's
+        `lua_time_limit` (in milliseconds), the lock is not acquired and False
+        is returned instead. Readers may still share the lock with a busy
+        read-only script.
+        """
+        server = self._server
+        acquire = server.lock.acquire_shared if shared else server.lock.acquire
+        while True:
+            limit = server.lua_time_limit / 1000.0
+            if limit <= 0:
+                acquire()
+                return True
+            started = server.script_started
+            if started is None:
+                # Wait for at most the time limit, in case a script starts
+                timeout = limit
+            else:
+                timeout = started + limit - time.monotonic()
+                if timeout <= 0:
+                    return acquire(blocking=False)
+            if acquire(timeout=timeout):
+                return True
+
+    def _run_while_busy(self, func, sig, args):
+        """Run a command while a script is busy, without the server lock.
+
+        Like redis, only SCRIPT KILL and FUNCTION KILL are allowed; other
+        commands get a BUSY error.
+        """
+        if sig.name in {'script', 'function'} and args and casematch(args[0], b'kill'):
+            return self._run_command(func, sig, args, False)
+        raise SimpleError(msgs.FUNCTION_BUSY_MSG if self._server.script_is_function else msgs.BUSY_MSG)
+
     def _process_command(self, fields):
         if not fields:
             return
         func_name = None
         try:
-            func, func_name = self._name_to_func(fields[0])
-            sig = func._fakeredis_sig
-            with self._server.lock:
-                # Clean out old connections
-                while True:
-                    try:
-                        weak_sock = self._server.closed_sockets.pop()
-                    except IndexError:
-                        break
+            func, sig = self._name_to_func(fields[0])
+            func_name = sig.name
+            shared = self._shares_server_lock(sig)
+            if not self._acquire_server_lock(shared):
+                # A script has been running for longer than the time limit
+                result = self._run_while_busy(func, sig, fields[1:])
+            else:
+                try:
+                    # Clean out old connections
+                    while not shared:
+                        try:
+                            weak_sock = self._server.closed_sockets.pop()
+                        except IndexError:
+                            break
+                        else:
+                            sock = weak_sock()
+                            if sock:
+                                sock._cleanup(self._server)
+                    self._server.clock.update()
+                    self._server.active_expire_cycle()
+                    sig.check_arity(fields[1:])
+                    # TODO: make a signature attribute for transactions
+                    if self._transaction is not None \
+                            and func_name not in ('exec', 'discard', 'multi', 'watch'):
+                        self._transaction.append((func, sig, fields[1:]))
+                        result = QUEUED
+                    else:
+                        result = self._run_command(func, sig, fields[1:], False)
+                        self._serve_blocked()
+                finally:
+                    if shared:
+                        self._server.lock.release_shared()
                     else:
-                        sock = weak_sock()
-                        if sock:
-                            sock._cleanup(self._server)
-                now = time.time()
-                for db in self._server.dbs.values():
-                    db.time = now
-                sig.check_arity(fields[1:])
-                # TODO: make a signature attribute for transactions
-                if self._transaction is not None \
-                        and func_name not in ('exec', 'discard', 'multi', 'watch'):
-                    self._transaction.append((func, sig, fields[1:]))
-                    result = QUEUED
-                else:
-                    result = self._run_command(func, sig, fields[1:], False)
+                        self._server.lock.release()
         except SimpleError as exc:
             if self._transaction is not None:
                 # TODO: should not apply if the exception is from _run_command
@@ -281,17 +396,42 @@ class BaseFakeSocket:
         end = min(end, length - 1)
         return start, end + 1
 
+    def _match_keys(self, pattern):
+        """Return the keys of the current database that match a glob pattern.
+
+        If the pattern starts with a literal prefix, the keys with that prefix
+        are looked up in the key index, and only the rest of the pattern is
+        matched against the rest of each key.
+        """
+        prefix, rest = split_glob_prefix(pattern)
+        if not prefix:
+            regex = compile_pattern(pattern)
+            return [key for key in self._db if regex.match(key)]
+        if not rest:
+            return [prefix] if prefix in self._db else []
+        keys = self._db.keys_with_prefix(prefix)
+        if rest == b'*':
+            return keys
+        regex = compile_pattern(rest)
+        n = len(prefix)
+        return [key for key in keys if regex.match(key[n:])]
+
+    def _scan_snapshot(self, keys, pattern):
+        """Return the sorted members of `keys` that a new scan iterates over."""
+        if pattern is not None and keys is self._db:
+            return sorted(self._match_keys(pattern))
+        return sorted(keys)
+
     def _scan(self, keys, cursor, *args):
         """
         This is the basis of most of the ``scan`` methods.
 
-        This implementation is KNOWN to be un-performant, as it requires
-        grabbing the full set of keys over which we are investigating subsets.
-
-        It also doesn't adhere to the guarantee that every key will be iterated
-        at least once even if the database is modified during the scan.
-        However, provided the database is not modified, every key will be
-        returned exactly once.
+        `keys` is the collection being scanned. Scanning from cursor 0 takes a
+        sorted snapshot of its members, which later pages of the same scan
+        slice into, so each page costs time proportional to its size. Members
+        present for the whole scan are returned exactly once, whatever the
+        changes to the collection, and members deleted since the snapshot are
+        skipped. Members added during the scan are not returned.
         """
         cursor = int(cursor)
         pattern = None
@@ -311,32 +451,47 @@ class BaseFakeSocket:
             else:
                 raise SimpleError(msgs.SYNTAX_ERROR_MSG)
 
-        if cursor >= len(keys):
-            return [0, []]
-        data = sorted(keys)
-        result_cursor = cursor + count
-        result_data = []
-
-        regex = compile_pattern(pattern) if pattern is not None else None
-
-        def match_key(key):
-            return regex.match(key) if pattern is not None else True
-
-        def match_type(key):
-            if type is not None:
-                return casematch(self._type(self._db[key]).value, type)
-            return True
+        if cursor == 0:
+            scan_id = None
+            data = self._scan_snapshot(keys, pattern)
+            pos = 0
+        else:
+            # The cursor holds the position in the snapshot in its high bits
+            scan_id = cursor & self._server.SCAN_ID_MASK
+            pos = cursor >> self._server.SCAN_ID_BITS
+            data = self._server.scan_snapshot(scan_id, keys)
+            if data is None:
+                # The scan has been forgotten. Snapshots are sorted, so resume
+                # from the same position in a new one, which returns every
+                # member exactly once if the collection has not changed.
+                scan_id = None
+                data = self._scan_snapshot(keys, pattern)
+        result_cursor = pos + count
+        page = data[pos:result_cursor]
+        if scan_id is not None:
+            # Skip members deleted since the snapshot was taken
+            page = [key for key in page if key in keys]
 
         if pattern is not None or type is not None:
-            for val in itertools.islice(data, cursor, result_cursor):
-                compare_val = val[0] if isinstance(val, tuple) else val
-                if match_key(compare_val) and match_type(compare_val):
-                    result_data.append(val)
+            regex = compile_pattern(pattern) if pattern is not None else None
+            result_data = []
+            for val in page:
+                if regex is not None and not regex.match(val):
+                    continue
+                if type is not None and not casematch(self._type(self._db[val]).value, type):
+                    continue
+                result_data.append(val)
         else:
-            result_data = data[cursor:result_cursor]
+            result_data = page
 
         if result_cursor >= len(data):
+            if scan_id is not None:
+                self._server.end_scan(scan_id)
             result_cursor = 0
+        else:
+            if scan_id is None:
+                scan_id = self._server.start_scan(data, keys)
+            result_cursor = (result_cursor << self._server.SCAN_ID_BITS) | scan_id
         return [str(result_cursor).encode(), result_data]
 
     @staticmethod
@@ -370,9 +525,9 @@ class BaseFakeSocket:
     def _type(self, key):
         if key.value is None:
             return SimpleString(b'none')
-        elif isinstance(key.value, bytes):
+        elif isinstance(key.value, STRING_TYPES):
             return SimpleString(b'string')
-        elif isinstance(key.value, list):
+        elif isinstance(key.value, List):
             return SimpleString(b'list')
         elif isinstance(key.value, set):
             return SimpleString(b'set')
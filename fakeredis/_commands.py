@@ -1,11 +1,20 @@
+import collections
 import functools
+import itertools
 import math
 import re
+import types
 
 from . import _msgs as msgs
 from ._helpers import MAX_STRING_SIZE, null_terminate, SimpleError
 
 
+# Strings are stored as bytes, or as a bytearray once they have been changed
+# in place (by APPEND, SETRANGE or SETBIT), so that repeated changes do not
+# copy the whole string.
+STRING_TYPES = (bytes, bytearray)
+
+
 class Key:
     """Marker to indicate that argument in signature is a key"""
     UNSPECIFIED = object()
@@ -14,6 +23,19 @@ class Key:
         self.type_ = type_
         self.missing_return = missing_return
 
+    def command_item(self, key, db):
+        """Read `key` from `db`, checking its type, and wrap it in a CommandItem"""
+        item = db.get(key)
+        default = None
+        if self.type_ is not None:
+            if item is not None and type(item.value) != self.type_ and not (
+                    self.type_ is bytes and type(item.value) is bytearray):
+                raise SimpleError(msgs.WRONGTYPE_MSG)
+            if item is None:
+                if self.type_ is not bytes:
+                    default = self.type_()
+        return CommandItem(key, db, item, default=default)
+
 
 class Item:
     """An item stored in the database"""
@@ -76,18 +98,22 @@ class CommandItem:
     def writeback(self):
         if self._modified:
             self.db.notify_watch(self.key)
-            if not isinstance(self.value, bytes) and not self.value:
+            if not isinstance(self.value, STRING_TYPES) and not self.value:
                 self.db.pop(self.key, None)
                 return
             else:
-                item = self.db.setdefault(self.key, Item(None))
-                item.value = self.value
+                # Items are always stored through the database, which keeps
+                # track of their expiry
+                item = Item(self.value)
                 item.expireat = self.expireat
+                self.db[self.key] = item
         elif self._expireat_modified and self.key in self.db:
-            self.db[self.key].expireat = self.expireat
+            item = Item(self.db[self.key].value)
+            item.expireat = self.expireat
+            self.db[self.key] = item
 
     def __bool__(self):
-        return bool(self._value) or isinstance(self._value, bytes)
+        return bool(self._value) or isinstance(self._value, STRING_TYPES)
 
     __nonzero__ = __bool__  # For Python 2
 
@@ -96,6 +122,44 @@ class Hash(dict):
     redis_type = b'hash'
 
 
+class List(collections.deque):
+    """A redis list.
+
+    Like the quicklist of redis, a deque is a linked list of fixed-size
+    blocks, so pushing and popping at either end is O(1), and elements are
+    looked up by walking the blocks from the nearest end.
+    """
+
+    redis_type = b'list'
+
+    def slice(self, start, stop):
+        """Return the elements from `start` up to `stop` (not included).
+
+        Both must be non-negative. The elements are read from the end of the
+        list nearest to them.
+        """
+        length = len(self)
+        stop = min(stop, length)
+        if start >= stop:
+            return []
+        if start <= length - stop:
+            return list(itertools.islice(self, start, stop))
+        out = list(itertools.islice(reversed(self), length - stop, length - start))
+        out.reverse()
+        return out
+
+    def trim(self, start, stop):
+        """Keep only the elements from `start` up to `stop` (not included)"""
+        length = len(self)
+        if start >= stop:
+            self.clear()
+            return
+        for _ in range(length - stop):
+            self.pop()
+        for _ in range(start):
+            self.popleft()
+
+
 class Int:
     """Argument converter for 64-bit signed integers"""
 
@@ -295,11 +359,20 @@ class StringTest:
 
 
 class Signature:
+    """Describes the arguments of a command.
+
+    `fixed` gives the types of the leading arguments and `repeat` the types
+    of a group that may be repeated any number of times after them. At
+    construction the signature is specialised into :meth:`apply`, so that the
+    per-call work is only the conversions and key lookups themselves.
+    """
+
     def __init__(self, name, fixed, repeat=(), flags=""):
         self.name = name
         self.fixed = fixed
         self.repeat = repeat
         self.flags = flags
+        self.apply = self._compile()
 
     def check_arity(self, args):
         if len(args) != len(self.fixed):
@@ -307,46 +380,97 @@ class Signature:
             if delta < 0 or not self.repeat:
                 raise SimpleError(msgs.WRONG_ARGS_MSG.format(self.name))
 
-    def apply(self, args, db):
-        """Returns a tuple, which is either:
-        - transformed args and a dict of CommandItems; or
+    @staticmethod
+    def _convert_step(type_):
+        """First-pass work for an argument: a decoder, a Key with a short-circuit value, or None"""
+        if isinstance(type_, Key):
+            return type_ if type_.missing_return is not Key.UNSPECIFIED else None
+        return type_.decode if type_ != bytes else None
+
+    def _compile(self):
+        """Build the `apply` function for this signature.
+
+        `apply` returns a tuple, which is either:
+        - transformed args and a list of CommandItems; or
         - a single containing a short-circuit return value
-        """
-        self.check_arity(args)
-        if self.repeat:
-            delta = len(args) - len(self.fixed)
-            if delta % len(self.repeat) != 0:
-                raise SimpleError(msgs.WRONG_ARGS_MSG.format(self.name))
 
-        types = list(self.fixed)
-        for i in range(len(args) - len(types)):
-            types.append(self.repeat[i % len(self.repeat)])
-
-        args = list(args)
-        # First pass: convert/validate non-keys, and short-circuit on missing keys
-        for i, (arg, type_) in enumerate(zip(args, types)):
-            if isinstance(type_, Key):
-                if type_.missing_return is not Key.UNSPECIFIED and arg not in db:
-                    return (type_.missing_return,)
-            elif type_ != bytes:
-                args[i] = type_.decode(args[i], )
-
-        # Second pass: read keys and check their types
-        command_items = []
-        for i, (arg, type_) in enumerate(zip(args, types)):
-            if isinstance(type_, Key):
-                item = db.get(arg)
-                default = None
-                if type_.type_ is not None:
-                    if item is not None and type(item.value) != type_.type_:
-                        raise SimpleError(msgs.WRONGTYPE_MSG)
-                    if item is None:
-                        if type_.type_ is not bytes:
-                            default = type_.type_()
-                args[i] = CommandItem(arg, db, item, default=default)
+        Arguments are processed in two passes, exactly as redis does: the first
+        converts and validates non-keys and short-circuits on missing keys, the
+        second reads the keys and checks their types. Errors are therefore
+        reported for the first offending argument in each pass.
+        """
+        wrong_args_msg = msgs.WRONG_ARGS_MSG.format(self.name)
+        n_fixed = len(self.fixed)
+        n_repeat = len(self.repeat)
+        # (position, step) for the fixed arguments, in order
+        fixed_steps = [(i, step) for i, step in enumerate(map(self._convert_step, self.fixed))
+                       if step is not None]
+        fixed_keys = [(i, type_) for i, type_ in enumerate(self.fixed) if isinstance(type_, Key)]
+        # (column, step) for the repeated arguments
+        repeat_steps = [(j, step) for j, step in enumerate(map(self._convert_step, self.repeat))
+                        if step is not None]
+        repeat_keys = [(j, type_) for j, type_ in enumerate(self.repeat) if isinstance(type_, Key)]
+
+        def first_pass_repeat(args, db):
+            n_args = len(args)
+            if len(repeat_steps) == 1:
+                # A single column can be handled as a whole, preserving order
+                j, step = repeat_steps[0]
+                column = slice(n_fixed + j, n_args, n_repeat)
+                if isinstance(step, Key):
+                    for arg in args[column]:
+                        if arg not in db:
+                            return (step.missing_return,)
+                else:
+                    args[column] = list(map(step, args[column]))
+                return None
+            for base in range(n_fixed, n_args, n_repeat):
+                for j, step in repeat_steps:
+                    if isinstance(step, Key):
+                        if args[base + j] not in db:
+                            return (step.missing_return,)
+                    else:
+                        args[base + j] = step(args[base + j])
+            return None
+
+        def repeat_key_positions(n_args):
+            if len(repeat_keys) == 1:
+                j, type_ = repeat_keys[0]
+                return ((i, type_) for i in range(n_fixed + j, n_args, n_repeat))
+            return ((base + j, type_)
+                    for base in range(n_fixed, n_args, n_repeat) for j, type_ in repeat_keys)
+
+        def apply(args, db):
+            n_args = len(args)
+            if n_args != n_fixed:
+                delta = n_args - n_fixed
+                if delta < 0 or not n_repeat or delta % n_repeat != 0:
+                    raise SimpleError(wrong_args_msg)
+            args = list(args)
+            # First pass: convert/validate non-keys, and short-circuit on missing keys
+            for i, step in fixed_steps:
+                if isinstance(step, Key):
+                    if args[i] not in db:
+                        return (step.missing_return,)
+                else:
+                    args[i] = step(args[i])
+            if repeat_steps and n_args > n_fixed:
+                ret = first_pass_repeat(args, db)
+                if ret is not None:
+                    return ret
+
+            # Second pass: read keys and check their types
+            command_items = []
+            for i, type_ in fixed_keys:
+                args[i] = type_.command_item(args[i], db)
                 command_items.append(args[i])
+            if repeat_keys and n_args > n_fixed:
+                for i, type_ in repeat_key_positions(n_args):
+                    args[i] = type_.command_item(args[i], db)
+                    command_items.append(args[i])
+            return args, command_items
 
-        return args, command_items
+        return apply
 
 
 def command(*args, **kwargs):
@@ -356,3 +480,21 @@ def command(*args, **kwargs):
         return func
 
     return decorator
+
+
+def build_command_table(cls):
+    """Collect the commands implemented by a socket class.
+
+    Returns a read-only mapping from the lowercase command name (as bytes) to
+    a ``(func, sig)`` pair, where `func` is the unbound handler and `sig` its
+    :class:`Signature` (which also carries the command flags).
+    """
+    table = {}
+    for attr in dir(cls):
+        if attr.startswith('_'):
+            continue
+        func = getattr(cls, attr)
+        sig = getattr(func, '_fakeredis_sig', None)
+        if sig is not None:
+            table[attr.encode()] = (func, sig)
+    return types.MappingProxyType(table)
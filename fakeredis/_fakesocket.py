@@ -12,12 +12,247 @@ from . import _msgs as msgs
 from ._basefakesocket import BaseFakeSocket
 from ._commands import (
     Key, command, DbIndex, Int, CommandItem, BeforeAny, SortFloat, Float, BitOffset, BitValue, Hash,
-    StringTest, ScoreTest, Timeout)
+    List, StringTest, ScoreTest, Timeout, STRING_TYPES)
 from ._helpers import (
     PONG, OK, MAX_STRING_SIZE, SimpleError, SimpleString, casematch,
     BGSAVE_STARTED, REDIS_LOG_LEVELS_TO_LOGGING, LOGGER, REDIS_LOG_LEVELS, casenorm, compile_pattern)
+from ._hll import HyperLogLog, HLL_REGISTERS, cardinality, merge_registers, registers_histogram
 from ._msgs import LUA_COMMAND_ARG_MSG, LUA_COMMAND_ARG_MSG6
-from ._zset import ZSet
+from ._zset import ZSet, AGGREGATES
+
+
+class LuaRuntime:
+    """A Lua runtime with the redis scripting environment, reused by scripts.
+
+    The environment is set up once, and the ``redis`` functions dispatch to
+    `socket`, which is set for the duration of each script. Scripts are
+    compiled the first time they run in this runtime, and cached by SHA1.
+    Each run gets its own table of globals, so scripts can't affect later
+    ones through global variables. With `version` 7 or later, the shared
+    globals and library tables are also read-only, like in redis 7.
+    """
+
+    # Number of Lua instructions between checks for SCRIPT KILL
+    KILL_CHECK_INTERVAL = 100000
+
+    def __init__(self, version=7):
+        from lupa import LuaRuntime as _LuaRuntime, as_attrgetter
+
+        self.lua = _LuaRuntime(encoding=None, unpack_returned_tuples=True)
+        self.socket = None
+        self.scripts = {}  # Maps SHA1 to compiled script
+        # Set while running a script that may not run write commands
+        self.read_only = False
+        set_globals = self.lua.eval(
+            """
+            function(redis_call, redis_pcall, redis_log, redis_log_levels)
+                redis = {}
+                redis.call = redis_call
+                redis.pcall = redis_pcall
+                redis.log = redis_log
+                for level, pylevel in python.iterex(redis_log_levels.items()) do
+                    redis[level] = pylevel
+                end
+                redis.error_reply = function(msg) return {err=msg} end
+                redis.status_reply = function(msg) return {ok=msg} end
+                KEYS = {}
+                ARGV = {}
+            end
+            """
+        )
+        set_globals(
+            lambda *args: self.socket._lua_redis_call(self, *args),
+            lambda *args: self.socket._lua_redis_pcall(self, *args),
+            lambda *args: self.socket._lua_redis_log(self, *args),
+            as_attrgetter(REDIS_LOG_LEVELS)
+        )
+        # Scripts share the runtime, so each one runs in a new environment
+        # that reads the globals, and where scripts may not create global
+        # variables. For redis 7, the standard tables are read through
+        # read-only proxies and the existing globals can't be changed either.
+        self._compile, self._run = self.lua.eval(
+            """
+            function(set_global, read_only)
+                local error, load, next, rawset, setmetatable = error, load, next, rawset, setmetatable
+                local setupvalue = debug.setupvalue
+                local readonly = setmetatable({}, {__mode = 'k'})
+                local function reject()
+                    error('Attempt to modify a readonly table', 2)
+                end
+                local function protect(t)
+                    local proxy = setmetatable({}, {
+                        __index = t, __newindex = reject, __metatable = false,
+                        __pairs = function() return next, t, nil end,
+                        __len = function() return #t end,
+                    })
+                    readonly[proxy] = true
+                    return proxy
+                end
+                local globals = _G
+                if read_only then
+                    globals = {}
+                    for name, value in pairs(_G) do
+                        if type(value) == 'table' and name ~= '_G' then
+                            value = protect(value)
+                        end
+                        globals[name] = value
+                    end
+                    globals.rawset = function(t, k, v)
+                        if readonly[t] then reject() end
+                        return rawset(t, k, v)
+                    end
+                    getmetatable('').__metatable = false
+                end
+                local env_mt = {
+                    __index = globals, __metatable = false,
+                    __newindex = function(t, name, value)
+                        if globals[name] == nil then
+                            set_global(name)
+                        elseif read_only then
+                            error('Attempt to modify a readonly table', 2)
+                        end
+                        rawset(t, name, value)
+                    end,
+                }
+                local function new_env(keys, argv)
+                    local env = setmetatable({KEYS = keys, ARGV = argv}, env_mt)
+                    rawset(env, '_G', env)
+                    return env
+                end
+                local function compile(code)
+                    local chunk, err = load(code, '@user_script', 't', new_env({}, {}))
+                    if not chunk then error(err, 0) end
+                    return chunk
+                end
+                local function run(chunk, keys, argv)
+                    setupvalue(chunk, 1, new_env(keys, argv))
+                    return chunk()
+                end
+                return compile, run
+            end
+            """
+        )(self._set_global, version >= 7)
+        # Check periodically whether the script has been killed
+        self._set_kill_hook = self.lua.eval(
+            """
+            function(check_kill)
+                local sethook = debug.sethook
+                local function hook() check_kill() end
+                return function(count) sethook(hook, '', count) end
+            end
+            """
+        )(self._check_kill)
+        self._set_kill_hook(self.KILL_CHECK_INTERVAL)
+        # Runs the body of a library, with redis.register_function available
+        # and without redis.call and redis.pcall, like FUNCTION LOAD.
+        self._load_library = self.lua.eval(
+            """
+            function(chunk, register_function)
+                local call, pcall_ = redis.call, redis.pcall
+                redis.call, redis.pcall = nil, nil
+                rawset(redis, 'register_function', register_function)
+                local ok, err = pcall(chunk)
+                redis.call, redis.pcall, redis.register_function = call, pcall_, nil
+                if not ok then error(err, 0) end
+            end
+            """
+        )
+
+    def _set_global(self, name):
+        raise SimpleError(msgs.GLOBAL_VARIABLE_MSG.format(self.socket.ensure_str(name)))
+
+    def _check_kill(self):
+        if self.socket._server.script_kill:
+            # Check on every instruction from now on, so that a script that
+            # catches the error with pcall stops at its next instruction.
+            self._set_kill_hook(1)
+            raise SimpleError(msgs.SCRIPT_KILLED_MSG)
+
+    def end_script(self):
+        """Restore the periodic kill check after a script has run."""
+        self._set_kill_hook(self.KILL_CHECK_INTERVAL)
+
+    def run(self, sha1, script, keys, argv):
+        """Run a script with the given KEYS and ARGV, returning its result"""
+        compiled = self.scripts.get(sha1)
+        if compiled is None:
+            compiled = self.scripts[sha1] = self._compile(script)
+        return self._run(compiled, self.lua.table_from(keys), self.lua.table_from(argv))
+
+    def load_library(self, code):
+        """Run the code of a library, returning the functions it registers.
+
+        The result maps function names to `LuaFunction`. Errors in the code
+        are raised as `lupa.LuaError`, and invalid registrations as
+        `SimpleError`.
+        """
+        from lupa import lua_type
+
+        functions = {}
+
+        def register_function(*args):
+            if len(args) == 1 and lua_type(args[0]) == 'table':
+                table = dict(args[0].items())
+                unknown = set(table) - {b'function_name', b'callback', b'flags', b'description'}
+                if unknown:
+                    raise SimpleError(msgs.FUNCTION_UNKNOWN_ARG_MSG)
+                name = table.get(b'function_name')
+                callback = table.get(b'callback')
+                flags = table.get(b'flags')
+                description = table.get(b'description')
+            elif len(args) == 2:
+                name, callback = args
+                flags = description = None
+            else:
+                raise SimpleError(msgs.FUNCTION_REGISTER_ARGS_MSG)
+            if not isinstance(name, bytes) or not _valid_name(name):
+                raise SimpleError(msgs.INVALID_FUNCTION_NAME_MSG)
+            if lua_type(callback) != 'function':
+                raise SimpleError(msgs.FUNCTION_CALLBACK_MSG)
+            flags = list(flags.values()) if lua_type(flags) == 'table' else []
+            if any(flag not in LuaFunction.FLAGS for flag in flags):
+                raise SimpleError(msgs.FUNCTION_UNKNOWN_FLAG_MSG)
+            if name in functions:
+                raise SimpleError(msgs.FUNCTION_EXISTS_IN_LIBRARY_MSG)
+            functions[name] = LuaFunction(name, callback, flags, description)
+
+        self._load_library(self._compile(code), register_function)
+        return functions
+
+    def call(self, function, keys, argv):
+        """Call a function registered by a library"""
+        return function.callback(self.lua.table_from(keys), self.lua.table_from(argv))
+
+
+def _valid_name(name):
+    return bool(name) and all(c in _NAME_CHARS for c in name)
+
+
+_NAME_CHARS = frozenset(b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_')
+
+
+class LuaFunction:
+    """A function registered by a library loaded with FUNCTION LOAD"""
+
+    FLAGS = frozenset([b'no-writes', b'allow-oom', b'allow-stale', b'no-cluster', b'allow-cross-slot-keys'])
+
+    def __init__(self, name, callback, flags, description):
+        self.name = name
+        self.callback = callback
+        self.flags = flags
+        self.description = description
+        self.library = None
+
+
+class LuaLibrary:
+    """A library loaded with FUNCTION LOAD, with its source and functions"""
+
+    def __init__(self, name, code, functions):
+        self.name = name
+        self.code = code
+        self.functions = functions
+        for function in functions.values():
+            function.library = self
 
 
 class FakeSocket(BaseFakeSocket):
@@ -48,7 +283,7 @@ class FakeSocket(BaseFakeSocket):
         self._db_num = index
         return OK
 
-    @command((DbIndex, DbIndex))
+    @command((DbIndex, DbIndex), flags='w')
     def swapdb(self, index1, index2):
         if index1 != index2:
             db1 = self._server.dbs[index1]
@@ -59,11 +294,11 @@ class FakeSocket(BaseFakeSocket):
     # Key commands
     # TODO: lots
 
-    @command((Key(),), (Key(),), name='del')
+    @command((Key(),), (Key(),), name='del', flags='w')
     def del_(self, *keys):
         return self._delete(*keys)
 
-    @command((Key(),), (Key(),), name='unlink')
+    @command((Key(),), (Key(),), name='unlink', flags='w')
     def unlink(self, *keys):
         return self._delete(*keys)
 
@@ -83,20 +318,20 @@ class FakeSocket(BaseFakeSocket):
         else:
             return int(round((key.expireat - self._db.time) * scale))
 
-    @command((Key(), Int,), (bytes,), name='expire')
+    @command((Key(), Int,), (bytes,), name='expire', flags='w')
     def expire(self, key, seconds, *args):
         res = self._expireat(key, self._db.time + seconds, *args)
         return res
 
-    @command((Key(), Int))
+    @command((Key(), Int), flags='w')
     def expireat(self, key, timestamp):
         return self._expireat(key, float(timestamp))
 
-    @command((Key(), Int))
+    @command((Key(), Int), flags='w')
     def pexpire(self, key, ms):
         return self._expireat(key, self._db.time + ms / 1000.0)
 
-    @command((Key(), Int))
+    @command((Key(), Int), flags='w')
     def pexpireat(self, key, ms_timestamp):
         return self._expireat(key, ms_timestamp / 1000.0)
 
@@ -112,7 +347,7 @@ class FakeSocket(BaseFakeSocket):
     def type(self, key):
         return self._type(key)
 
-    @command((Key(),))
+    @command((Key(),), flags='w')
     def persist(self, key):
         if key.expireat is None:
             return 0
@@ -124,10 +359,9 @@ class FakeSocket(BaseFakeSocket):
         if pattern == b'*':
             return list(self._db)
         else:
-            regex = compile_pattern(pattern)
-            return [key for key in self._db if regex.match(key)]
+            return self._match_keys(pattern)
 
-    @command((Key(), DbIndex))
+    @command((Key(), DbIndex), flags='w')
     def move(self, key, db):
         if db == self._db_num:
             raise SimpleError(msgs.SRC_DST_SAME_MSG)
@@ -145,7 +379,7 @@ class FakeSocket(BaseFakeSocket):
             return None
         return random.choice(keys)
 
-    @command((Key(), Key()))
+    @command((Key(), Key()), flags='w')
     def rename(self, key, newkey):
         if not key:
             raise SimpleError(msgs.NO_KEY_MSG)
@@ -156,7 +390,7 @@ class FakeSocket(BaseFakeSocket):
             key.value = None
         return OK
 
-    @command((Key(), Key()))
+    @command((Key(), Key()), flags='w')
     def renamenx(self, key, newkey):
         if not key:
             raise SimpleError(msgs.NO_KEY_MSG)
@@ -167,7 +401,7 @@ class FakeSocket(BaseFakeSocket):
 
     @command((Int,), (bytes, bytes))
     def scan(self, cursor, *args):
-        return self._scan(list(self._db), cursor, *args)
+        return self._scan(self._db, cursor, *args)
 
     def _lookup_key(self, key, pattern):
         """Python implementation of lookupKeyByPattern from redis"""
@@ -193,11 +427,11 @@ class FakeSocket(BaseFakeSocket):
                 return None
             return item.value.get(field)
         else:
-            if not isinstance(item.value, bytes):
+            if not isinstance(item.value, STRING_TYPES):
                 return None
-            return item.value
+            return bytes(item.value)
 
-    @command((Key(),), (bytes,))
+    @command((Key(),), (bytes,), flags='w')
     def sort(self, key, *args):
         i = 0
         desc = False
@@ -209,7 +443,7 @@ class FakeSocket(BaseFakeSocket):
         dontsort = False
         get = []
         if key.value is not None:
-            if not isinstance(key.value, (set, list, ZSet)):
+            if not isinstance(key.value, (set, List, ZSet)):
                 raise SimpleError(msgs.WRONGTYPE_MSG)
 
         while i < len(args):
@@ -277,7 +511,7 @@ class FakeSocket(BaseFakeSocket):
                     return (score, v)
 
             items.sort(key=sort_key, reverse=desc)
-        elif isinstance(key.value, (list, ZSet)):
+        elif isinstance(key.value, (List, ZSet)):
             items.reverse()
 
         out = []
@@ -289,7 +523,7 @@ class FakeSocket(BaseFakeSocket):
                 out.append(v)
         if store is not None:
             item = CommandItem(store, self._db, item=self._db.get(store))
-            item.value = out
+            item.value = List(out)
             item.writeback()
             return len(out)
         else:
@@ -301,7 +535,7 @@ class FakeSocket(BaseFakeSocket):
         checksum = hashlib.sha1(value).digest()
         return checksum + value
 
-    @command((Key(), Int, bytes), (bytes,))
+    @command((Key(), Int, bytes), (bytes,), flags='w')
     def restore(self, key, ttl, value, *args):
         replace = False
         i = 0
@@ -390,13 +624,29 @@ class FakeSocket(BaseFakeSocket):
     # String commands
     # TODO: bitfield, bitop, bitpos
 
-    @command((Key(bytes), bytes))
+    @staticmethod
+    def _string_buffer(key):
+        """Return the value of a string key as a bytearray to change in place.
+
+        Strings are stored as bytes until they are first changed in place.
+        Growing a bytearray over-allocates, so appending to it takes amortised
+        constant time, like the SDS strings of redis.
+        """
+        value = key.value
+        if type(value) is not bytearray:
+            value = bytearray(value) if value is not None else bytearray()
+            key.update(value)
+        return value
+
+    @command((Key(bytes), bytes), flags='w')
     def append(self, key, value):
         old = key.get(b'')
         if len(old) + len(value) > MAX_STRING_SIZE:
             raise SimpleError(msgs.STRING_OVERFLOW_MSG)
-        key.update(key.get(b'') + value)
-        return len(key.value)
+        buf = self._string_buffer(key)
+        buf += value
+        key.updated()
+        return len(buf)
 
     @command((Key(bytes, 0),), (bytes,))
     def bitcount(self, key, *args):
@@ -413,28 +663,28 @@ class FakeSocket(BaseFakeSocket):
             value = key.value
         return bin(int.from_bytes(value, 'little')).count('1')
 
-    @command((Key(bytes), Int))
+    @command((Key(bytes), Int), flags='w')
     def decrby(self, key, amount):
         return self.incrby(key, -amount)
 
-    @command((Key(bytes),))
+    @command((Key(bytes),), flags='w')
     def decr(self, key):
         return self.incrby(key, -1)
 
-    @command((Key(bytes), Int))
+    @command((Key(bytes), Int), flags='w')
     def incrby(self, key, amount):
-        c = Int.decode(key.get(b'0')) + amount
+        c = Int.decode(bytes(key.get(b'0'))) + amount
         key.update(self._encodeint(c))
         return c
 
-    @command((Key(bytes),))
+    @command((Key(bytes),), flags='w')
     def incr(self, key):
         return self.incrby(key, 1)
 
-    @command((Key(bytes), bytes))
+    @command((Key(bytes), bytes), flags='w')
     def incrbyfloat(self, key, amount):
         # TODO: introduce convert_order so that we can specify amount is Float
-        c = Float.decode(key.get(b'0')) + Float.decode(amount)
+        c = Float.decode(bytes(key.get(b'0'))) + Float.decode(amount)
         if not math.isfinite(c):
             raise SimpleError(msgs.NONFINITE_MSG)
         encoded = self._encodefloat(c, True)
@@ -443,7 +693,9 @@ class FakeSocket(BaseFakeSocket):
 
     @command((Key(bytes),))
     def get(self, key):
-        return key.get(None)
+        value = key.get(None)
+        # Return a copy of a string that may still be changed in place
+        return bytes(value) if value is not None else None
 
     @command((Key(bytes), BitOffset))
     def getbit(self, key, offset):
@@ -457,56 +709,54 @@ class FakeSocket(BaseFakeSocket):
             return 0
         return 1 if (1 << actual_bitoffset) & actual_val else 0
 
-    @command((Key(bytes), BitOffset, BitValue))
+    @command((Key(bytes), BitOffset, BitValue), flags='w')
     def setbit(self, key, offset, value):
-        val = key.get(b'\x00')
+        val = self._string_buffer(key)
         byte = offset // 8
         remaining = offset % 8
         actual_bitoffset = 7 - remaining
         if len(val) - 1 < byte:
             # We need to expand val so that we can set the appropriate
             # bit.
-            needed = byte - (len(val) - 1)
-            val += b'\x00' * needed
+            val.extend(bytes(byte + 1 - len(val)))
         old_byte = val[byte]
         if value == 1:
             new_byte = old_byte | (1 << actual_bitoffset)
         else:
             new_byte = old_byte & ~(1 << actual_bitoffset)
         old_value = value if old_byte == new_byte else 1 - value
-        reconstructed = bytearray(val)
-        reconstructed[byte] = new_byte
-        key.update(bytes(reconstructed))
+        val[byte] = new_byte
+        key.updated()
         return old_value
 
     @command((Key(bytes), Int, Int))
     def getrange(self, key, start, end):
         value = key.get(b'')
         start, end = self._fix_range_string(start, end, len(value))
-        return value[start:end]
+        return bytes(value[start:end])
 
     # substr is a deprecated alias for getrange
     @command((Key(bytes), Int, Int))
     def substr(self, key, start, end):
         return self.getrange(key, start, end)
 
-    @command((Key(bytes), bytes))
+    @command((Key(bytes), bytes), flags='w')
     def getset(self, key, value):
         old = key.value
         key.value = value
-        return old
+        return bytes(old) if old is not None else None
 
     @command((Key(),), (Key(),))
     def mget(self, *keys):
-        return [key.value if isinstance(key.value, bytes) else None for key in keys]
+        return [bytes(key.value) if isinstance(key.value, STRING_TYPES) else None for key in keys]
 
-    @command((Key(), bytes), (Key(), bytes))
+    @command((Key(), bytes), (Key(), bytes), flags='w')
     def mset(self, *args):
         for i in range(0, len(args), 2):
             args[i].value = args[i + 1]
         return OK
 
-    @command((Key(), bytes), (Key(), bytes))
+    @command((Key(), bytes), (Key(), bytes), flags='w')
     def msetnx(self, *args):
         for i in range(0, len(args), 2):
             if args[i]:
@@ -515,7 +765,7 @@ class FakeSocket(BaseFakeSocket):
             args[i].value = args[i + 1]
         return 1
 
-    @command((Key(), bytes), (bytes,), name='set')
+    @command((Key(), bytes), (bytes,), name='set', flags='w')
     def set_(self, key, value, *args):
         i = 0
         ex = None
@@ -557,9 +807,9 @@ class FakeSocket(BaseFakeSocket):
 
         old_value = None
         if get:
-            if key.value is not None and type(key.value) is not bytes:
+            if key.value is not None and not isinstance(key.value, STRING_TYPES):
                 raise SimpleError(msgs.WRONGTYPE_MSG)
-            old_value = key.value
+            old_value = bytes(key.value) if key.value is not None else None
 
         if nx and key:
             return old_value
@@ -575,7 +825,7 @@ class FakeSocket(BaseFakeSocket):
             key.expireat = self._db.time + px / 1000.0
         return OK if not get else old_value
 
-    @command((Key(), Int, bytes))
+    @command((Key(), Int, bytes), flags='w')
     def setex(self, key, seconds, value):
         if seconds <= 0 or (self._db.time + seconds) * 1000 >= 2 ** 63:
             raise SimpleError(msgs.INVALID_EXPIRE_MSG.format('setex'))
@@ -583,7 +833,7 @@ class FakeSocket(BaseFakeSocket):
         key.expireat = self._db.time + seconds
         return OK
 
-    @command((Key(), Int, bytes))
+    @command((Key(), Int, bytes), flags='w')
     def psetex(self, key, ms, value):
         if ms <= 0 or self._db.time * 1000 + ms >= 2 ** 63:
             raise SimpleError(msgs.INVALID_EXPIRE_MSG.format('psetex'))
@@ -591,14 +841,14 @@ class FakeSocket(BaseFakeSocket):
         key.expireat = self._db.time + ms / 1000.0
         return OK
 
-    @command((Key(), bytes))
+    @command((Key(), bytes), flags='w')
     def setnx(self, key, value):
         if key:
             return 0
         key.value = value
         return 1
 
-    @command((Key(bytes), Int, bytes))
+    @command((Key(bytes), Int, bytes), flags='w')
     def setrange(self, key, offset, value):
         if offset < 0:
             raise SimpleError(msgs.INVALID_OFFSET_MSG)
@@ -607,11 +857,11 @@ class FakeSocket(BaseFakeSocket):
         elif offset + len(value) > MAX_STRING_SIZE:
             raise SimpleError(msgs.STRING_OVERFLOW_MSG)
         else:
-            out = key.get(b'')
+            out = self._string_buffer(key)
             if len(out) < offset:
-                out += b'\x00' * (offset - len(out))
-            out = out[0:offset] + value + out[offset + len(value):]
-            key.update(out)
+                out.extend(bytes(offset - len(out)))
+            out[offset:offset + len(value)] = value
+            key.updated()
             return len(out)
 
     @command((Key(bytes),))
@@ -620,7 +870,7 @@ class FakeSocket(BaseFakeSocket):
 
     # Hash commands
 
-    @command((Key(Hash), bytes), (bytes,))
+    @command((Key(Hash), bytes), (bytes,), flags='w')
     def hdel(self, key, *fields):
         h = key.value
         rem = 0
@@ -643,14 +893,14 @@ class FakeSocket(BaseFakeSocket):
     def hgetall(self, key):
         return list(itertools.chain(*key.value.items()))
 
-    @command((Key(Hash), bytes, Int))
+    @command((Key(Hash), bytes, Int), flags='w')
     def hincrby(self, key, field, amount):
         c = Int.decode(key.value.get(field, b'0')) + amount
         key.value[field] = self._encodeint(c)
         key.updated()
         return c
 
-    @command((Key(Hash), bytes, bytes))
+    @command((Key(Hash), bytes, bytes), flags='w')
     def hincrbyfloat(self, key, field, amount):
         c = Float.decode(key.value.get(field, b'0')) + Float.decode(amount)
         if not math.isfinite(c):
@@ -672,7 +922,7 @@ class FakeSocket(BaseFakeSocket):
     def hmget(self, key, *fields):
         return [key.value.get(field) for field in fields]
 
-    @command((Key(Hash), bytes, bytes), (bytes, bytes))
+    @command((Key(Hash), bytes, bytes), (bytes, bytes), flags='w')
     def hmset(self, key, *args):
         self.hset(key, *args)
         return OK
@@ -686,7 +936,7 @@ class FakeSocket(BaseFakeSocket):
             items.append(key.value[k])
         return [cursor, items]
 
-    @command((Key(Hash), bytes, bytes), (bytes, bytes))
+    @command((Key(Hash), bytes, bytes), (bytes, bytes), flags='w')
     def hset(self, key, *args):
         h = key.value
         created = 0
@@ -697,7 +947,7 @@ class FakeSocket(BaseFakeSocket):
         key.updated()
         return created
 
-    @command((Key(Hash), bytes, bytes))
+    @command((Key(Hash), bytes, bytes), flags='w')
     def hsetnx(self, key, field, value):
         if field in key.value:
             return 0
@@ -715,8 +965,8 @@ class FakeSocket(BaseFakeSocket):
 
     def _bpop_pass(self, keys, op, first_pass):
         for key in keys:
-            item = CommandItem(key, self._db, item=self._db.get(key), default=[])
-            if not isinstance(item.value, list):
+            item = CommandItem(key, self._db, item=self._db.get(key), default=List())
+            if not isinstance(item.value, List):
                 if first_pass:
                     raise SimpleError(msgs.WRONGTYPE_MSG)
                 else:
@@ -731,30 +981,30 @@ class FakeSocket(BaseFakeSocket):
     def _bpop(self, args, op):
         keys = args[:-1]
         timeout = Timeout.decode(args[-1])
-        return self._blocking(timeout, functools.partial(self._bpop_pass, keys, op))
+        return self._blocking(timeout, functools.partial(self._bpop_pass, keys, op), keys)
 
-    @command((bytes, bytes), (bytes,), flags='s')
+    @command((bytes, bytes), (bytes,), flags='sw')
     def blpop(self, *args):
-        return self._bpop(args, lambda lst: lst.pop(0))
+        return self._bpop(args, lambda lst: lst.popleft())
 
-    @command((bytes, bytes), (bytes,), flags='s')
+    @command((bytes, bytes), (bytes,), flags='sw')
     def brpop(self, *args):
         return self._bpop(args, lambda lst: lst.pop())
 
     def _brpoplpush_pass(self, source, destination, first_pass):
-        src = CommandItem(source, self._db, item=self._db.get(source), default=[])
-        if not isinstance(src.value, list):
+        src = CommandItem(source, self._db, item=self._db.get(source), default=List())
+        if not isinstance(src.value, List):
             if first_pass:
                 raise SimpleError(msgs.WRONGTYPE_MSG)
             else:
                 return None
         if not src.value:
             return None  # Empty list
-        dst = CommandItem(destination, self._db, item=self._db.get(destination), default=[])
-        if not isinstance(dst.value, list):
+        dst = CommandItem(destination, self._db, item=self._db.get(destination), default=List())
+        if not isinstance(dst.value, List):
             raise SimpleError(msgs.WRONGTYPE_MSG)
         el = src.value.pop()
-        dst.value.insert(0, el)
+        dst.value.appendleft(el)
         src.updated()
         src.writeback()
         if destination != source:
@@ -763,19 +1013,20 @@ class FakeSocket(BaseFakeSocket):
             dst.writeback()
         return el
 
-    @command((bytes, bytes, Timeout), flags='s')
+    @command((bytes, bytes, Timeout), flags='sw')
     def brpoplpush(self, source, destination, timeout):
         return self._blocking(timeout,
-                              functools.partial(self._brpoplpush_pass, source, destination))
+                              functools.partial(self._brpoplpush_pass, source, destination),
+                              (source,))
 
-    @command((Key(list, None), Int))
+    @command((Key(List, None), Int))
     def lindex(self, key, index):
         try:
             return key.value[index]
         except IndexError:
             return None
 
-    @command((Key(list), bytes, bytes, bytes))
+    @command((Key(List), bytes, bytes, bytes), flags='w')
     def linsert(self, key, where, pivot, value):
         if not casematch(where, b'before') and not casematch(where, b'after'):
             raise SimpleError(msgs.SYNTAX_ERROR_MSG)
@@ -792,11 +1043,11 @@ class FakeSocket(BaseFakeSocket):
             key.updated()
             return len(key.value)
 
-    @command((Key(list),))
+    @command((Key(List),))
     def llen(self, key):
         return len(key.value)
 
-    @command((Key(list, None), Key(list), SimpleString, SimpleString))
+    @command((Key(List, None), Key(List), SimpleString, SimpleString), flags='w')
     def lmove(self, first_list, second_list, src, dst):
         if src not in [b'LEFT', b'RIGHT']:
             raise SimpleError(msgs.SYNTAX_ERROR_MSG)
@@ -806,11 +1057,10 @@ class FakeSocket(BaseFakeSocket):
         self.lpush(second_list, el) if dst == b'LEFT' else self.rpush(second_list, el)
         return el
 
-    def _list_pop(self, get_slice, key, *args):
+    def _list_pop(self, pop, key, *args):
         """Implements lpop and rpop.
 
-        `get_slice` must take a count and return a slice expression for the
-        range to pop.
+        `pop` must remove and return an element from the list.
         """
         # This implementation is somewhat contorted to match the odd
         # behaviours described in https://github.com/redis/redis/issues/9680.
@@ -825,60 +1075,62 @@ class FakeSocket(BaseFakeSocket):
                 return None
         if not key:
             return None
-        elif type(key.value) != list:
+        elif type(key.value) != List:
             raise SimpleError(msgs.WRONGTYPE_MSG)
-        slc = get_slice(count)
-        ret = key.value[slc]
-        del key.value[slc]
+        ret = [pop(key.value) for _ in range(min(count, len(key.value)))]
         key.updated()
         if not args:
             ret = ret[0]
         return ret
 
-    @command((Key(),), (Int(),))
+    @command((Key(),), (Int(),), flags='w')
     def lpop(self, key, *args):
-        return self._list_pop(lambda count: slice(None, count), key, *args)
+        return self._list_pop(List.popleft, key, *args)
 
-    @command((Key(list), bytes), (bytes,))
+    @command((Key(List), bytes), (bytes,), flags='w')
     def lpush(self, key, *values):
-        for value in values:
-            key.value.insert(0, value)
+        key.value.extendleft(values)
         key.updated()
         return len(key.value)
 
-    @command((Key(list), bytes), (bytes,))
+    @command((Key(List), bytes), (bytes,), flags='w')
     def lpushx(self, key, *values):
         if not key:
             return 0
         return self.lpush(key, *values)
 
-    @command((Key(list), Int, Int))
+    @command((Key(List), Int, Int))
     def lrange(self, key, start, stop):
         start, stop = self._fix_range(start, stop, len(key.value))
-        return key.value[start:stop]
+        return key.value.slice(start, stop)
 
-    @command((Key(list), Int, bytes))
+    @command((Key(List), Int, bytes), flags='w')
     def lrem(self, key, count, value):
         a_list = key.value
-        found = []
-        for i, el in enumerate(a_list):
-            if el == value:
-                found.append(i)
-        if count > 0:
-            indices_to_remove = found[:count]
-        elif count < 0:
-            indices_to_remove = found[count:]
+        if count == 0:
+            kept = [el for el in a_list if el != value]
+            removed = len(a_list) - len(kept)
+            if removed:
+                a_list.clear()
+                a_list.extend(kept)
         else:
-            indices_to_remove = found
-        # Iterating in reverse order to ensure the indices
-        # remain valid during deletion.
-        for index in reversed(indices_to_remove):
-            del a_list[index]
-        if indices_to_remove:
+            # Find the first `count` occurrences from the head (or the tail if
+            # negative), and stop there.
+            length = len(a_list)
+            if count > 0:
+                matches = (i for i, el in enumerate(a_list) if el == value)
+            else:
+                matches = (length - 1 - i for i, el in enumerate(reversed(a_list)) if el == value)
+            # Delete in decreasing order so that the indices remain valid
+            indices = sorted(itertools.islice(matches, abs(count)), reverse=True)
+            for index in indices:
+                del a_list[index]
+            removed = len(indices)
+        if removed:
             key.updated()
-        return len(indices_to_remove)
+        return removed
 
-    @command((Key(list), Int, bytes))
+    @command((Key(List), Int, bytes), flags='w')
     def lset(self, key, index, value):
         if not key:
             raise SimpleError(msgs.NO_KEY_MSG)
@@ -889,37 +1141,38 @@ class FakeSocket(BaseFakeSocket):
             raise SimpleError(msgs.INDEX_ERROR_MSG)
         return OK
 
-    @command((Key(list), Int, Int))
+    @command((Key(List), Int, Int), flags='w')
     def ltrim(self, key, start, stop):
         if key:
             if stop == -1:
                 stop = None
             else:
                 stop += 1
-            new_value = key.value[start:stop]
+            length = len(key.value)
+            start, stop, _ = slice(start, stop).indices(length)
             # TODO: check if this should actually be conditional
-            if len(new_value) != len(key.value):
-                key.update(new_value)
+            if max(stop - start, 0) != length:
+                key.value.trim(start, stop)
+                key.updated()
         return OK
 
-    @command((Key(),), (Int(),))
+    @command((Key(),), (Int(),), flags='w')
     def rpop(self, key, *args):
-        return self._list_pop(lambda count: slice(None, -count - 1, -1), key, *args)
+        return self._list_pop(List.pop, key, *args)
 
-    @command((Key(list, None), Key(list)))
+    @command((Key(List, None), Key(List)), flags='w')
     def rpoplpush(self, src, dst):
         el = self.rpop(src)
         self.lpush(dst, el)
         return el
 
-    @command((Key(list), bytes), (bytes,))
+    @command((Key(List), bytes), (bytes,), flags='w')
     def rpush(self, key, *values):
-        for value in values:
-            key.value.append(value)
+        key.value.extend(values)
         key.updated()
         return len(key.value)
 
-    @command((Key(list), bytes), (bytes,))
+    @command((Key(List), bytes), (bytes,), flags='w')
     def rpushx(self, key, *values):
         if not key:
             return 0
@@ -927,7 +1180,7 @@ class FakeSocket(BaseFakeSocket):
 
     # Set commands
 
-    @command((Key(set), bytes), (bytes,))
+    @command((Key(set), bytes), (bytes,), flags='w')
     def sadd(self, key, *members):
         old_size = len(key.value)
         key.value.update(members)
@@ -942,7 +1195,7 @@ class FakeSocket(BaseFakeSocket):
     def sdiff(self, *keys):
         return self._setop(lambda a, b: a - b, False, None, *keys)
 
-    @command((Key(), Key(set)), (Key(set),))
+    @command((Key(), Key(set)), (Key(set),), flags='w')
     def sdiffstore(self, dst, *keys):
         return self._setop(lambda a, b: a - b, False, dst, *keys)
 
@@ -950,7 +1203,7 @@ class FakeSocket(BaseFakeSocket):
     def sinter(self, *keys):
         return self._setop(lambda a, b: a & b, True, None, *keys)
 
-    @command((Key(), Key(set)), (Key(set),))
+    @command((Key(), Key(set)), (Key(set),), flags='w')
     def sinterstore(self, dst, *keys):
         return self._setop(lambda a, b: a & b, True, dst, *keys)
 
@@ -966,7 +1219,7 @@ class FakeSocket(BaseFakeSocket):
     def smembers(self, key):
         return list(key.value)
 
-    @command((Key(set, 0), Key(set), bytes))
+    @command((Key(set, 0), Key(set), bytes), flags='w')
     def smove(self, src, dst, member):
         try:
             src.value.remove(member)
@@ -978,7 +1231,7 @@ class FakeSocket(BaseFakeSocket):
             dst.updated()  # TODO: is it updated if member was already present?
             return 1
 
-    @command((Key(set),), (Int,))
+    @command((Key(set),), (Int,), flags='w')
     def spop(self, key, count=None):
         if count is None:
             if not key.value:
@@ -1010,7 +1263,7 @@ class FakeSocket(BaseFakeSocket):
             items = list(key.value)
             return [random.choice(items) for _ in range(-count)]
 
-    @command((Key(set), bytes), (bytes,))
+    @command((Key(set), bytes), (bytes,), flags='w')
     def srem(self, key, *members):
         old_size = len(key.value)
         for member in members:
@@ -1028,51 +1281,70 @@ class FakeSocket(BaseFakeSocket):
     def sunion(self, *keys):
         return self._setop(lambda a, b: a | b, False, None, *keys)
 
-    @command((Key(), Key(set)), (Key(set),))
+    @command((Key(), Key(set)), (Key(set),), flags='w')
     def sunionstore(self, dst, *keys):
         return self._setop(lambda a, b: a | b, False, dst, *keys)
 
     # Hyperloglog commands
-    # These are not quite the same as the real redis ones, which are
-    # approximate and store the results in a string. Instead, it is implemented
-    # on top of sets.
+    # These store the HyperLogLog in a string, in the same format as redis
+    # (see _hll).
 
-    @command((Key(set),), (bytes,))
-    def pfadd(self, key, *elements):
-        result = self.sadd(key, *elements)
-        # Per the documentation:
-        # - 1 if at least 1 HyperLogLog internal register was altered. 0 otherwise.
-        return 1 if result > 0 else 0
+    @staticmethod
+    def _hyperloglog(key):
+        """Read the HyperLogLog at `key`, or return None if it does not exist"""
+        return HyperLogLog(key.value) if key else None
 
-    @command((Key(set),), (Key(set),))
+    @command((Key(bytes),), (bytes,), flags='w')
+    def pfadd(self, key, *elements):
+        hll = self._hyperloglog(key)
+        # Creating the key counts as a change, even without elements
+        updated = hll is None
+        if updated:
+            hll = HyperLogLog()
+        for element in elements:
+            if hll.add(element):
+                updated = True
+        if updated:
+            key.update(hll.to_bytes())
+        return 1 if updated else 0
+
+    @command((Key(bytes),), (Key(bytes),), flags='w')
     def pfcount(self, *keys):
         """
         Return the approximated cardinality of
         the set observed by the HyperLogLog at key(s).
         """
-        return len(self.sunion(*keys))
+        if len(keys) == 1:
+            hll = self._hyperloglog(keys[0])
+            if hll is None:
+                return 0
+            result = hll.count()
+            if hll.modified:
+                # Like redis, store the cardinality that was computed
+                keys[0].update(hll.to_bytes())
+            return result
+        registers = bytearray(HLL_REGISTERS)
+        for key in keys:
+            hll = self._hyperloglog(key)
+            if hll is not None:
+                merge_registers(registers, hll.registers())
+        return cardinality(registers_histogram(registers))
 
-    @command((Key(set), Key(set)), (Key(set),))
+    @command((Key(bytes),), (Key(bytes),), flags='w')
     def pfmerge(self, dest, *sources):
         "Merge N different HyperLogLogs into a single one."
-        self.sunionstore(dest, *sources)
+        registers = bytearray(HLL_REGISTERS)
+        dense = False
+        # The destination is merged too if it exists
+        for key in (dest,) + sources:
+            hll = self._hyperloglog(key)
+            if hll is not None:
+                merge_registers(registers, hll.registers())
+                dense = dense or hll.is_dense
+        dest.update(HyperLogLog.from_registers(registers, dense).to_bytes())
         return OK
 
     # Sorted set commands
-    # TODO: [b]zpopmin/zpopmax,
-
-    @staticmethod
-    def _limit_items(items, offset, count):
-        out = []
-        for item in items:
-            if offset:  # Note: not offset > 0, in order to match redis
-                offset -= 1
-                continue
-            if count == 0:
-                break
-            count -= 1
-            out.append(item)
-        return out
 
     def _apply_withscores(self, items, withscores):
         if withscores:
@@ -1084,7 +1356,7 @@ class FakeSocket(BaseFakeSocket):
             out = [item[1] for item in items]
         return out
 
-    @command((Key(ZSet), bytes, bytes), (bytes,))
+    @command((Key(ZSet), bytes, bytes), (bytes,), flags='w')
     def zadd(self, key, *args):
         zset = key.value
         ZADD_PARAMS = ['nx', 'xx', 'ch', 'incr', 'gt', 'lt', ]
@@ -1156,7 +1428,7 @@ class FakeSocket(BaseFakeSocket):
     def zcount(self, key, min, max):
         return key.value.zcount(min.lower_bound, max.upper_bound)
 
-    @command((Key(ZSet), Float, bytes))
+    @command((Key(ZSet), Float, bytes), flags='w')
     def zincrby(self, key, increment, member):
         # Can't just default the old score to 0.0, because in IEEE754, adding
         # 0.0 to something isn't a nop (e.g. 0.0 + -0.0 == 0.0).
@@ -1216,9 +1488,8 @@ class FakeSocket(BaseFakeSocket):
         zset = key.value
         items = zset.irange_lex(_min.value, _max.value,
                                 inclusive=(not _min.exclusive, not _max.exclusive),
-                                reverse=reverse)
-        items = self._limit_items(items, offset, count)
-        return items
+                                reverse=reverse, offset=offset, count=count)
+        return list(items)
 
     @command((Key(ZSet), StringTest, StringTest), (bytes,))
     def zrangebylex(self, key, _min, _max, *args):
@@ -1244,8 +1515,8 @@ class FakeSocket(BaseFakeSocket):
             else:
                 raise SimpleError(msgs.SYNTAX_ERROR_MSG)
         zset = key.value
-        items = list(zset.irange_score(_min.lower_bound, _max.upper_bound, reverse=reverse))
-        items = self._limit_items(items, offset, count)
+        items = zset.irange_score(_min.lower_bound, _max.upper_bound, reverse=reverse,
+                                  offset=offset, count=count)
         items = self._apply_withscores(items, withscores)
         return items
 
@@ -1271,7 +1542,7 @@ class FakeSocket(BaseFakeSocket):
         except KeyError:
             return None
 
-    @command((Key(ZSet), bytes), (bytes,))
+    @command((Key(ZSet), bytes), (bytes,), flags='w')
     def zrem(self, key, *members):
         old_size = len(key.value)
         for member in members:
@@ -1281,31 +1552,141 @@ class FakeSocket(BaseFakeSocket):
             key.updated()
         return deleted
 
-    @command((Key(ZSet), StringTest, StringTest))
+    def _zpop(self, key, reverse, *args):
+        count = 1
+        if len(args) > 1:
+            raise SimpleError(msgs.SYNTAX_ERROR_MSG)
+        elif args:
+            count = Int.decode(args[0])
+            if count < 0:
+                if self.version >= 7:
+                    raise SimpleError(msgs.VALUE_POSITIVE_MSG)
+                return []
+        items = key.value.pop(count, reverse)
+        if items:
+            key.updated()
+        return self._apply_withscores(items, True)
+
+    @command((Key(ZSet),), (bytes,), flags='w')
+    def zpopmin(self, key, *args):
+        return self._zpop(key, False, *args)
+
+    @command((Key(ZSet),), (bytes,), flags='w')
+    def zpopmax(self, key, *args):
+        return self._zpop(key, True, *args)
+
+    def _zmpop_pass(self, keys, reverse, count, first_pass):
+        """Pop up to `count` members from the first of `keys` that is not empty.
+
+        Returns the key and the popped (score, member) pairs, or None if all
+        the keys are empty.
+        """
+        for key in keys:
+            item = CommandItem(key, self._db, item=self._db.get(key), default=ZSet())
+            if not isinstance(item.value, ZSet):
+                if first_pass:
+                    raise SimpleError(msgs.WRONGTYPE_MSG)
+                else:
+                    continue
+            if item.value:
+                items = item.value.pop(count, reverse)
+                item.updated()
+                item.writeback()
+                return key, items
+        return None
+
+    def _bzpop(self, args, reverse):
+        keys = args[:-1]
+        timeout = Timeout.decode(args[-1])
+
+        def pop(first_pass):
+            ret = self._zmpop_pass(keys, reverse, 1, first_pass)
+            if ret is None:
+                return None
+            key, [(score, member)] = ret
+            return [key, member, self._encodefloat(score, False)]
+
+        return self._blocking(timeout, pop, keys)
+
+    @command((bytes, bytes), (bytes,), flags='sw')
+    def bzpopmin(self, *args):
+        return self._bzpop(args, False)
+
+    @command((bytes, bytes), (bytes,), flags='sw')
+    def bzpopmax(self, *args):
+        return self._bzpop(args, True)
+
+    def _zmpop(self, timeout, numkeys, args):
+        """Implements zmpop and bzmpop, which does not block if `timeout` is None."""
+        if numkeys <= 0:
+            raise SimpleError(msgs.NUMKEYS_POSITIVE_MSG)
+        if numkeys >= len(args):
+            raise SimpleError(msgs.SYNTAX_ERROR_MSG)
+        keys = args[:numkeys]
+        if casematch(args[numkeys], b'min'):
+            reverse = False
+        elif casematch(args[numkeys], b'max'):
+            reverse = True
+        else:
+            raise SimpleError(msgs.SYNTAX_ERROR_MSG)
+        count = 1
+        rest = args[numkeys + 1:]
+        if rest:
+            if len(rest) != 2 or not casematch(rest[0], b'count'):
+                raise SimpleError(msgs.SYNTAX_ERROR_MSG)
+            count = Int.decode(rest[1])
+            if count <= 0:
+                raise SimpleError(msgs.COUNT_POSITIVE_MSG)
+
+        def pop(first_pass):
+            ret = self._zmpop_pass(keys, reverse, count, first_pass)
+            if ret is None:
+                return None
+            key, items = ret
+            return [key, [[member, self._encodefloat(score, False)] for score, member in items]]
+
+        if timeout is None:
+            return pop(True)
+        return self._blocking(timeout, pop, keys)
+
+    @command((Int, bytes, bytes), (bytes,), flags='w')
+    def zmpop(self, numkeys, *args):
+        return self._zmpop(None, numkeys, args)
+
+    @command((Timeout, Int, bytes, bytes), (bytes,), flags='sw')
+    def bzmpop(self, timeout, numkeys, *args):
+        return self._zmpop(timeout, numkeys, args)
+
+    @staticmethod
+    def _zremrange(key, deleted):
+        if deleted:
+            key.updated()
+        return deleted
+
+    @command((Key(ZSet), StringTest, StringTest), flags='w')
     def zremrangebylex(self, key, min, max):
-        items = key.value.irange_lex(min.value, max.value,
-                                     inclusive=(not min.exclusive, not max.exclusive))
-        return self.zrem(key, *items)
+        deleted = key.value.remove_range_lex(min.value, max.value,
+                                             inclusive=(not min.exclusive, not max.exclusive))
+        return self._zremrange(key, deleted)
 
-    @command((Key(ZSet), ScoreTest, ScoreTest))
+    @command((Key(ZSet), ScoreTest, ScoreTest), flags='w')
     def zremrangebyscore(self, key, min, max):
-        items = key.value.irange_score(min.lower_bound, max.upper_bound)
-        return self.zrem(key, *[item[1] for item in items])
+        deleted = key.value.remove_range_score(min.lower_bound, max.upper_bound)
+        return self._zremrange(key, deleted)
 
-    @command((Key(ZSet), Int, Int))
+    @command((Key(ZSet), Int, Int), flags='w')
     def zremrangebyrank(self, key, start, stop):
         zset = key.value
         start, stop = self._fix_range(start, stop, len(zset))
-        items = zset.islice_score(start, stop)
-        return self.zrem(key, *[item[1] for item in items])
+        return self._zremrange(key, zset.remove_range(start, stop))
 
     @command((Key(ZSet), Int), (bytes, bytes))
     def zscan(self, key, cursor, *args):
-        new_cursor, ans = self._scan(key.value.items(), cursor, *args)
+        new_cursor, ans = self._scan(key.value, cursor, *args)
         flat = []
-        for (key, score) in ans:
-            flat.append(key)
-            flat.append(self._encodefloat(score, False))
+        for member in ans:
+            flat.append(member)
+            flat.append(self._encodefloat(key.value[member], False))
         return [new_cursor, flat]
 
     @command((Key(ZSet), bytes))
@@ -1318,26 +1699,38 @@ class FakeSocket(BaseFakeSocket):
     @staticmethod
     def _get_zset(value):
         if isinstance(value, set):
-            zset = ZSet()
-            for item in value:
-                zset[item] = 1.0
-            return zset
+            return ZSet.from_dict(dict.fromkeys(value, 1.0))
         elif isinstance(value, ZSet):
             return value
         else:
             raise SimpleError(msgs.WRONGTYPE_MSG)
 
-    def _zunioninter(self, func, dest, numkeys, *args):
+    def _get_zsets(self, func, dest, numkeys, args):
+        """Read the `numkeys` input keys at the start of `args` for ZUNION and friends."""
         if numkeys < 1:
-            raise SimpleError(msgs.ZUNIONSTORE_KEYS_MSG)
+            if dest is not None and func in ('ZUNIONSTORE', 'ZINTERSTORE'):
+                raise SimpleError(msgs.ZUNIONSTORE_KEYS_MSG)
+            raise SimpleError(msgs.ZSETOP_KEYS_MSG.format(func.lower()))
         if numkeys > len(args):
             raise SimpleError(msgs.SYNTAX_ERROR_MSG)
-        aggregate = b'sum'
         sets = []
         for i in range(numkeys):
             item = CommandItem(args[i], self._db, item=self._db.get(args[i]), default=ZSet())
             sets.append(self._get_zset(item.value))
+        return sets
+
+    def _zsetop_result(self, dest, zset, withscores):
+        """Store the result of ZUNION and friends in `dest`, or reply with it if `dest` is None"""
+        if dest is None:
+            return self._apply_withscores(zset.islice_score(0, len(zset)), withscores)
+        dest.value = zset
+        return len(zset)
+
+    def _zunioninter(self, func, dest, numkeys, *args):
+        sets = self._get_zsets(func, dest, numkeys, args)
         weights = [1.0] * numkeys
+        aggregate = b'sum'
+        withscores = False
 
         i = numkeys
         while i < len(args):
@@ -1347,66 +1740,70 @@ class FakeSocket(BaseFakeSocket):
                 i += numkeys + 1
             elif casematch(arg, b'aggregate') and i + 1 < len(args):
                 aggregate = casenorm(args[i + 1])
-                if aggregate not in (b'sum', b'min', b'max'):
+                if aggregate not in AGGREGATES:
                     raise SimpleError(msgs.SYNTAX_ERROR_MSG)
                 i += 2
+            elif casematch(arg, b'withscores') and dest is None:
+                withscores = True
+                i += 1
             else:
                 raise SimpleError(msgs.SYNTAX_ERROR_MSG)
 
-        out_members = set(sets[0])
-        for s in sets[1:]:
-            if func == 'ZUNIONSTORE':
-                out_members |= set(s)
-            else:
-                out_members.intersection_update(s)
-
-        # We first build a regular dict and turn it into a ZSet. The
-        # reason is subtle: a ZSet won't update a score from -0 to +0
-        # (or vice versa) through assignment, but a regular dict will.
-        out = {}
-        # The sort affects the order of floating-point operations.
-        # Note that redis uses qsort(1), which has no stability guarantees,
-        # so we can't be sure to match it in all cases.
-        for s, w in sorted(zip(sets, weights), key=lambda x: len(x[0])):
-            for member, score in s.items():
-                score *= w
-                # Redis only does this step for ZUNIONSTORE. See
-                # https://github.com/antirez/redis/issues/3954.
-                if func == 'ZUNIONSTORE' and math.isnan(score):
-                    score = 0.0
-                if member not in out_members:
-                    continue
-                if member in out:
-                    old = out[member]
-                    if aggregate == b'sum':
-                        score += old
-                        if math.isnan(score):
-                            score = 0.0
-                    elif aggregate == b'max':
-                        score = max(old, score)
-                    elif aggregate == b'min':
-                        score = min(old, score)
-                    else:
-                        assert False  # pragma: nocover
-                if math.isnan(score):
-                    score = 0.0
-                out[member] = score
-
-        out_zset = ZSet()
-        for member, score in out.items():
-            out_zset[member] = score
-
-        dest.value = out_zset
-        return len(out_zset)
+        if func in ('ZUNIONSTORE', 'ZUNION'):
+            out = ZSet.union(sets, weights, AGGREGATES[aggregate])
+        else:
+            out = ZSet.intersection(sets, weights, AGGREGATES[aggregate])
+        return self._zsetop_result(dest, out, withscores)
 
-    @command((Key(), Int, bytes), (bytes,))
+    @command((Key(), Int, bytes), (bytes,), flags='w')
     def zunionstore(self, dest, numkeys, *args):
         return self._zunioninter('ZUNIONSTORE', dest, numkeys, *args)
 
-    @command((Key(), Int, bytes), (bytes,))
+    @command((Key(), Int, bytes), (bytes,), flags='w')
     def zinterstore(self, dest, numkeys, *args):
         return self._zunioninter('ZINTERSTORE', dest, numkeys, *args)
 
+    @command((Int, bytes), (bytes,))
+    def zunion(self, numkeys, *args):
+        return self._zunioninter('ZUNION', None, numkeys, *args)
+
+    @command((Int, bytes), (bytes,))
+    def zinter(self, numkeys, *args):
+        return self._zunioninter('ZINTER', None, numkeys, *args)
+
+    def _zdiff(self, func, dest, numkeys, *args):
+        sets = self._get_zsets(func, dest, numkeys, args)
+        withscores = False
+        for arg in args[numkeys:]:
+            if casematch(arg, b'withscores') and dest is None:
+                withscores = True
+            else:
+                raise SimpleError(msgs.SYNTAX_ERROR_MSG)
+        return self._zsetop_result(dest, ZSet.difference(sets), withscores)
+
+    @command((Int, bytes), (bytes,))
+    def zdiff(self, numkeys, *args):
+        return self._zdiff('ZDIFF', None, numkeys, *args)
+
+    @command((Key(), Int, bytes), (bytes,), flags='w')
+    def zdiffstore(self, dest, numkeys, *args):
+        return self._zdiff('ZDIFFSTORE', dest, numkeys, *args)
+
+    @command((Int, bytes), (bytes,))
+    def zintercard(self, numkeys, *args):
+        sets = self._get_zsets('ZINTERCARD', None, numkeys, args)
+        limit = 0
+        i = numkeys
+        while i < len(args):
+            if casematch(args[i], b'limit') and i + 1 < len(args):
+                limit = Int.decode(args[i + 1])
+                if limit < 0:
+                    raise SimpleError(msgs.LIMIT_NEGATIVE_MSG)
+                i += 2
+            else:
+                raise SimpleError(msgs.SYNTAX_ERROR_MSG)
+        return ZSet.intersection_card(sets, limit)
+
     # Server commands
     # TODO: lots
 
@@ -1421,7 +1818,7 @@ class FakeSocket(BaseFakeSocket):
     def dbsize(self):
         return len(self._db)
 
-    @command((), (bytes,))
+    @command((), (bytes,), flags='w')
     def flushdb(self, *args):
         if args:
             if len(args) != 1 or not casematch(args[0], b'async'):
@@ -1429,7 +1826,7 @@ class FakeSocket(BaseFakeSocket):
         self._db.clear()
         return OK
 
-    @command((), (bytes,))
+    @command((), (bytes,), flags='w')
     def flushall(self, *args):
         if args:
             if len(args) != 1 or not casematch(args[0], b'async'):
@@ -1450,13 +1847,13 @@ class FakeSocket(BaseFakeSocket):
 
     @command(())
     def time(self):
-        now_us = round(time.time() * 1000000)
+        now_us = round(self._server.clock.time * 1000000)
         now_s = now_us // 1000000
         now_us %= 1000000
         return [str(now_s).encode(), str(now_us).encode()]
 
     # Script commands
-    # script debug and script kill will probably not be supported
+    # script debug will probably not be supported
 
     def _convert_redis_arg(self, lua_runtime, value):
         # Type checks are exact to avoid issues like bool being a subclass of int.
@@ -1522,29 +1919,24 @@ class FakeSocket(BaseFakeSocket):
                 if isinstance(s, bytes)
                 else str(s).encode(encoding='utf-8', errors='replace'))
 
-    def _check_for_lua_globals(self, lua_runtime, expected_globals):
-        actual_globals = set(lua_runtime.globals().keys())
-        if actual_globals != expected_globals:
-            unexpected = [self.ensure_str(var, 'utf-8', 'replace')
-                          for var in actual_globals - expected_globals]
-            raise SimpleError(msgs.GLOBAL_VARIABLE_MSG.format(", ".join(unexpected)))
-
-    def _lua_redis_call(self, lua_runtime, expected_globals, op, *args):
-        # Check if we've set any global variables before making any change.
-        self._check_for_lua_globals(lua_runtime, expected_globals)
-        func, func_name = self._name_to_func(op)
-        args = [self._convert_redis_arg(lua_runtime, arg) for arg in args]
-        result = self._run_command(func, func._fakeredis_sig, args, True)
-        return self._convert_redis_result(lua_runtime, result)
-
-    def _lua_redis_pcall(self, lua_runtime, expected_globals, op, *args):
+    def _lua_redis_call(self, runtime, op, *args):
+        func, sig = self._name_to_func(op)
+        if msgs.FLAG_WRITE in sig.flags:
+            if runtime.read_only:
+                raise SimpleError(msgs.WRITE_IN_READ_ONLY_SCRIPT_MSG)
+            # The script can no longer be killed
+            self._server.script_wrote = True
+        args = [self._convert_redis_arg(runtime.lua, arg) for arg in args]
+        result = self._run_command(func, sig, args, True)
+        return self._convert_redis_result(runtime.lua, result)
+
+    def _lua_redis_pcall(self, runtime, op, *args):
         try:
-            return self._lua_redis_call(lua_runtime, expected_globals, op, *args)
+            return self._lua_redis_call(runtime, op, *args)
         except Exception as ex:
-            return lua_runtime.table_from({b"err": str(ex)})
+            return runtime.lua.table_from({b"err": str(ex)})
 
-    def _lua_redis_log(self, lua_runtime, expected_globals, lvl, *args):
-        self._check_for_lua_globals(lua_runtime, expected_globals)
+    def _lua_redis_log(self, runtime, lvl, *args):
         if len(args) < 1:
             raise SimpleError(msgs.REQUIRES_MORE_ARGS_MSG.format("redis.log()", "two"))
         if lvl not in REDIS_LOG_LEVELS.values():
@@ -1554,66 +1946,74 @@ class FakeSocket(BaseFakeSocket):
                         for x in args if not isinstance(x, bool)])
         LOGGER.log(REDIS_LOG_LEVELS_TO_LOGGING[lvl], msg)
 
-    @command((bytes, Int), (bytes,), flags='s')
-    def eval(self, script, numkeys, *keys_and_args):
-        from lupa import LuaError, LuaRuntime, as_attrgetter
+    def _run_script(self, runtime, name, func, read_only=False, is_function=False):
+        """Run a script or function in a Lua runtime, and convert its result.
+
+        `func` is called with the runtime to run the script. While it runs,
+        the server tracks it so that it can be killed (see SCRIPT KILL and
+        FUNCTION KILL).
+        """
+        from lupa import LuaError
 
+        runtime.socket = self
+        runtime.read_only = read_only
+        self._server.start_script(runtime, is_function)
+        try:
+            try:
+                result = func(runtime)
+            except SimpleError as ex:
+                if self.version == 6:
+                    raise SimpleError(msgs.SCRIPT_ERROR_MSG.format(name, ex))
+                raise SimpleError(ex.value)
+            except LuaError as ex:
+                raise SimpleError(msgs.SCRIPT_ERROR_MSG.format(name, ex))
+            return self._convert_lua_result(result, nested=False)
+        finally:
+            self._server.end_script(runtime)
+            runtime.end_script()
+            runtime.socket = None
+            runtime.read_only = False
+
+    def _eval(self, sha1, script, numkeys, keys_and_args, read_only=False):
         if numkeys > len(keys_and_args):
             raise SimpleError(msgs.TOO_MANY_KEYS_MSG)
         if numkeys < 0:
             raise SimpleError(msgs.NEGATIVE_KEYS_MSG)
-        sha1 = hashlib.sha1(script).hexdigest().encode()
-        self._server.script_cache[sha1] = script
-        lua_runtime = LuaRuntime(encoding=None, unpack_returned_tuples=True)
-
-        set_globals = lua_runtime.eval(
-            """
-            function(keys, argv, redis_call, redis_pcall, redis_log, redis_log_levels)
-                redis = {}
-                redis.call = redis_call
-                redis.pcall = redis_pcall
-                redis.log = redis_log
-                for level, pylevel in python.iterex(redis_log_levels.items()) do
-                    redis[level] = pylevel
-                end
-                redis.error_reply = function(msg) return {err=msg} end
-                redis.status_reply = function(msg) return {ok=msg} end
-                KEYS = keys
-                ARGV = argv
-            end
-            """
-        )
-        expected_globals = set()
-        set_globals(
-            lua_runtime.table_from(keys_and_args[:numkeys]),
-            lua_runtime.table_from(keys_and_args[numkeys:]),
-            functools.partial(self._lua_redis_call, lua_runtime, expected_globals),
-            functools.partial(self._lua_redis_pcall, lua_runtime, expected_globals),
-            functools.partial(self._lua_redis_log, lua_runtime, expected_globals),
-            as_attrgetter(REDIS_LOG_LEVELS)
-        )
-        expected_globals.update(lua_runtime.globals().keys())
-
+        runtime = self._server.acquire_lua_runtime()
         try:
-            result = lua_runtime.execute(script)
-        except SimpleError as ex:
-            if self.version == 6:
-                raise SimpleError(msgs.SCRIPT_ERROR_MSG.format(sha1.decode(), ex))
-            raise SimpleError(ex.value)
-        except LuaError as ex:
-            raise SimpleError(msgs.SCRIPT_ERROR_MSG.format(sha1.decode(), ex))
-
-        self._check_for_lua_globals(lua_runtime, expected_globals)
-
-        return self._convert_lua_result(result, nested=False)
-
-    @command((bytes, Int), (bytes,), flags='s')
-    def evalsha(self, sha1, numkeys, *keys_and_args):
+            return self._run_script(
+                runtime, sha1.decode(),
+                lambda rt: rt.run(sha1, script, keys_and_args[:numkeys], keys_and_args[numkeys:]),
+                read_only=read_only)
+        finally:
+            self._server.release_lua_runtime(runtime)
+
+    def _evalsha(self, sha1, numkeys, keys_and_args, read_only=False):
         try:
             script = self._server.script_cache[sha1]
         except KeyError:
             raise SimpleError(msgs.NO_MATCHING_SCRIPT_MSG)
-        return self.eval(script, numkeys, *keys_and_args)
+        return self._eval(sha1, script, numkeys, keys_and_args, read_only)
+
+    @command((bytes, Int), (bytes,), flags='s')
+    def eval(self, script, numkeys, *keys_and_args):
+        sha1 = hashlib.sha1(script).hexdigest().encode()
+        self._server.script_cache[sha1] = script
+        return self._eval(sha1, script, numkeys, keys_and_args)
+
+    @command((bytes, Int), (bytes,), flags='s')
+    def evalsha(self, sha1, numkeys, *keys_and_args):
+        return self._evalsha(sha1, numkeys, keys_and_args)
+
+    @command((bytes, Int), (bytes,), flags='sr')
+    def eval_ro(self, script, numkeys, *keys_and_args):
+        sha1 = hashlib.sha1(script).hexdigest().encode()
+        self._server.script_cache[sha1] = script
+        return self._eval(sha1, script, numkeys, keys_and_args, read_only=True)
+
+    @command((bytes, Int), (bytes,), flags='sr')
+    def evalsha_ro(self, sha1, numkeys, *keys_and_args):
+        return self._evalsha(sha1, numkeys, keys_and_args, read_only=True)
 
     @command((bytes,), (bytes,), flags='s')
     def script(self, subcmd, *args):
@@ -1628,14 +2028,211 @@ class FakeSocket(BaseFakeSocket):
             if self.version >= 7 and len(args) == 0:
                 raise SimpleError(msgs.WRONG_ARGS_MSG.format('script|exists'))
             return [int(sha1 in self._server.script_cache) for sha1 in args]
+        elif casematch(subcmd, b'kill'):
+            # This is only reached while a script is running if it is busy
+            # (see _run_while_busy).
+            if len(args) != 0:
+                raise SimpleError(msgs.BAD_SUBCOMMAND_MSG.format('SCRIPT'))
+            return self._kill_script(False)
         elif casematch(subcmd, b'flush'):
             if len(args) > 1 or (len(args) == 1 and casenorm(args[0]) not in {b'sync', b'async'}):
                 raise SimpleError(msgs.BAD_SUBCOMMAND_MSG.format('SCRIPT'))
             self._server.script_cache = {}
+            # Also drop the scripts compiled by idle runtimes
+            self._server.lua_runtimes = []
             return OK
         else:
             raise SimpleError(msgs.BAD_SUBCOMMAND_MSG.format('SCRIPT'))
 
+    def _kill_script(self, is_function):
+        """Kill the busy script for SCRIPT KILL, or function for FUNCTION KILL."""
+        if self._server.script_started is None:
+            raise SimpleError(msgs.NOTBUSY_MSG)
+        if self._server.script_wrote:
+            raise SimpleError(msgs.UNKILLABLE_MSG)
+        if self._server.script_is_function != is_function:
+            # Like redis, point to the KILL command for what is running
+            raise SimpleError(msgs.FUNCTION_BUSY_MSG if self._server.script_is_function else msgs.BUSY_MSG)
+        self._server.script_kill = True
+        return OK
+
+    # Function commands
+
+    @staticmethod
+    def _library_name(code):
+        """Parse the name of a library from the metadata in its first line"""
+        first_line = code.split(b'\n', 1)[0]
+        if not first_line.startswith(b'#!'):
+            raise SimpleError(msgs.MISSING_LIBRARY_METADATA_MSG)
+        parts = first_line[2:].split()
+        engine = parts[0] if parts else b''
+        if casenorm(engine) != b'lua':
+            raise SimpleError(msgs.ENGINE_NOT_FOUND_MSG.format(engine.decode('utf-8', 'replace')))
+        name = None
+        for part in parts[1:]:
+            key, sep, value = part.partition(b'=')
+            if not sep or key != b'name':
+                raise SimpleError(msgs.INVALID_LIBRARY_METADATA_MSG.format(part.decode('utf-8', 'replace')))
+            name = value
+        if name is None:
+            raise SimpleError(msgs.LIBRARY_NAME_MISSING_MSG)
+        if not _valid_name(name):
+            raise SimpleError(msgs.INVALID_LIBRARY_NAME_MSG)
+        return name
+
+    def _load_library(self, code, replace):
+        from lupa import LuaError
+
+        server = self._server
+        name = self._library_name(code)
+        if name in server.libraries and not replace:
+            raise SimpleError(msgs.LIBRARY_EXISTS_MSG.format(name.decode()))
+        runtime = server.get_functions_runtime()
+        # Drop the metadata line, keeping line numbers in errors right
+        body = b'\n' + code.split(b'\n', 1)[1] if b'\n' in code else b''
+        runtime.socket = self
+        try:
+            functions = runtime.load_library(body)
+        except LuaError as ex:
+            msg = ex.args[0] if ex.args else ''
+            if isinstance(msg, bytes):
+                msg = msg.decode('utf-8', 'replace')
+            # Leave out the Lua traceback
+            raise SimpleError(msgs.FUNCTION_LOAD_ERROR_MSG.format(msg.split('\n', 1)[0]))
+        finally:
+            runtime.socket = None
+        if not functions:
+            raise SimpleError(msgs.NO_FUNCTIONS_REGISTERED_MSG)
+        for function_name in functions:
+            existing = server.lua_functions.get(function_name)
+            if existing is not None and existing.library.name != name:
+                raise SimpleError(msgs.FUNCTION_EXISTS_MSG.format(function_name.decode()))
+        if name in server.libraries:
+            self._delete_library(name)
+        server.libraries[name] = LuaLibrary(name, code, functions)
+        server.lua_functions.update(functions)
+        return name
+
+    def _delete_library(self, name):
+        library = self._server.libraries.pop(name)
+        for function_name in library.functions:
+            del self._server.lua_functions[function_name]
+
+    def _flush_libraries(self):
+        self._server.libraries = {}
+        self._server.lua_functions = {}
+        # Functions are only referenced from their runtime, so start afresh
+        self._server.functions_runtime = None
+
+    def _function_list(self, args):
+        with_code = False
+        pattern = None
+        i = 0
+        while i < len(args):
+            if casematch(args[i], b'withcode') and not with_code:
+                with_code = True
+            elif casematch(args[i], b'libraryname') and pattern is None and i + 1 < len(args):
+                pattern = compile_pattern(args[i + 1])
+                i += 1
+            else:
+                raise SimpleError(msgs.SYNTAX_ERROR_MSG)
+            i += 1
+        result = []
+        for library in self._server.libraries.values():
+            if pattern is not None and not pattern.match(library.name):
+                continue
+            functions = [
+                [b'name', function.name, b'description', function.description, b'flags', function.flags]
+                for function in library.functions.values()
+            ]
+            item = [b'library_name', library.name, b'engine', b'LUA', b'functions', functions]
+            if with_code:
+                item.extend([b'library_code', library.code])
+            result.append(item)
+        return result
+
+    def _function_restore(self, payload, policy):
+        if len(payload) < 20 or hashlib.sha1(payload[20:]).digest() != payload[:20]:
+            raise SimpleError(msgs.RESTORE_INVALID_CHECKSUM_MSG)
+        codes = pickle.loads(payload[20:])
+        if casematch(policy, b'flush'):
+            self._flush_libraries()
+        elif casematch(policy, b'append'):
+            # Fail before loading anything, like redis
+            for code in codes:
+                name = self._library_name(code)
+                if name in self._server.libraries:
+                    raise SimpleError(msgs.LIBRARY_EXISTS_MSG.format(name.decode()))
+        elif not casematch(policy, b'replace'):
+            raise SimpleError(msgs.SYNTAX_ERROR_MSG)
+        for code in codes:
+            self._load_library(code, True)
+        return OK
+
+    @command((bytes,), (bytes,), flags='s')
+    def function(self, subcmd, *args):
+        if casematch(subcmd, b'load'):
+            if len(args) == 2 and casematch(args[0], b'replace'):
+                return self._load_library(args[1], True)
+            elif len(args) == 1:
+                return self._load_library(args[0], False)
+            raise SimpleError(msgs.WRONG_ARGS_MSG.format('function|load'))
+        elif casematch(subcmd, b'list'):
+            return self._function_list(args)
+        elif casematch(subcmd, b'delete'):
+            if len(args) != 1:
+                raise SimpleError(msgs.WRONG_ARGS_MSG.format('function|delete'))
+            if args[0] not in self._server.libraries:
+                raise SimpleError(msgs.LIBRARY_NOT_FOUND_MSG)
+            self._delete_library(args[0])
+            return OK
+        elif casematch(subcmd, b'flush'):
+            if len(args) > 1 or (len(args) == 1 and casenorm(args[0]) not in {b'sync', b'async'}):
+                raise SimpleError(msgs.SYNTAX_ERROR_MSG)
+            self._flush_libraries()
+            return OK
+        elif casematch(subcmd, b'dump'):
+            if len(args) != 0:
+                raise SimpleError(msgs.WRONG_ARGS_MSG.format('function|dump'))
+            data = pickle.dumps([library.code for library in self._server.libraries.values()])
+            return hashlib.sha1(data).digest() + data
+        elif casematch(subcmd, b'restore'):
+            if len(args) not in {1, 2}:
+                raise SimpleError(msgs.WRONG_ARGS_MSG.format('function|restore'))
+            return self._function_restore(args[0], args[1] if len(args) == 2 else b'append')
+        elif casematch(subcmd, b'kill'):
+            # Like SCRIPT KILL, this is only reached while a function is busy
+            if len(args) != 0:
+                raise SimpleError(msgs.WRONG_ARGS_MSG.format('function|kill'))
+            return self._kill_script(True)
+        else:
+            raise SimpleError(msgs.BAD_SUBCOMMAND_MSG.format('FUNCTION'))
+
+    def _fcall(self, name, numkeys, keys_and_args, read_only):
+        function = self._server.lua_functions.get(name)
+        if function is None:
+            raise SimpleError(msgs.FUNCTION_NOT_FOUND_MSG)
+        if numkeys > len(keys_and_args):
+            raise SimpleError(msgs.TOO_MANY_KEYS_MSG)
+        if numkeys < 0:
+            raise SimpleError(msgs.NEGATIVE_KEYS_MSG)
+        no_writes = b'no-writes' in function.flags
+        if read_only and not no_writes:
+            raise SimpleError(msgs.FUNCTION_WRITE_FLAG_RO_MSG)
+        runtime = self._server.get_functions_runtime()
+        return self._run_script(
+            runtime, name.decode(),
+            lambda rt: rt.call(function, keys_and_args[:numkeys], keys_and_args[numkeys:]),
+            read_only=no_writes, is_function=True)
+
+    @command((bytes, Int), (bytes,), flags='s')
+    def fcall(self, name, numkeys, *keys_and_args):
+        return self._fcall(name, numkeys, keys_and_args, False)
+
+    @command((bytes, Int), (bytes,), flags='s')
+    def fcall_ro(self, name, numkeys, *keys_and_args):
+        return self._fcall(name, numkeys, keys_and_args, True)
+
     @command((bytes,), (bytes,), flags='s')
     def psubscribe(self, *patterns):
         return self._subscribe(patterns, self._server.psubscribers, b'psubscribe')
@@ -1660,13 +2257,11 @@ class FakeSocket(BaseFakeSocket):
         for sock in subs:
             sock.put_response(msg)
             receivers += 1
-        for (pattern, socks) in self._server.psubscribers.items():
-            regex = compile_pattern(pattern)
-            if regex.match(channel):
-                msg = [b'pmessage', pattern, channel, message]
-                for sock in socks:
-                    sock.put_response(msg)
-                    receivers += 1
+        for (pattern, socks) in self._server.psubscribers.matching(channel):
+            msg = [b'pmessage', pattern, channel, message]
+            for sock in socks:
+                sock.put_response(msg)
+                receivers += 1
         return receivers
 
     def _encodefloat(self, value, humanfriendly):
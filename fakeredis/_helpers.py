@@ -1,3 +1,4 @@
+import functools
 import logging
 import re
 import threading
@@ -6,6 +7,8 @@ import weakref
 from collections import defaultdict
 from collections.abc import MutableMapping
 
+import sortedcontainers
+
 LOGGER = logging.getLogger('fakeredis')
 REDIS_LOG_LEVELS = {
     b'LOG_DEBUG': 0,
@@ -68,7 +71,39 @@ def casematch(a, b):
     return casenorm(a) == casenorm(b)
 
 
+class _SimpleMatcher:
+    """Matches a glob pattern simple enough not to need a regex.
+
+    It has the same `match` method as a compiled regex, but returns a bool.
+    """
+    __slots__ = ['match']
+
+    def __init__(self, match):
+        self.match = match
+
+
+@functools.lru_cache(maxsize=1024)
 def compile_pattern(pattern):
+    """Compile a glob pattern (e.g. for keys) to an object with a `match` method.
+
+    Compiled patterns are cached, since the same ones are used over and over by
+    KEYS, SCAN and pattern subscriptions. Literal patterns and ones of the form
+    ``prefix*`` or ``*suffix`` are matched with string comparisons; the others
+    are translated to a bytes regex.
+    """
+    prefix, rest = split_glob_prefix(pattern)
+    if not rest:
+        return _SimpleMatcher(lambda s: s == prefix)
+    if rest == b'*':
+        return _SimpleMatcher(lambda s: s.startswith(prefix))
+    if not prefix and rest[:1] == b'*':
+        suffix, rest = split_glob_prefix(rest[1:])
+        if not rest:
+            return _SimpleMatcher(lambda s: s.endswith(suffix))
+    return _compile_pattern_regex(pattern)
+
+
+def _compile_pattern_regex(pattern):
     """Compile a glob pattern (e.g. for keys) to a bytes regex.
 
     fnmatch.fnmatchcase doesn't work for this, because it uses different
@@ -135,24 +170,206 @@ def compile_pattern(pattern):
     return re.compile(regex, re.S)
 
 
+def split_glob_prefix(pattern):
+    """Split a glob pattern into its literal prefix and the rest of it.
+
+    Keys matching `pattern` are those that start with the prefix, and whose
+    remainder matches the rest of the pattern.
+    """
+    prefix = bytearray()
+    i = 0
+    pattern_len = len(pattern)
+    while i < pattern_len:
+        c = pattern[i:i + 1]
+        if c in (b'*', b'?', b'['):
+            break
+        if c == b'\\' and i + 1 < pattern_len:
+            i += 1
+            c = pattern[i:i + 1]
+        prefix += c
+        i += 1
+    return bytes(prefix), pattern[i:]
+
+
+class PatternSubscribers(defaultdict):
+    """Maps patterns to the weak sets of sockets subscribed to them.
+
+    The patterns are also indexed by their literal prefix (see
+    `split_glob_prefix`), so that finding the patterns matching a channel only
+    has to try those whose prefix the channel starts with.
+    """
+
+    def __init__(self):
+        super().__init__(weakref.WeakSet)
+        # Maps literal prefix to its patterns (a dict used as an ordered set)
+        self._by_prefix = {}
+        # Maps prefix length to the number of prefixes of that length
+        self._prefix_lengths = {}
+
+    def __setitem__(self, pattern, subs):
+        if pattern not in self:
+            prefix = split_glob_prefix(pattern)[0]
+            patterns = self._by_prefix.get(prefix)
+            if patterns is None:
+                patterns = self._by_prefix[prefix] = {}
+                self._prefix_lengths[len(prefix)] = self._prefix_lengths.get(len(prefix), 0) + 1
+            patterns[pattern] = None
+        super().__setitem__(pattern, subs)
+
+    def __delitem__(self, pattern):
+        super().__delitem__(pattern)
+        prefix = split_glob_prefix(pattern)[0]
+        patterns = self._by_prefix[prefix]
+        del patterns[pattern]
+        if not patterns:
+            del self._by_prefix[prefix]
+            self._prefix_lengths[len(prefix)] -= 1
+            if not self._prefix_lengths[len(prefix)]:
+                del self._prefix_lengths[len(prefix)]
+
+    def matching(self, channel):
+        """Return the (pattern, sockets) pairs for the patterns matching `channel`"""
+        result = []
+        for length in self._prefix_lengths:
+            if length > len(channel):
+                continue
+            for pattern in self._by_prefix.get(channel[:length], ()):
+                if compile_pattern(pattern).match(channel):
+                    result.append((pattern, self[pattern]))
+        return result
+
+
+class RWLock:
+    """A lock held either by one thread, or shared by several readers.
+
+    `acquire` and `release` take the lock exclusively, like `threading.Lock`,
+    so it can be used in its place (including with `threading.Condition`).
+    Readers use `acquire_shared` and `release_shared`. Threads waiting for the
+    exclusive lock have priority over new readers, so they are not starved.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def _wait(self, predicate, blocking, timeout):
+        if predicate():
+            return True
+        if not blocking:
+            return False
+        return self._cond.wait_for(predicate, None if timeout < 0 else timeout)
+
+    def acquire(self, blocking=True, timeout=-1):
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                acquired = self._wait(lambda: not self._writer and not self._readers, blocking, timeout)
+            finally:
+                self._writers_waiting -= 1
+            if acquired:
+                self._writer = True
+            elif not self._writers_waiting:
+                # Readers held back for this thread may go ahead
+                self._cond.notify_all()
+            return acquired
+
+    def release(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    def acquire_shared(self, blocking=True, timeout=-1):
+        with self._cond:
+            if not self._wait(lambda: not self._writer and not self._writers_waiting, blocking, timeout):
+                return False
+            self._readers += 1
+            return True
+
+    def release_shared(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class Clock:
+    """The time as seen by the commands of a server.
+
+    It is read once at the start of each command (see `update`), and
+    commands executed as part of it (from a transaction or a script) see the
+    same time. Override `now` to provide a virtual clock.
+    """
+
+    def __init__(self):
+        self.time = 0.0
+
+    def now(self):
+        return time.time()
+
+    def update(self):
+        self.time = self.now()
+        return self.time
+
+
 class Database(MutableMapping):
-    def __init__(self, lock, *args, **kwargs):
+    def __init__(self, lock, *args, clock=None, ready_dbs=None, **kwargs):
+        # Guards the deletion of expired keys, which readers sharing the server
+        # lock may do concurrently (see RWLock).
+        self._lock = lock
         self._dict = dict(*args, **kwargs)
-        self.time = 0.0
+        self._clock = clock if clock is not None else Clock()
+        # Deadlines of the keys with an expiry, and the same ordered by deadline
+        # so that expired keys are found without scanning the whole keyspace.
+        self._expires = {}
+        self._expiry_index = sortedcontainers.SortedList()
+        for key, item in self._dict.items():
+            self._set_expiry(key, item.expireat)
+        # Keys in order, to find those with a given prefix. It is only built
+        # when first needed, since it makes adding and deleting keys slower.
+        self._key_index = None
         self._watches = defaultdict(weakref.WeakSet)  # key to set of connections
-        self.condition = threading.Condition(lock)
-        self._change_callbacks = set()
+        # Maps key to the clients blocked on it, in the order they blocked. The
+        # inner dicts are used as ordered sets.
+        self._waiters = {}
+        # Keys with waiters that have been written since they were last served
+        self._ready_keys = {}
+        # Shared with the other databases of the server, to find the databases
+        # with ready keys after a command.
+        self._ready_dbs = ready_dbs
+
+    @property
+    def time(self):
+        return self._clock.time
 
     def swap(self, other):
         self._dict, other._dict = other._dict, self._dict
-        self.time, other.time = other.time, self.time
+        self._expires, other._expires = other._expires, self._expires
+        self._expiry_index, other._expiry_index = other._expiry_index, self._expiry_index
+        self._key_index, other._key_index = other._key_index, self._key_index
+        # Clients stay blocked on the database index, so they may be served
+        # by the keys that have just been swapped in.
+        for db in (self, other):
+            for key in db._waiters:
+                db._mark_ready(key)
+
+    def _mark_ready(self, key):
+        if not self._ready_keys and self._ready_dbs is not None:
+            self._ready_dbs.append(self)
+        self._ready_keys[key] = None
 
     def notify_watch(self, key):
         for sock in self._watches.get(key, set()):
             sock.notify_watch()
-        self.condition.notify_all()
-        for callback in self._change_callbacks:
-            callback()
+        if key in self._waiters:
+            self._mark_ready(key)
 
     def add_watch(self, key, sock):
         self._watches[key].add(sock)
@@ -163,45 +380,121 @@ class Database(MutableMapping):
         if not watches:
             del self._watches[key]
 
-    def add_change_callback(self, callback):
-        self._change_callbacks.add(callback)
-
-    def remove_change_callback(self, callback):
-        self._change_callbacks.remove(callback)
+    def add_waiter(self, keys, waiter):
+        """Register a client blocked on `keys`.
+
+        `waiter` is called without arguments when one of the keys has been
+        written, and returns True if it was served. It must then remove itself
+        with `remove_waiter`.
+        """
+        for key in keys:
+            self._waiters.setdefault(key, {})[waiter] = None
+
+    def remove_waiter(self, keys, waiter):
+        for key in keys:
+            waiters = self._waiters.get(key)
+            if waiters is not None:
+                waiters.pop(waiter, None)
+                if not waiters:
+                    del self._waiters[key]
+
+    def serve_waiters(self):
+        """Serve the clients blocked on keys that have been written.
+
+        The clients blocked on a key are served in the order they blocked,
+        until one of them empties it.
+        """
+        while self._ready_keys:
+            key = next(iter(self._ready_keys))
+            del self._ready_keys[key]
+            for waiter in list(self._waiters.get(key, ())):
+                if key not in self:
+                    break
+                waiter()
 
     def clear(self):
         for key in self:
             self.notify_watch(key)
         self._dict.clear()
+        self._expires.clear()
+        self._expiry_index.clear()
+        self._key_index = None
 
     def expired(self, item):
         return item.expireat is not None and item.expireat < self.time
 
-    def _remove_expired(self):
-        for key in list(self._dict):
-            item = self._dict[key]
-            if self.expired(item):
-                del self._dict[key]
+    def _set_expiry(self, key, expireat):
+        old = self._expires.pop(key, None)
+        if old is not None:
+            self._expiry_index.remove((old, key))
+        if expireat is not None:
+            self._expires[key] = expireat
+            self._expiry_index.add((expireat, key))
+
+    def remove_expired(self, limit=None):
+        """Delete the keys that have expired, soonest deadline first.
+
+        At most `limit` keys are deleted if it is given. Returns the number of
+        keys deleted.
+        """
+        with self._lock:
+            return self._remove_expired(limit)
+
+    def _remove_expired(self, limit=None):
+        now = self.time
+        index = self._expiry_index
+        removed = 0
+        while index and index[0][0] < now and (limit is None or removed < limit):
+            _, key = index.pop(0)
+            del self._expires[key]
+            del self._dict[key]
+            if self._key_index is not None:
+                self._key_index.remove(key)
+            removed += 1
+        return removed
+
+    def keys_with_prefix(self, prefix):
+        """Return the keys that start with `prefix`, in order."""
+        with self._lock:
+            self._remove_expired()
+            if self._key_index is None:
+                self._key_index = sortedcontainers.SortedList(self._dict)
+            keys = []
+            for key in self._key_index.irange(minimum=prefix):
+                if not key.startswith(prefix):
+                    break
+                keys.append(key)
+            return keys
 
     def __getitem__(self, key):
         item = self._dict[key]
         if self.expired(item):
-            del self._dict[key]
+            with self._lock:
+                if self._dict.get(key) is item:
+                    del self[key]
             raise KeyError(key)
         return item
 
     def __setitem__(self, key, value):
+        if self._key_index is not None and key not in self._dict:
+            self._key_index.add(key)
         self._dict[key] = value
+        self._set_expiry(key, value.expireat)
 
     def __delitem__(self, key):
         del self._dict[key]
+        self._set_expiry(key, None)
+        if self._key_index is not None:
+            self._key_index.remove(key)
 
     def __iter__(self):
-        self._remove_expired()
-        return iter(self._dict)
+        with self._lock:
+            self._remove_expired()
+            # A copy, since other readers may delete expired keys meanwhile
+            return iter(list(self._dict))
 
     def __len__(self):
-        self._remove_expired()
+        self.remove_expired()
         return len(self._dict)
 
     def __hash__(self):
@@ -211,6 +504,21 @@ class Database(MutableMapping):
         return super(object, self) == other
 
 
+def pack_fields(encoder, args):
+    """Encode the arguments of a command into the fields that a fake socket
+    processes, without going through the redis protocol.
+
+    This mirrors ``Connection.pack_command`` in redis-py: the command name may
+    include literal arguments (e.g. 'CONFIG GET'), which are split off.
+    """
+    if isinstance(args[0], str):
+        args = tuple(args[0].encode().split()) + args[1:]
+    elif b' ' in args[0]:
+        args = tuple(args[0].split()) + args[1:]
+    return [bytes(arg) if isinstance(arg, memoryview) else arg
+            for arg in map(encoder.encode, args)]
+
+
 def valid_response_type(value, nested=False):
     if isinstance(value, NoResponse) and not nested:
         return True
@@ -245,21 +553,16 @@ except ImportError:
 
 class FakeSelector(BaseSelector):
     def check_can_read(self, timeout):
-        if self.sock.responses.qsize():
+        responses = self.sock.responses
+        if responses.qsize():
             return True
         if timeout is not None and timeout <= 0:
             return False
-
-        # A sleep/poll loop is easier to mock out than messing with condition
-        # variables.
-        start = time.time()
-        while True:
-            if self.sock.responses.qsize():
-                return True
-            time.sleep(0.01)
-            now = time.time()
-            if timeout is not None and now > start + timeout:
-                return False
+        # Every put on the queue notifies not_empty, so wait on it to be woken
+        # as soon as a response arrives. The queue's mutex is held while
+        # waiting, hence checking the underlying deque rather than qsize().
+        with responses.not_empty:
+            return responses.not_empty.wait_for(lambda: len(responses.queue) > 0, timeout)
 
     def check_is_ready_for_command(self, timeout):
         return True
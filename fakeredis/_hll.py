@@ -0,0 +1,360 @@
+"""HyperLogLogs in the string representation used by redis.
+
+The layout, hash function and estimator follow hyperloglog.c in redis, so
+that the strings stored by PFADD and PFMERGE and the counts returned by
+PFCOUNT match those of a real server. A string starts with a 16 byte header
+(the "HYLL" magic, the encoding, three unused bytes and the cached cardinality,
+little endian, whose most significant bit is set when it is out of date),
+followed by the 2**14 registers of 6 bits each, in one of two encodings:
+
+- dense: the registers packed into 12288 bytes, least significant bits first.
+- sparse: a run length encoding of the registers with three opcodes, ZERO
+  (00xxxxxx, 1 to 64 zero registers), XZERO (01xxxxxx yyyyyyyy, 1 to 16384
+  zero registers) and VAL (1vvvvvxx, 1 to 4 registers of value 1 to 32).
+
+New HyperLogLogs are sparse, and switch to the dense encoding once a register
+can no longer be represented, or the string would exceed
+HLL_SPARSE_MAX_BYTES.
+"""
+import math
+import struct
+from itertools import groupby
+
+from . import _msgs as msgs
+from ._helpers import SimpleError
+
+HLL_P = 14  # Bits of the hash used to select the register
+HLL_Q = 64 - HLL_P
+HLL_REGISTERS = 1 << HLL_P
+HLL_P_MASK = HLL_REGISTERS - 1
+HLL_BITS = 6
+HLL_REGISTER_MAX = (1 << HLL_BITS) - 1
+HLL_HDR_SIZE = 16
+HLL_DENSE_SIZE = HLL_HDR_SIZE + (HLL_REGISTERS * HLL_BITS + 7) // 8
+HLL_DENSE = 0
+HLL_SPARSE = 1
+HLL_SPARSE_VAL_MAX_VALUE = 32
+HLL_SPARSE_VAL_MAX_LEN = 4
+HLL_SPARSE_ZERO_MAX_LEN = 64
+HLL_SPARSE_MAX_BYTES = 3000  # The default of hll-sparse-max-bytes
+HLL_ALPHA_INF = 0.721347520444481703680
+HLL_MAGIC = b'HYLL'
+
+_MURMUR_SEED = 0xadc83b19
+_MURMUR_M = 0xc6a4a7935bd1e995
+_UINT64_MASK = (1 << 64) - 1
+_CARD_INVALID = 0x80
+
+
+def murmurhash64a(key, seed=_MURMUR_SEED):
+    """MurmurHash2, 64-bit version, reading blocks as little endian like redis"""
+    m = _MURMUR_M
+    h = (seed ^ (len(key) * m)) & _UINT64_MASK
+    end = len(key) - len(key) % 8
+    for (k,) in struct.iter_unpack('<Q', key[:end]):
+        k = (k * m) & _UINT64_MASK
+        k ^= k >> 47
+        k = (k * m) & _UINT64_MASK
+        h ^= k
+        h = (h * m) & _UINT64_MASK
+    if end < len(key):
+        h ^= int.from_bytes(key[end:], 'little')
+        h = (h * m) & _UINT64_MASK
+    h ^= h >> 47
+    h = (h * m) & _UINT64_MASK
+    h ^= h >> 47
+    return h
+
+
+def _pattern_length(element):
+    """Return the register of an element, and the value it sets it to.
+
+    The value is the length of the run of zero bits, plus one, in the bits of
+    the hash that are not used to select the register.
+    """
+    h = murmurhash64a(element)
+    index = h & HLL_P_MASK
+    h = (h >> HLL_P) | (1 << HLL_Q)  # Makes the value at most HLL_Q + 1
+    return index, (h & -h).bit_length()
+
+
+def _sigma(x):
+    if x == 1.0:
+        return math.inf
+    y = 1.0
+    z = x
+    while True:
+        x *= x
+        z_prime = z
+        z += x * y
+        y += y
+        if z_prime == z:
+            return z
+
+
+def _tau(x):
+    if x == 0.0 or x == 1.0:
+        return 0.0
+    y = 1.0
+    z = 1 - x
+    while True:
+        x = math.sqrt(x)
+        z_prime = z
+        y *= 0.5
+        z -= (1 - x) ** 2 * y
+        if z_prime == z:
+            return z / 3
+
+
+def cardinality(histogram):
+    """Estimate the cardinality from the number of registers with each value.
+
+    This is the estimator of Otmar Ertl, as used by redis.
+    """
+    m = HLL_REGISTERS
+    z = m * _tau((m - histogram[HLL_Q + 1]) / m)
+    for j in range(HLL_Q, 0, -1):
+        z += histogram[j]
+        z *= 0.5
+    z += m * _sigma(histogram[0] / m)
+    return int(math.floor(HLL_ALPHA_INF * m * m / z + 0.5))
+
+
+def registers_histogram(registers):
+    return [registers.count(value) for value in range(HLL_Q + 2)]
+
+
+def merge_registers(registers, other):
+    """Set each of `registers` to the maximum of itself and `other`"""
+    registers[:] = map(max, registers, other)
+
+
+def _invalid():
+    return SimpleError(msgs.INVALID_HYPERLOGLOG_MSG)
+
+
+def _corrupted():
+    return SimpleError(msgs.CORRUPTED_HYPERLOGLOG_MSG)
+
+
+def _dense_registers(data):
+    registers = bytearray()
+    it = iter(data[HLL_HDR_SIZE:])
+    # Every 3 bytes hold 4 registers
+    for b0, b1, b2 in zip(it, it, it):
+        registers += bytes((
+            b0 & 63, (b0 >> 6 | b1 << 2) & 63, (b1 >> 4 | b2 << 4) & 63, b2 >> 2))
+    return registers
+
+
+def _dense_from_registers(registers):
+    data = bytearray()
+    it = iter(registers)
+    for r0, r1, r2, r3 in zip(it, it, it, it):
+        data += bytes((r0 | (r1 << 6) & 0xff, r1 >> 2 | (r2 << 4) & 0xff, r2 >> 4 | r3 << 2))
+    return data
+
+
+def _sparse_opcodes(data):
+    """Iterate over the opcodes of a sparse HyperLogLog.
+
+    Yields the position and size of each opcode, and the value and number of
+    the registers it stands for.
+    """
+    i = HLL_HDR_SIZE
+    end = len(data)
+    while i < end:
+        op = data[i]
+        if op & 0xc0 == 0:  # ZERO
+            yield i, 1, 0, (op & 0x3f) + 1
+            i += 1
+        elif op & 0xc0 == 0x40:  # XZERO
+            if i + 1 >= end:
+                raise _corrupted()
+            yield i, 2, 0, ((op & 0x3f) << 8 | data[i + 1]) + 1
+            i += 2
+        else:  # VAL
+            yield i, 1, ((op >> 2) & 0x1f) + 1, (op & 0x3) + 1
+            i += 1
+
+
+def _sparse_run(value, length):
+    """Encode registers with the same value, in as few opcodes as possible"""
+    if value == 0:
+        # Zero runs never exceed HLL_REGISTERS, the limit of XZERO
+        if length > HLL_SPARSE_ZERO_MAX_LEN:
+            return bytes((0x40 | (length - 1) >> 8, (length - 1) & 0xff))
+        return bytes((length - 1,))
+    data = bytearray()
+    while length:
+        n = min(length, HLL_SPARSE_VAL_MAX_LEN)
+        data.append(0x80 | (value - 1) << 2 | (n - 1))
+        length -= n
+    return data
+
+
+def _sparse_from_registers(registers):
+    data = bytearray()
+    for value, group in groupby(registers):
+        data += _sparse_run(value, sum(1 for _ in group))
+    return data
+
+
+class HyperLogLog:
+    """A HyperLogLog in a redis string, which is updated in place.
+
+    Like redis, registers are set in the sparse encoding by rewriting the
+    opcode that covers them, and merging it with its neighbours if possible.
+    """
+
+    def __init__(self, data=None):
+        if data is None:
+            # An empty sparse HyperLogLog, whose cached cardinality is 0
+            data = HLL_MAGIC + bytes((HLL_SPARSE,)) + bytes(HLL_HDR_SIZE - 5) + _sparse_run(0, HLL_REGISTERS)
+        elif (len(data) < HLL_HDR_SIZE or data[:4] != HLL_MAGIC or data[4] not in (HLL_DENSE, HLL_SPARSE)
+              or (data[4] == HLL_DENSE and len(data) != HLL_DENSE_SIZE)):
+            raise _invalid()
+        self._data = bytearray(data)
+        # Whether the string has changed, either its registers or its cache
+        self.modified = False
+
+    @classmethod
+    def from_registers(cls, registers, dense=False):
+        hll = cls()
+        body = None
+        if not dense and max(registers) <= HLL_SPARSE_VAL_MAX_VALUE:
+            body = _sparse_from_registers(registers)
+            if HLL_HDR_SIZE + len(body) > HLL_SPARSE_MAX_BYTES:
+                body = None
+        if body is None:
+            hll._data[4] = HLL_DENSE
+            body = _dense_from_registers(registers)
+        hll._data[HLL_HDR_SIZE:] = body
+        hll._invalidate_cache()
+        return hll
+
+    @property
+    def is_dense(self):
+        return self._data[4] == HLL_DENSE
+
+    def _invalidate_cache(self):
+        self._data[15] |= _CARD_INVALID
+        self.modified = True
+
+    def _promote(self):
+        """Switch to the dense encoding"""
+        registers = self.registers()
+        self._data[4] = HLL_DENSE
+        self._data[HLL_HDR_SIZE:] = _dense_from_registers(registers)
+
+    def registers(self):
+        """Return the registers, as a bytearray with one byte per register"""
+        if self.is_dense:
+            return _dense_registers(self._data)
+        registers = bytearray()
+        for _, _, value, length in _sparse_opcodes(self._data):
+            registers += bytes((value,)) * length
+        if len(registers) != HLL_REGISTERS:
+            raise _corrupted()
+        return registers
+
+    def add(self, element):
+        """Add an element, returning whether a register was changed"""
+        index, count = _pattern_length(element)
+        if self.is_dense:
+            changed = self._dense_set(index, count)
+        else:
+            changed = self._sparse_set(index, count)
+        if changed:
+            self._invalidate_cache()
+        return changed
+
+    def _dense_set(self, index, count):
+        data = self._data
+        byte = HLL_HDR_SIZE + index * HLL_BITS // 8
+        fb = index * HLL_BITS & 7
+        if fb > 8 - HLL_BITS:
+            old = (data[byte] >> fb | data[byte + 1] << (8 - fb)) & HLL_REGISTER_MAX
+        else:
+            old = (data[byte] >> fb) & HLL_REGISTER_MAX
+        if count <= old:
+            return False
+        data[byte] = data[byte] & ~(HLL_REGISTER_MAX << fb) & 0xff | (count << fb) & 0xff
+        if fb > 8 - HLL_BITS:
+            data[byte + 1] = data[byte + 1] & ~(HLL_REGISTER_MAX >> (8 - fb)) | count >> (8 - fb)
+        return True
+
+    def _sparse_set(self, index, count):
+        if count > HLL_SPARSE_VAL_MAX_VALUE:
+            self._promote()
+            return self._dense_set(index, count)
+        data = self._data
+        first = 0
+        prev = None
+        for pos, size, value, length in _sparse_opcodes(data):
+            if index < first + length:
+                break
+            first += length
+            prev = pos
+        else:
+            raise _corrupted()
+        if count <= value:
+            return False
+        # Replace the opcode by up to three: the registers before, the one
+        # being set, and those after.
+        last = first + length - 1
+        seq = bytearray()
+        if index > first:
+            seq += _sparse_run(value, index - first)
+        seq += _sparse_run(count, 1)
+        if index < last:
+            seq += _sparse_run(value, last - index)
+        if len(seq) > size and len(data) + len(seq) - size > HLL_SPARSE_MAX_BYTES:
+            self._promote()
+            return self._dense_set(index, count)
+        data[pos:pos + size] = seq
+        self._merge_values(pos if prev is None else prev)
+        return True
+
+    def _merge_values(self, pos):
+        """Merge adjacent VAL opcodes with the same value, in the few opcodes
+        from `pos` that may have changed."""
+        data = self._data
+        for _ in range(5):
+            if pos >= len(data):
+                break
+            op = data[pos]
+            if op & 0xc0 == 0x40:  # XZERO
+                pos += 2
+            elif op & 0xc0 == 0:  # ZERO
+                pos += 1
+            elif (pos + 1 < len(data) and data[pos + 1] & 0x80 and (op ^ data[pos + 1]) & 0x7c == 0
+                  and (op & 0x3) + (data[pos + 1] & 0x3) + 2 <= HLL_SPARSE_VAL_MAX_LEN):
+                # Try the merged opcode with the one that follows it next
+                data[pos:pos + 2] = bytes((op + (data[pos + 1] & 0x3) + 1,))
+            else:
+                pos += 1
+
+    def count(self):
+        """Return the estimated cardinality, from the cache if it is valid.
+
+        Otherwise the cache is updated, which changes the string.
+        """
+        data = self._data
+        if not data[15] & _CARD_INVALID:
+            return int.from_bytes(data[8:16], 'little')
+        if self.is_dense:
+            histogram = registers_histogram(self.registers())
+        else:
+            histogram = [0] * (HLL_Q + 2)
+            for _, _, value, length in _sparse_opcodes(data):
+                histogram[value] += length
+            if sum(histogram) != HLL_REGISTERS:
+                raise _corrupted()
+        result = cardinality(histogram)
+        data[8:16] = result.to_bytes(8, 'little')
+        self.modified = True
+        return result
+
+    def to_bytes(self):
+        return bytes(self._data)
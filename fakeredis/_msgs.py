@@ -1,5 +1,7 @@
 INVALID_EXPIRE_MSG = "ERR invalid expire time in {}"
 WRONGTYPE_MSG = "WRONGTYPE Operation against a key holding the wrong kind of value"
+INVALID_HYPERLOGLOG_MSG = "WRONGTYPE Key is not a valid HyperLogLog string value."
+CORRUPTED_HYPERLOGLOG_MSG = "INVALIDOBJ Corrupted HLL object detected"
 SYNTAX_ERROR_MSG = "ERR syntax error"
 INVALID_INT_MSG = "ERR value is not an integer or out of range"
 INVALID_FLOAT_MSG = "ERR value is not a valid float"
@@ -23,6 +25,11 @@ ZADD_NX_GT_LT_ERROR_MSG = "ERR GT, LT, and/or NX options at the same time are no
 NX_XX_GT_LT_ERROR_MSG = "ERR NX and XX, GT or LT options at the same time are not compatible"
 EXPIRE_UNSUPPORTED_OPTION = "ERR Unsupported option {}"
 ZUNIONSTORE_KEYS_MSG = "ERR at least 1 input key is needed for ZUNIONSTORE/ZINTERSTORE"
+ZSETOP_KEYS_MSG = "ERR at least 1 input key is needed for '{}' command"
+LIMIT_NEGATIVE_MSG = "ERR LIMIT can't be negative"
+NUMKEYS_POSITIVE_MSG = "ERR numkeys should be greater than 0"
+COUNT_POSITIVE_MSG = "ERR count should be greater than 0"
+VALUE_POSITIVE_MSG = "ERR value is out of range, must be positive"
 WRONG_ARGS_MSG = "ERR wrong number of arguments for '{}' command"
 UNKNOWN_COMMAND_MSG = "ERR unknown command '{}'"
 EXECABORT_MSG = "EXECABORT Transaction discarded because of previous errors."
@@ -45,8 +52,39 @@ LUA_COMMAND_ARG_MSG6 = "ERR Lua redis() command arguments must be strings or int
 LUA_COMMAND_ARG_MSG = "ERR Lua redis lib command arguments must be strings or integers"
 LUA_WRONG_NUMBER_ARGS_MSG = "ERR wrong number or type of arguments"
 SCRIPT_ERROR_MSG = "ERR Error running script (call to f_{}): @user_script:?: {}"
+BUSY_MSG = "BUSY Redis is busy running a script. You can only call SCRIPT KILL or SHUTDOWN NOSAVE."
+FUNCTION_BUSY_MSG = "BUSY Redis is busy running a script. You can only call FUNCTION KILL or SHUTDOWN NOSAVE."
+NOTBUSY_MSG = "NOTBUSY No scripts in execution right now."
+UNKILLABLE_MSG = (
+    "UNKILLABLE Sorry the script already executed write commands against the dataset. "
+    "You can either wait the script termination or kill the server in a hard way "
+    "using the SHUTDOWN NOSAVE command.")
+SCRIPT_KILLED_MSG = "ERR Script killed by user with SCRIPT KILL..."
+WRITE_IN_READ_ONLY_SCRIPT_MSG = "ERR Write commands are not allowed from read-only scripts."
+MISSING_LIBRARY_METADATA_MSG = "ERR Missing library metadata"
+ENGINE_NOT_FOUND_MSG = "ERR Engine '{}' not found"
+INVALID_LIBRARY_METADATA_MSG = "ERR Invalid metadata value given: {}"
+LIBRARY_NAME_MISSING_MSG = "ERR Library name was not given"
+INVALID_LIBRARY_NAME_MSG = \
+    "ERR Library names can only contain letters, numbers, or underscores(_) and must be at least one character long"
+INVALID_FUNCTION_NAME_MSG = \
+    "ERR Function names can only contain letters, numbers, or underscores(_) and must be at least one character long"
+LIBRARY_EXISTS_MSG = "ERR Library '{}' already exists"
+LIBRARY_NOT_FOUND_MSG = "ERR Library not found"
+NO_FUNCTIONS_REGISTERED_MSG = "ERR No functions registered"
+FUNCTION_EXISTS_MSG = "ERR Function {} already exists"
+FUNCTION_EXISTS_IN_LIBRARY_MSG = "ERR Function already exists in the library"
+FUNCTION_NOT_FOUND_MSG = "ERR Function not found"
+FUNCTION_REGISTER_ARGS_MSG = "ERR wrong number of arguments to redis.register_function"
+FUNCTION_UNKNOWN_ARG_MSG = "ERR unknown argument given to redis.register_function"
+FUNCTION_CALLBACK_MSG = "ERR callback argument given to redis.register_function must be a function"
+FUNCTION_UNKNOWN_FLAG_MSG = "ERR unknown flag given"
+FUNCTION_LOAD_ERROR_MSG = "ERR Error registering functions: {}"
+FUNCTION_WRITE_FLAG_RO_MSG = "ERR Can not execute a script with write flag using *_ro command."
 RESTORE_KEY_EXISTS = "BUSYKEY Target key name already exists."
 RESTORE_INVALID_CHECKSUM_MSG = "ERR DUMP payload version or checksum are wrong"
 RESTORE_INVALID_TTL_MSG = "ERR Invalid TTL value, must be >= 0"
 
 FLAG_NO_SCRIPT = 's'  # Command not allowed in scripts
+FLAG_WRITE = 'w'  # Command may modify the dataset
+FLAG_READ_ONLY = 'r'  # Command only reads, though it is not allowed in scripts
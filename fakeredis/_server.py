@@ -1,38 +1,201 @@
 import inspect
+import itertools
 import queue
 import threading
 import time
 import warnings
 import weakref
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 import redis
 
-from fakeredis._fakesocket import FakeSocket
+from fakeredis._commands import build_command_table
+from fakeredis._fakesocket import FakeSocket, LuaRuntime
 from fakeredis._helpers import (
-    Database, FakeSelector, LOGGER)
+    Clock, Database, FakeSelector, LOGGER, PatternSubscribers, RWLock, pack_fields)
 from fakeredis._msgs import CONNECTION_ERROR_MSG
 
 LOGGER = LOGGER
 
 
 class FakeServer:
-    def __init__(self, version=7):
-        self.lock = threading.Lock()
-        self.dbs = defaultdict(lambda: Database(self.lock))
+    # Maximum number of expired keys deleted from each database per cycle
+    ACTIVE_EXPIRE_CYCLE_KEYS = 200
+    # Number of scans in progress that are remembered, the total number of
+    # members in their snapshots, and the bits of a scan cursor that identify
+    # the scan.
+    MAX_SCANS = 128
+    MAX_SCAN_MEMBERS = 1000000
+    SCAN_ID_BITS = 32
+    SCAN_ID_MASK = (1 << SCAN_ID_BITS) - 1
+
+    def __init__(self, version=7, hz=10, lua_time_limit=5000, concurrent_reads=False):
+        # With concurrent_reads, commands that only read (and read-only
+        # scripts) share the lock, so that they run concurrently.
+        self.concurrent_reads = concurrent_reads
+        self.lock = RWLock() if concurrent_reads else threading.Lock()
+        self.clock = Clock()
+        # Frequency of the active expire cycle; 0 to only expire keys lazily
+        self.hz = hz
+        self._last_expire_cycle = 0.0
+        self._expire_cycle_lock = threading.Lock()
+        # Databases with keys that blocked clients may now be served from
+        self.ready_dbs = []
+        self.dbs = defaultdict(
+            lambda: Database(threading.Lock(), clock=self.clock, ready_dbs=self.ready_dbs))
         # Maps SHA1 to script source
         self.script_cache = {}
+        # Lua runtimes that are not running a script
+        self.lua_runtimes = []
+        # Libraries loaded with FUNCTION LOAD, by name, and the functions
+        # they registered, by function name. The functions all live in one
+        # runtime, which is created when the first library is loaded.
+        self.libraries = {}
+        self.lua_functions = {}
+        self.functions_runtime = None
+        # After a script has run for this many milliseconds, other commands
+        # get BUSY errors (0 for no limit)
+        self.lua_time_limit = lua_time_limit
+        # While scripts run: when the first of them started (from
+        # time.monotonic), whether it is a function rather than an eval
+        # script, whether it has run a write command, and whether it was
+        # killed. Several read-only scripts may be running with
+        # concurrent_reads; their start times and kinds are kept by runtime.
+        self.script_started = None
+        self.script_is_function = False
+        self.script_wrote = False
+        self.script_kill = False
+        self._running_scripts = {}
+        self._scripts_lock = threading.Lock()
         # Maps channel/pattern to weak set of sockets
         self.subscribers = defaultdict(weakref.WeakSet)
-        self.psubscribers = defaultdict(weakref.WeakSet)
+        self.psubscribers = PatternSubscribers()
         self.lastsave = int(time.time())
         self.connected = True
         # List of weakrefs to sockets that are being closed lazily
         self.closed_sockets = []
         self.version = version
+        # Maps socket class to its command table (see command_table)
+        self._command_tables = {}
+        # Maps the id of each scan in progress to the collection it is over and
+        # the snapshot of its members (see start_scan)
+        self._scans = OrderedDict()
+        self._scan_members = 0
+        self._scan_ids = itertools.count()
+        self._scans_lock = threading.Lock()
+
+    def active_expire_cycle(self):
+        """Delete some of the keys that have expired, even if never accessed.
+
+        Like the active expiry of redis, this runs at most `hz` times per
+        second of the server clock, and deletes a bounded number of keys from
+        each database.
+        """
+        now = self.clock.time
+        if not self.hz or 0 <= now - self._last_expire_cycle < 1.0 / self.hz:
+            return
+        # Readers sharing the server lock skip the cycle if one of them is
+        # already running it.
+        if not self._expire_cycle_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_expire_cycle = now
+            for db in list(self.dbs.values()):
+                db.remove_expired(self.ACTIVE_EXPIRE_CYCLE_KEYS)
+        finally:
+            self._expire_cycle_lock.release()
+
+    def acquire_lua_runtime(self):
+        """Take an idle Lua runtime to run a script, or create one."""
+        try:
+            return self.lua_runtimes.pop()
+        except IndexError:
+            return LuaRuntime(self.version)
+
+    def release_lua_runtime(self, runtime):
+        self.lua_runtimes.append(runtime)
+
+    def start_script(self, runtime, is_function=False):
+        """Record that a script or function is starting to run in `runtime`."""
+        with self._scripts_lock:
+            if not self._running_scripts:
+                self.script_wrote = False
+                self.script_kill = False
+            self._running_scripts[runtime] = (time.monotonic(), is_function)
+            self.script_started, self.script_is_function = min(self._running_scripts.values())
+
+    def end_script(self, runtime):
+        with self._scripts_lock:
+            del self._running_scripts[runtime]
+            self.script_started, self.script_is_function = min(
+                self._running_scripts.values(), default=(None, False))
+            if not self._running_scripts:
+                # A kill only applies to the scripts that were running
+                self.script_kill = False
+
+    def get_functions_runtime(self):
+        """The Lua runtime that loads libraries and runs their functions."""
+        if self.functions_runtime is None:
+            self.functions_runtime = LuaRuntime(self.version)
+        return self.functions_runtime
+
+    def start_scan(self, snapshot, collection):
+        """Register the snapshot of a collection taken by a new scan.
+
+        Returns the scan id, which is stored in the low bits of its cursors.
+        Only the most recent scans are kept, so abandoned ones are forgotten,
+        and the scan resumes from a new snapshot (see BaseFakeSocket._scan).
+        """
+        with self._scans_lock:
+            scan_id = next(self._scan_ids) % self.SCAN_ID_MASK + 1
+            self._scans[scan_id] = (collection, snapshot)
+            self._scan_members += len(snapshot)
+            while len(self._scans) > self.MAX_SCANS or (
+                    self._scan_members > self.MAX_SCAN_MEMBERS and len(self._scans) > 1):
+                self._scan_members -= len(self._scans.popitem(last=False)[1][1])
+            return scan_id
+
+    def scan_snapshot(self, scan_id, collection):
+        """Return the snapshot of `collection` for a scan, or None if unknown"""
+        with self._scans_lock:
+            try:
+                scanned, snapshot = self._scans[scan_id]
+            except KeyError:
+                return None
+            # The collection is referenced by the scan, so its identity can't
+            # be reused by another object.
+            if scanned is not collection:
+                return None
+            self._scans.move_to_end(scan_id)
+            return snapshot
+
+    def end_scan(self, scan_id):
+        with self._scans_lock:
+            scan = self._scans.pop(scan_id, None)
+            if scan is not None:
+                self._scan_members -= len(scan[1])
+
+    def command_table(self, sock_class):
+        """Return the command table for sockets of type `sock_class`.
+
+        The table is built the first time a socket of that class connects to
+        this server and shared by all later ones, so that looking up a command
+        is a single dictionary access on the raw command name.
+        """
+        table = self._command_tables.get(sock_class)
+        if table is None:
+            table = build_command_table(sock_class)
+            self._command_tables[sock_class] = table
+        return table
 
 
 class FakeConnection(redis.Connection):
+    """Connection to a `FakeServer`.
+
+    Commands are handed to the server as lists of fields, skipping the
+    encoding to and parsing of the redis protocol. Pass ``direct=False`` to
+    send them as protocol bytes instead, as a real connection would.
+    """
     description_format = "FakeConnection<db=%(db)s>"
 
     def __init__(self, *args, **kwargs):
@@ -41,8 +204,19 @@ class FakeConnection(redis.Connection):
         self._sock = None
         self._selector = None
         self._server = kwargs.pop('server')
+        self._direct = kwargs.pop('direct', True)
         super().__init__(*args, **kwargs)
 
+    def pack_command(self, *args):
+        if not self._direct:
+            return super().pack_command(*args)
+        return [pack_fields(self.encoder, args)]
+
+    def pack_commands(self, commands):
+        if not self._direct:
+            return super().pack_commands(commands)
+        return [pack_fields(self.encoder, args) for args in commands]
+
     def connect(self):
         super().connect()
         # The selector is set in redis.Connection.connect() after _connect() is called
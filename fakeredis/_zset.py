@@ -1,87 +1,509 @@
-import sortedcontainers
+import bisect
+import math
+from array import array
+
+# Sorted sets at most this size, with no member longer than LISTPACK_MAX_VALUE,
+# are kept in a single flat block without a dict, like the listpack encoding
+# in redis (zset-max-listpack-entries and zset-max-listpack-value).
+LISTPACK_MAX_ENTRIES = 128
+LISTPACK_MAX_VALUE = 64
+# Larger sorted sets are split into blocks of between _LOAD / 2 and 2 * _LOAD
+# members.
+_LOAD = 512
+
+
+def _sum(old, score):
+    score += old
+    return 0.0 if math.isnan(score) else score
+
+
+# Functions for the AGGREGATE option of ZUNION and ZINTER
+AGGREGATES = {b'sum': _sum, b'min': min, b'max': max}
 
 
 class ZSet:
+    """Sorted set of members ordered by (score, member).
+
+    Members are kept in sorted blocks of parallel arrays: an ``array('d')`` of
+    scores and a list of members. The last score and member of each block are
+    kept in ``_max_scores`` and ``_max_members`` to find the block for a key
+    by bisection, and a Fenwick tree of block lengths (rebuilt whenever
+    blocks are split, merged or removed) maps ranks to blocks.
+    Once the set outgrows the listpack limits, a dict from member to score
+    gives constant time score lookups.
+    """
+
     def __init__(self):
-        self._bylex = {}     # Maps value to score
-        self._byscore = sortedcontainers.SortedList()
+        self._scores = []       # Blocks of scores, as array('d')
+        self._members = []      # Blocks of members, parallel to _scores
+        self._max_scores = array('d')
+        self._max_members = []
+        self._index = [0]       # Fenwick tree of block lengths
+        self._dict = None       # Maps member to score, None for a listpack
+        self._len = 0
+
+    @classmethod
+    def from_dict(cls, scores):
+        """Build a ZSet from a dict mapping members to scores, taking ownership of it."""
+        pairs = sorted(zip(scores.values(), scores.keys()))
+        return cls._from_sorted(pairs, scores)
+
+    @classmethod
+    def _from_sorted(cls, pairs, scores=None):
+        """Build a ZSet from a list of (score, member) pairs in sorted order.
+
+        `scores` is the dict of the pairs if the caller has one.
+        """
+        zset = cls()
+        n = len(pairs)
+        if not n:
+            return zset
+        if n > LISTPACK_MAX_ENTRIES or any(len(pair[1]) > LISTPACK_MAX_VALUE for pair in pairs):
+            zset._dict = scores if scores is not None else {member: score for score, member in pairs}
+            blocks = max(1, n // _LOAD)
+        else:
+            blocks = 1
+        size = -(-n // blocks)
+        for i in range(0, n, size):
+            block = pairs[i:i + size]
+            zset._scores.append(array('d', [pair[0] for pair in block]))
+            zset._members.append([pair[1] for pair in block])
+        zset._max_scores = array('d', [block[-1] for block in zset._scores])
+        zset._max_members = [block[-1] for block in zset._members]
+        zset._len = n
+        zset._build_index()
+        return zset
+
+    @classmethod
+    def union(cls, zsets, weights, aggregate):
+        """Return the union of ZSets, as computed by ZUNION.
+
+        `aggregate` is one of the functions in `AGGREGATES`. The inputs are
+        combined from the smallest to the largest, which determines the order
+        of the floating-point operations, like in redis.
+        """
+        out = {}
+        for zset, weight in sorted(zip(zsets, weights), key=lambda x: len(x[0])):
+            for member, score in zset.items():
+                score *= weight
+                # Redis only does this step for ZUNION. See
+                # https://github.com/antirez/redis/issues/3954.
+                if math.isnan(score):
+                    score = 0.0
+                old = out.get(member)
+                if old is not None:
+                    score = aggregate(old, score)
+                out[member] = score
+        return cls.from_dict(out)
+
+    @classmethod
+    def intersection(cls, zsets, weights, aggregate):
+        """Return the intersection of ZSets, as computed by ZINTER.
+
+        Only the members of the smallest input are candidates, and the result
+        is returned as soon as there are none left.
+        """
+        inputs = sorted(zip(zsets, weights), key=lambda x: len(x[0]))
+        zset, weight = inputs[0]
+        out = {}
+        for member, score in zset.items():
+            score *= weight
+            out[member] = 0.0 if math.isnan(score) else score
+        for zset, weight in inputs[1:]:
+            if not out:
+                break
+            candidates, out = out, {}
+            for member, old in candidates.items():
+                score = zset.get(member)
+                if score is not None:
+                    score = aggregate(old, score * weight)
+                    out[member] = 0.0 if math.isnan(score) else score
+        return cls.from_dict(out)
+
+    @classmethod
+    def difference(cls, zsets):
+        """Return the members of the first ZSet that are in none of the others."""
+        first, others = zsets[0], sorted(zsets[1:], key=len, reverse=True)
+        pairs = [pair for pair in first.islice_score(0, len(first))
+                 if not any(pair[1] in zset for zset in others)]
+        return cls._from_sorted(pairs)
+
+    @staticmethod
+    def intersection_card(zsets, limit=0):
+        """Return the size of the intersection of ZSets, stopping at `limit` if nonzero."""
+        first, *others = sorted(zsets, key=len)
+        count = 0
+        for member in first:
+            if all(member in zset for zset in others):
+                count += 1
+                if count == limit:
+                    break
+        return count
+
+    def _find(self, member):
+        """Return the block and the position in it of a member of a listpack."""
+        try:
+            return 0, self._members[0].index(member)
+        except (IndexError, ValueError):
+            raise KeyError(member) from None
 
     def __contains__(self, value):
-        return value in self._bylex
+        if self._dict is not None:
+            return value in self._dict
+        return bool(self._members) and value in self._members[0]
 
     def add(self, value, score):
         """Update the item and return whether it modified the zset"""
-        old_score = self._bylex.get(value, None)
+        if self._dict is not None:
+            old_score = self._dict.get(value, None)
+        else:
+            old_score = self.get(value, None)
         if old_score is not None:
             if score == old_score:
                 return False
-            self._byscore.remove((old_score, value))
-        self._bylex[value] = score
-        self._byscore.add((score, value))
+            self._remove_at(*self._locate(old_score, value))
+        elif self._dict is None and (self._len >= LISTPACK_MAX_ENTRIES or len(value) > LISTPACK_MAX_VALUE):
+            self._dict = dict(zip(self._members[0], self._scores[0])) if self._members else {}
+        if self._dict is not None:
+            self._dict[value] = score
+        self._insert(score, value)
         return True
 
     def __setitem__(self, value, score):
         self.add(value, score)
 
     def __getitem__(self, key):
-        return self._bylex[key]
+        if self._dict is not None:
+            return self._dict[key]
+        i, j = self._find(key)
+        return self._scores[i][j]
 
     def get(self, key, default=None):
-        return self._bylex.get(key, default)
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
     def __len__(self):
-        return len(self._bylex)
+        return self._len
 
     def __iter__(self):
         def gen():
-            for score, value in self._byscore:
-                yield value
+            for block in self._members:
+                yield from block
 
         return gen()
 
     def discard(self, key):
-        try:
-            score = self._bylex.pop(key)
-        except KeyError:
-            return
+        if self._dict is not None:
+            try:
+                score = self._dict.pop(key)
+            except KeyError:
+                return
+            self._remove_at(*self._locate(score, key))
         else:
-            self._byscore.remove((score, key))
+            try:
+                self._remove_at(*self._find(key))
+            except KeyError:
+                return
 
     def zcount(self, min_, max_):
-        pos1 = self._byscore.bisect_left(min_)
-        pos2 = self._byscore.bisect_left(max_)
+        pos1 = self._bisect(*min_)
+        pos2 = self._bisect(*max_)
         return max(0, pos2 - pos1)
 
     def zlexcount(self, min_value, min_exclusive, max_value, max_exclusive):
-        if not self._byscore:
-            return 0
-        score = self._byscore[0][0]
-        if min_exclusive:
-            pos1 = self._byscore.bisect_right((score, min_value))
-        else:
-            pos1 = self._byscore.bisect_left((score, min_value))
-        if max_exclusive:
-            pos2 = self._byscore.bisect_left((score, max_value))
-        else:
-            pos2 = self._byscore.bisect_right((score, max_value))
+        pos1, pos2 = self._range_lex(min_value, max_value, (not min_exclusive, not max_exclusive))
         return max(0, pos2 - pos1)
 
     def islice_score(self, start, stop, reverse=False):
-        return self._byscore.islice(start, stop, reverse)
+        start, stop, _ = slice(start, stop).indices(self._len)
+        return self._iter_range(start, stop, reverse)
+
+    def irange_lex(self, start, stop, inclusive=(True, True), reverse=False, offset=0, count=-1):
+        pos1, pos2 = self._range_lex(start, stop, inclusive)
+        pos1, pos2 = self._limit(pos1, pos2, reverse, offset, count)
+        return (item[1] for item in self._iter_range(pos1, pos2, reverse))
+
+    def irange_score(self, start, stop, reverse=False, offset=0, count=-1):
+        pos1, pos2 = self._range_score(start, stop)
+        pos1, pos2 = self._limit(pos1, pos2, reverse, offset, count)
+        return self._iter_range(pos1, pos2, reverse)
+
+    def remove_range(self, start, stop):
+        """Remove the members with ranks from `start` to `stop` and return how many.
 
-    def irange_lex(self, start, stop, inclusive=(True, True), reverse=False):
-        if not self._byscore:
-            return iter([])
-        score = self._byscore[0][0]
-        it = self._byscore.irange((score, start), (score, stop),
-                                  inclusive=inclusive, reverse=reverse)
-        return (item[1] for item in it)
+        The slice is cut out of the blocks it spans at once, and the blocks are
+        rebalanced only at the cut. The index is rebuilt only when blocks are
+        dropped or merged, so this costs amortized O(k + log n) for k members.
+        """
+        start, stop, _ = slice(start, stop).indices(self._len)
+        if start >= stop:
+            return 0
+        scores, members = self._scores, self._members
+        i, j = self._position(start)
+        k, m = self._position(stop - 1)
+        m += 1
+        if self._dict is not None:
+            for n in range(i, k + 1):
+                for member in members[n][j if n == i else 0:m if n == k else None]:
+                    del self._dict[member]
+        if i == k:
+            del scores[i][j:m]
+            del members[i][j:m]
+            cut = ((i, m - j),)
+        else:
+            cut = ((i + 1, m), (i, len(members[i]) - j))
+            del scores[k][:m]
+            del members[k][:m]
+            del scores[i][j:]
+            del members[i][j:]
+            del scores[i + 1:k]
+            del members[i + 1:k]
+            del self._max_scores[i + 1:k]
+            del self._max_members[i + 1:k]
+        rebuild = k > i + 1
+        for n, removed in cut:
+            if members[n]:
+                self._max_scores[n] = scores[n][-1]
+                self._max_members[n] = members[n][-1]
+                if not rebuild:
+                    self._update_index(n, -removed)
+            else:
+                del scores[n]
+                del members[n]
+                del self._max_scores[n]
+                del self._max_members[n]
+                rebuild = True
+        self._len -= stop - start
+        for n in (i + 1, i):
+            if n < len(members) and len(members) > 1 and len(members[n]) < _LOAD // 2:
+                self._merge(n - 1 if n else n)
+                rebuild = True
+        if rebuild:
+            self._build_index()
+        return stop - start
+
+    def pop(self, count=1, reverse=False):
+        """Remove and return up to `count` (score, member) pairs with the lowest scores.
+
+        If `reverse` is true, the pairs with the highest scores are popped
+        instead, highest first. A negative `count` pops nothing.
+        """
+        count = max(0, min(count, self._len))
+        start, stop = (self._len - count, self._len) if reverse else (0, count)
+        items = list(self._iter_range(start, stop, reverse))
+        self.remove_range(start, stop)
+        return items
 
-    def irange_score(self, start, stop, reverse=False):
-        return self._byscore.irange(start, stop, reverse=reverse)
+    def remove_range_lex(self, start, stop, inclusive=(True, True)):
+        return self.remove_range(*self._range_lex(start, stop, inclusive))
+
+    def remove_range_score(self, start, stop):
+        return self.remove_range(*self._range_score(start, stop))
 
     def rank(self, member):
-        return self._byscore.index((self._bylex[member], member))
+        if self._dict is not None:
+            i, j = self._locate(self._dict[member], member)
+        else:
+            i, j = self._find(member)
+        return self._offset(i) + j
 
     def items(self):
-        return self._bylex.items()
+        """Return a list of (member, score) pairs, in no particular order."""
+        if self._dict is not None:
+            return list(self._dict.items())
+        return list(zip(self._members[0], self._scores[0])) if self._members else []
+
+    def _locate(self, score, member, right=False):
+        """Return the block and the position in it where (score, member) belongs.
+
+        `member` may be a bytes value or one of the `BeforeAny` and `AfterAny`
+        bounds. If the key is greater than every member, the block is the number
+        of blocks.
+        """
+        side = bisect.bisect_right if right else bisect.bisect_left
+        # The maxima with the same score as the key are sorted by member
+        lo = bisect.bisect_left(self._max_scores, score)
+        hi = bisect.bisect_right(self._max_scores, score, lo)
+        i = side(self._max_members, member, lo, hi)
+        if i == len(self._members):
+            return i, 0
+        scores = self._scores[i]
+        lo = bisect.bisect_left(scores, score)
+        hi = bisect.bisect_right(scores, score, lo)
+        return i, side(self._members[i], member, lo, hi)
+
+    def _range_lex(self, start, stop, inclusive):
+        """Return the ranks of a lexicographical range, assuming equal scores."""
+        if not self._len:
+            return 0, 0
+        score = self._scores[0][0]
+        pos1 = self._bisect(score, start, right=not inclusive[0])
+        pos2 = self._bisect(score, stop, right=inclusive[1])
+        return pos1, pos2
+
+    def _range_score(self, start, stop):
+        """Return the ranks of the members from key `start` to key `stop`."""
+        return self._bisect(*start), self._bisect(*stop, right=True)
+
+    @staticmethod
+    def _limit(pos1, pos2, reverse, offset, count):
+        """Narrow the ranks from `pos1` to `pos2` to a LIMIT `offset` `count`.
+
+        Like redis, a negative offset selects nothing and a negative count
+        selects everything after the offset.
+        """
+        if offset < 0:
+            return pos1, pos1
+        if reverse:
+            pos2 -= offset
+            if count >= 0:
+                pos1 = max(pos1, pos2 - count)
+        else:
+            pos1 += offset
+            if count >= 0:
+                pos2 = min(pos2, pos1 + count)
+        return pos1, pos2
+
+    def _bisect(self, score, member, right=False):
+        """Return the rank where (score, member) belongs."""
+        i, j = self._locate(score, member, right)
+        return self._offset(i) + j
+
+    def _build_index(self):
+        """Build the Fenwick tree of block lengths.
+
+        The index is only changed by mutators, never by lookups, so that read
+        commands running concurrently (see ``FakeServer(concurrent_reads=True)``)
+        do not write to the sorted set.
+        """
+        index = [0]
+        index.extend(len(block) for block in self._members)
+        for i in range(1, len(index)):
+            parent = i + (i & -i)
+            if parent < len(index):
+                index[parent] += index[i]
+        self._index = index
+
+    def _update_index(self, i, delta):
+        index = self._index
+        i += 1
+        while i < len(index):
+            index[i] += delta
+            i += i & -i
+
+    def _offset(self, i):
+        """Return the number of members before block `i`."""
+        if i == 0:
+            return 0
+        if i == len(self._members):
+            return self._len
+        index = self._index
+        total = 0
+        while i:
+            total += index[i]
+            i -= i & -i
+        return total
+
+    def _position(self, rank):
+        """Return the block and the position in it of the member at `rank`."""
+        if len(self._members) == 1:
+            return 0, rank
+        index = self._index
+        i = 0
+        step = 1 << (len(index).bit_length() - 1)
+        while step:
+            if i + step < len(index) and index[i + step] <= rank:
+                i += step
+                rank -= index[i]
+            step >>= 1
+        return i, rank
+
+    def _iter_range(self, start, stop, reverse=False):
+        """Yield the (score, member) pairs with ranks from `start` to `stop`."""
+        remaining = stop - start
+        if remaining <= 0:
+            return
+        scores, members = self._scores, self._members
+        if reverse:
+            i, j = self._position(stop - 1)
+            while remaining > 0:
+                lo = max(0, j + 1 - remaining)
+                yield from zip(reversed(scores[i][lo:j + 1]), reversed(members[i][lo:j + 1]))
+                remaining -= j + 1 - lo
+                i -= 1
+                j = len(members[i]) - 1
+        else:
+            i, j = self._position(start)
+            while remaining > 0:
+                hi = min(len(members[i]), j + remaining)
+                yield from zip(scores[i][j:hi], members[i][j:hi])
+                remaining -= hi - j
+                i += 1
+                j = 0
+
+    def _insert(self, score, member):
+        self._len += 1
+        if not self._members:
+            self._scores.append(array('d', (score,)))
+            self._members.append([member])
+            self._max_scores.append(score)
+            self._max_members.append(member)
+            self._build_index()
+            return
+        i, j = self._locate(score, member)
+        if i == len(self._members):
+            i -= 1
+            j = len(self._members[i])
+        scores, members = self._scores[i], self._members[i]
+        scores.insert(j, score)
+        members.insert(j, member)
+        if j == len(members) - 1:
+            self._max_scores[i] = score
+            self._max_members[i] = member
+        if len(members) > 2 * _LOAD and self._dict is not None:
+            self._split(i)
+            self._build_index()
+        else:
+            self._update_index(i, 1)
+
+    def _split(self, i):
+        scores, members = self._scores[i], self._members[i]
+        half = len(members) // 2
+        self._scores.insert(i + 1, scores[half:])
+        self._members.insert(i + 1, members[half:])
+        del scores[half:]
+        del members[half:]
+        self._max_scores.insert(i, scores[-1])
+        self._max_members.insert(i, members[-1])
+
+    def _remove_at(self, i, j):
+        self._len -= 1
+        scores, members = self._scores[i], self._members[i]
+        del scores[j]
+        del members[j]
+        if not members:
+            del self._scores[i]
+            del self._members[i]
+            del self._max_scores[i]
+            del self._max_members[i]
+            self._build_index()
+            return
+        if j == len(members):
+            self._max_scores[i] = scores[-1]
+            self._max_members[i] = members[-1]
+        if len(members) < _LOAD // 2 and len(self._members) > 1:
+            self._merge(i - 1 if i else i)
+            self._build_index()
+        else:
+            self._update_index(i, -1)
+
+    def _merge(self, i):
+        """Merge block `i + 1` into block `i`."""
+        self._scores[i].extend(self._scores.pop(i + 1))
+        self._members[i].extend(self._members.pop(i + 1))
+        del self._max_scores[i]
+        del self._max_members[i]
+        if len(self._members[i]) > 2 * _LOAD:
+            self._split(i)
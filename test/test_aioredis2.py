@@ -146,6 +146,43 @@ async def test_pubsub_timeout(req_aioredis2):
         assert message is None
 
 
+@pytest.mark.slow
+async def test_pubsub_wakes_on_publish(req_aioredis2, event_loop):
+    async def publish():
+        await asyncio.sleep(0.1)
+        await req_aioredis2.publish('channel', 'hello')
+
+    async with req_aioredis2.pubsub() as ps:
+        await ps.subscribe('channel')
+        await ps.get_message(timeout=0.5)  # Subscription message
+        task = event_loop.create_task(publish())
+        start = event_loop.time()
+        message = await ps.get_message(timeout=10)
+        assert event_loop.time() - start < 0.5
+        assert message['data'] == b'hello'
+        await task
+
+
+@fake_only
+async def test_pubsub_get_message_does_not_poll(req_aioredis2, event_loop, mocker):
+    sleep = asyncio.sleep
+
+    async def publish():
+        await sleep(0.1)
+        await req_aioredis2.publish('channel', 'hello')
+
+    async with req_aioredis2.pubsub() as ps:
+        await ps.subscribe('channel')
+        await ps.get_message(timeout=0.5)  # Subscription message
+        sleep_spy = mocker.spy(asyncio, 'sleep')
+        task = event_loop.create_task(publish())
+        message = await ps.get_message(timeout=10)
+        await task
+        assert message['data'] == b'hello'
+        # The reader waits to be woken up, rather than sleeping between polls
+        sleep_spy.assert_not_called()
+
+
 @pytest.mark.slow
 async def test_pubsub_disconnect(req_aioredis2):
     async with req_aioredis2.pubsub() as ps:
@@ -233,6 +270,21 @@ async def test_disconnect_server(req_aioredis2, fake_server):
     fake_server.connected = True
 
 
+@pytest.mark.fake
+@pytest.mark.parametrize('direct', [True, False])
+async def test_direct_and_protocol_paths(fake_server, direct):
+    pool = aioredis.ConnectionPool(
+        connection_class=fakeredis.aioredis.FakeConnection, server=fake_server, direct=direct)
+    r = aioredis.Redis(connection_pool=pool)
+    value = b'bar\r\n$3\r\n'
+    assert await r.set('foo', value)
+    assert await r.get('foo') == value
+    async with r.pipeline() as p:
+        p.incr('n').incrby('n', 5).get('foo')
+        assert await p.execute() == [1, 6, value]
+    await pool.disconnect()
+
+
 @pytest.mark.fake
 async def test_from_url():
     r0 = fakeredis.aioredis.FakeRedis.from_url('redis://localhost?db=0')
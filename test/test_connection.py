@@ -1,8 +1,12 @@
+import threading
+import time
+
 import pytest
 import redis
 import redis.client
 from redis.exceptions import ResponseError
 
+import fakeredis
 import testtools
 
 fake_only = pytest.mark.parametrize(
@@ -23,6 +27,95 @@ def test_time(r, mocker):
     assert r.time() == (1234567891, 0)
 
 
+@fake_only
+def test_virtual_clock(r, fake_server):
+    now = [1000.0]
+    fake_server.clock.now = lambda: now[0]
+    r.set('foo', 'bar', ex=10)
+    r.select(1)
+    r.set('baz', 'qux', px=500)
+    assert r.time() == (1000, 0)
+    now[0] += 9
+    assert r.get('baz') is None
+    r.select(0)
+    assert r.get('foo') == b'bar'
+    assert r.ttl('foo') == 1
+    now[0] += 2
+    assert r.get('foo') is None
+
+
+@fake_only
+def test_active_expire(r, fake_server):
+    now = [1000.0]
+    fake_server.clock.now = lambda: now[0]
+    db = fake_server.dbs[0]
+    for i in range(300):
+        r.set(f'key{i}', 'value', px=100 + i)
+    r.set('persistent', 'value')
+    now[0] += 1
+    r.ping()
+    # Expired keys are reclaimed in bounded batches without being accessed
+    assert len(db._dict) == 300 + 1 - fake_server.ACTIVE_EXPIRE_CYCLE_KEYS
+    now[0] += 1
+    r.ping()
+    assert list(db._dict) == [b'persistent']
+    assert r.dbsize() == 1
+
+
+@fake_only
+def test_blocked_clients_wake_per_key(r, fake_server):
+    results = {}
+
+    def blpop(key):
+        client = fakeredis.FakeStrictRedis(server=fake_server)
+        results[key] = client.blpop(key, timeout=5)
+
+    threads = {key: threading.Thread(target=blpop, args=(key,)) for key in ('foo', 'bar')}
+    for thread in threads.values():
+        thread.start()
+    time.sleep(0.1)
+    r.set('baz', 'qux')
+    r.rpush('foo', 'value')
+    threads['foo'].join(timeout=2)
+    assert not threads['foo'].is_alive()
+    assert results == {'foo': (b'foo', b'value')}
+    # The client blocked on another key is still waiting
+    time.sleep(0.1)
+    assert threads['bar'].is_alive()
+    r.rpush('bar', 'value')
+    threads['bar'].join(timeout=2)
+    assert not threads['bar'].is_alive()
+    assert results['bar'] == (b'bar', b'value')
+
+
+@pytest.mark.fake
+@pytest.mark.parametrize('direct', [True, False])
+def test_direct_and_protocol_paths(fake_server, direct):
+    pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection, server=fake_server, direct=direct)
+    r = fakeredis.FakeStrictRedis(connection_pool=pool)
+    value = b'bar\r\n$3\r\n'
+    assert r.set('foo', value)
+    assert r.get('foo') == value
+    assert r.execute_command('SCRIPT EXISTS', 'abc') == [0]
+    with r.pipeline() as p:
+        p.incr('n').incrby('n', 5).get('foo').hset('h', 'f', memoryview(b'v'))
+        assert p.execute() == [1, 6, value, 1]
+    assert r.hget('h', 'f') == b'v'
+
+
+@pytest.mark.fake
+def test_protocol_large_value_and_pipeline(fake_server):
+    pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection, server=fake_server, direct=False)
+    r = fakeredis.FakeStrictRedis(connection_pool=pool)
+    value = bytes(range(256)) * 4096
+    assert r.set('big', value)
+    assert r.get('big') == value
+    with r.pipeline(transaction=False) as p:
+        for i in range(2000):
+            p.rpush('list', i)
+        assert p.execute() == list(range(1, 2001))
+
+
 @pytest.mark.decode_responses
 class TestDecodeResponses:
     def test_decode_str(self, r):
@@ -486,3 +579,32 @@ def test_fakeredis_aioredis_raises_if_missing_aioredis():
     ):
         import fakeredis.aioredis
         v = fakeredis.aioredis
+
+
+@pytest.mark.fake
+def test_concurrent_reads_with_expiry():
+    server = fakeredis.FakeServer(concurrent_reads=True)
+    r = fakeredis.FakeStrictRedis(server=server)
+    for i in range(1000):
+        r.set('key{}'.format(i), 'value', px=1 + i % 20)
+    errors = []
+
+    def read():
+        client = fakeredis.FakeStrictRedis(server=server)
+        try:
+            for _ in range(50):
+                client.keys('key1*')
+                client.keys('*')
+                client.get('key1')
+                client.dbsize()
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    time.sleep(0.05)
+    assert r.keys() == []
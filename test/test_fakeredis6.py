@@ -354,6 +354,28 @@ def test_append_wrong_type(r):
         r.append('foo', b'x')
 
 
+def test_append_many(r):
+    for i in range(1000):
+        assert r.append('foo', b'%03d' % i) == 3 * (i + 1)
+    expected = b''.join(b'%03d' % i for i in range(1000))
+    assert r.get('foo') == expected
+    assert r.strlen('foo') == 3000
+    assert r.getrange('foo', 0, 5) == b'000001'
+    assert r.type('foo') == b'string'
+
+
+def test_modified_string_commands(r):
+    r.set('foo', 'bar')
+    r.setrange('foo', 5, 'baz')
+    r.setbit('foo', 7, 1)
+    assert r.get('foo') == b'car\x00\x00baz'
+    assert r.mget('foo', 'bar') == [b'car\x00\x00baz', None]
+    assert r.getset('foo', '1') == b'car\x00\x00baz'
+    r.append('foo', '2')
+    assert r.incr('foo') == 13
+    assert r.getrange('foo', 0, -1) == b'13'
+
+
 def test_incr_with_no_preexisting_key(r):
     assert r.incr('foo') == 1
     assert r.incr('bar', 2) == 2
@@ -496,6 +518,34 @@ def test_keys(r):
     assert r.keys(r'abc[c-\e]e') == []
 
 
+def test_keys_simple_patterns(r):
+    r.mset({'abc': 'a', 'abc*': 'b', 'xabc': 'c', 'ab': 'd'})
+    assert sorted(r.keys('*')) == [b'ab', b'abc', b'abc*', b'xabc']
+    assert sorted(r.keys('ab*')) == [b'ab', b'abc', b'abc*']
+    assert sorted(r.keys('*bc')) == [b'abc', b'xabc']
+    assert r.keys(r'*c\*') == [b'abc*']
+    assert r.keys('abc') == [b'abc']
+    # Cached patterns give the same result after the keys change
+    r.delete('abc')
+    assert sorted(r.keys('*bc')) == [b'xabc']
+    assert r.keys('abc') == []
+
+
+def test_keys_with_prefix(r):
+    r.mset({'job:1': 'a', 'job:2': 'b', 'job:10': 'c', 'jobs': 'd', 'jo': 'e', 'job\\*': 'f'})
+    assert sorted(r.keys('job:*')) == [b'job:1', b'job:10', b'job:2']
+    assert r.keys('job:?0') == [b'job:10']
+    assert r.keys('job:2') == [b'job:2']
+    assert r.keys(r'job\\\*') == [b'job\\*']
+    # Keys added, deleted and expired after a lookup are taken into account
+    r.set('job:3', 'g')
+    r.delete('job:1')
+    r.set('job:2', 'h', px=1)
+    sleep(0.01)
+    assert sorted(r.keys('job:*')) == [b'job:10', b'job:3']
+    assert sorted(r.scan_iter(match='job*', count=1)) == [b'job:10', b'job:3', b'job\\*', b'jobs']
+
+
 def test_exists(r):
     assert 'foo' not in r
     r.set('foo', 'bar')
@@ -830,6 +880,23 @@ def test_lrange_negative_indices(r):
     assert r.lrange('foo', -2, -1) == [b'b', b'c']
 
 
+def test_long_list_both_ends(r):
+    r.rpush('foo', *range(1000))
+    r.lpush('foo', 'head')
+    r.rpush('foo', 'tail')
+    assert r.lpop('foo') == b'head'
+    assert r.rpop('foo') == b'tail'
+    assert r.lrange('foo', 0, 2) == [b'0', b'1', b'2']
+    assert r.lrange('foo', 997, 2000) == [b'997', b'998', b'999']
+    assert r.lrange('foo', -3, -2) == [b'997', b'998']
+    assert r.lindex('foo', 500) == b'500'
+    assert r.lindex('foo', -501) == b'499'
+    assert r.lrem('foo', -1, '998') == 1
+    assert r.ltrim('foo', 10, -10)
+    assert r.llen('foo') == 980
+    assert r.lrange('foo', -2, -1) == [b'988', b'989']
+
+
 def test_lpush_key_does_not_exist(r):
     assert r.lrange('foo', 0, -1) == []
 
@@ -1226,6 +1293,26 @@ def test_blpop_block(r):
         thread.join()
 
 
+@pytest.mark.slow
+def test_blpop_fifo(r):
+    # Clients blocked on the same key are served in the order they blocked
+    results = {}
+
+    def pop_thread(name):
+        results[name] = r.blpop('foo', timeout=5)
+
+    threads = []
+    for name in ['first', 'second']:
+        thread = threading.Thread(target=pop_thread, args=(name,))
+        thread.start()
+        threads.append(thread)
+        sleep(0.2)
+    r.rpush('foo', 'value1', 'value2')
+    for thread in threads:
+        thread.join()
+    assert results == {'first': (b'foo', b'value1'), 'second': (b'foo', b'value2')}
+
+
 def test_blpop_wrong_type(r):
     r.set('foo', 'bar')
     with pytest.raises(redis.ResponseError):
@@ -2038,6 +2125,23 @@ def test_zrank(r):
     assert r.zrank('foo', 'three') == 2
 
 
+def test_zset_large(r):
+    # Large enough to be split into several blocks
+    members = {'m{:05d}'.format(i): i % 7 for i in range(5000)}
+    testtools.zadd(r, 'foo', members)
+    expected = sorted(members, key=lambda m: (members[m], m))
+    assert r.zcard('foo') == 5000
+    assert r.zrank('foo', expected[3000]) == 3000
+    assert r.zrevrank('foo', expected[3000]) == 1999
+    assert r.zrange('foo', 1020, 1025) == [m.encode() for m in expected[1020:1026]]
+    assert r.zcount('foo', 2, '(4') == sum(1 for s in members.values() if 2 <= s < 4)
+    assert r.zrem('foo', *expected[:4000:2]) == 2000
+    del expected[:4000:2]
+    assert r.zrange('foo', 0, -1) == [m.encode() for m in expected]
+    assert r.zrevrange('foo', 0, 2) == [m.encode() for m in expected[:-4:-1]]
+    assert r.zscore('foo', expected[-1]) == members[expected[-1]]
+
+
 def test_zrank_non_existent_member(r):
     assert r.zrank('foo', 'one') is None
 
@@ -2218,6 +2322,18 @@ def test_zrangebyscore_slice(r):
     assert r.zrangebyscore('foo', 0, 4, 1, 3) == [b'two_b', b'two_c', b'two_d']
 
 
+def test_zrangebyscore_limit_pages(r):
+    testtools.zadd(r, 'foo', {'m{:04d}'.format(i): i // 10 for i in range(3000)})
+    expected = [b'm%04d' % i for i in range(100, 2900)]
+    pages = [r.zrangebyscore('foo', 10, '(290', offset, 100) for offset in range(0, 2800, 100)]
+    assert sum(pages, []) == expected
+    pages = [r.zrevrangebyscore('foo', '(290', 10, offset, 100) for offset in range(0, 2800, 100)]
+    assert sum(pages, []) == expected[::-1]
+    assert r.zrangebyscore('foo', 10, 20, 108, 10, withscores=True) == [(b'm0208', 20.0), (b'm0209', 20.0)]
+    assert r.zrevrangebyscore('foo', 20, 10, 105, -1) == [b'm0104', b'm0103', b'm0102', b'm0101', b'm0100']
+    assert r.zrangebyscore('foo', 10, 20, 5000, 10) == []
+
+
 def test_zrangebyscore_withscores(r):
     testtools.zadd(r, 'foo', {'one': 1})
     testtools.zadd(r, 'foo', {'two': 2})
@@ -2521,6 +2637,59 @@ def test_zremrangebyscore_exclusive(r):
     assert r.zrange('foo', 0, -1) == []
 
 
+def test_zpopmin_zpopmax(r):
+    testtools.zadd(r, 'foo', {'one': 1, 'two': 2, 'three': 3, 'four': 4})
+    assert r.zpopmin('foo') == [(b'one', 1)]
+    assert r.zpopmax('foo', 2) == [(b'four', 4), (b'three', 3)]
+    assert r.zpopmin('foo', 0) == []
+    assert r.zpopmin('foo', 5) == [(b'two', 2)]
+    assert not r.exists('foo')
+    assert r.zpopmax('foo') == []
+    r.set('bar', 'value')
+    with pytest.raises(redis.ResponseError):
+        r.zpopmin('bar')
+
+
+def test_bzpopmin_bzpopmax(r):
+    testtools.zadd(r, 'bar', {'one': 1, 'two': 2})
+    assert r.bzpopmin(['foo', 'bar'], timeout=1) == (b'bar', b'one', 1)
+    assert r.bzpopmax('bar', timeout=1) == (b'bar', b'two', 2)
+    assert not r.exists('bar')
+    r.set('baz', 'value')
+    with pytest.raises(redis.ResponseError):
+        r.bzpopmin(['foo', 'baz'], timeout=1)
+
+
+@pytest.mark.slow
+def test_bzpopmin_block(r):
+    def add_thread():
+        sleep(0.5)
+        testtools.zadd(r, 'foo', {'job1': 2, 'job2': 1})
+
+    thread = threading.Thread(target=add_thread)
+    thread.start()
+    try:
+        assert r.bzpopmin('foo', timeout=5) == (b'foo', b'job2', 1)
+        assert r.bzpopmin('foo', timeout=5) == (b'foo', b'job1', 2)
+    finally:
+        thread.join()
+    assert r.bzpopmax('foo', timeout=1) is None
+
+
+def test_zremrange_large(r):
+    # Sliding window: trim the oldest entries after each batch of additions
+    for now in range(0, 5000, 500):
+        testtools.zadd(r, 'foo', {'req{}'.format(t): t for t in range(now, now + 500)})
+        r.zremrangebyscore('foo', '-inf', '({}'.format(now - 1500))
+    assert r.zcard('foo') == 2000
+    assert r.zrange('foo', 0, 0) == [b'req3000']
+    assert r.zrank('foo', 'req4000') == 1000
+    assert r.zremrangebyrank('foo', 100, 1599) == 1500
+    assert r.zrange('foo', 99, 100) == [b'req3099', b'req4600']
+    assert r.zremrangebyrank('foo', 0, -1) == 500
+    assert not r.exists('foo')
+
+
 def test_zremrangebyscore_raises_error(r):
     testtools.zadd(r, 'foo', {'zero': 0})
     testtools.zadd(r, 'foo', {'two': 2})
@@ -2763,6 +2932,60 @@ def test_zinterstore_wrong_type(r):
         r.zinterstore('baz', ['foo', 'bar'])
 
 
+@pytest.mark.min_server('6.2')
+def test_zunion_zinter(r):
+    testtools.zadd(r, 'foo', {'one': 1, 'two': 2})
+    testtools.zadd(r, 'bar', {'one': 1, 'two': 2, 'three': 3})
+    r.sadd('baz', 'two', 'four')
+    assert r.zunion(['foo', 'bar']) == [b'one', b'three', b'two']
+    assert r.zunion(['foo', 'bar', 'baz'], withscores=True) == [
+        (b'four', 1), (b'one', 2), (b'three', 3), (b'two', 5)]
+    assert r.zunion({'foo': 2, 'bar': 1}, aggregate='MIN', withscores=True) == [
+        (b'one', 1), (b'two', 2), (b'three', 3)]
+    assert r.zinter(['foo', 'bar'], withscores=True) == [(b'one', 2), (b'two', 4)]
+    assert r.zinter(['foo', 'bar', 'baz'], aggregate='MAX', withscores=True) == [(b'two', 2)]
+    assert r.zinter(['foo', 'bar', 'missing']) == []
+    with pytest.raises(redis.ResponseError):
+        testtools.raw_command(r, 'zunion', 0, 'foo')
+    with pytest.raises(redis.ResponseError):
+        testtools.raw_command(r, 'zinter', 1, 'foo', 'aggregate', 'avg')
+
+
+@pytest.mark.min_server('6.2')
+def test_zdiff(r):
+    testtools.zadd(r, 'foo', {'one': 1, 'two': 2, 'three': 3, 'four': 4})
+    testtools.zadd(r, 'bar', {'two': 2})
+    r.sadd('baz', 'four')
+    assert r.zdiff(['foo', 'bar', 'baz'], withscores=True) == [b'one', b'1', b'three', b'3']
+    assert r.zdiff(['foo', 'missing']) == [b'one', b'two', b'three', b'four']
+    assert r.zdiff(['missing', 'foo']) == []
+    assert r.zdiffstore('out', ['foo', 'bar']) == 3
+    assert r.zrange('out', 0, -1, withscores=True) == [(b'one', 1), (b'three', 3), (b'four', 4)]
+    assert r.zdiffstore('out', ['bar', 'foo']) == 0
+    assert not r.exists('out')
+    r.set('str', 'value')
+    with pytest.raises(redis.ResponseError):
+        r.zdiff(['foo', 'str'])
+    with pytest.raises(redis.ResponseError):
+        testtools.raw_command(r, 'zdiffstore', 'out', 1, 'foo', 'withscores')
+
+
+def test_zunionstore_large(r):
+    testtools.zadd(r, 'foo', {'m{}'.format(i): i for i in range(0, 3000, 2)})
+    testtools.zadd(r, 'bar', {'m{}'.format(i): i for i in range(0, 3000, 3)})
+    assert r.zunionstore('baz', ['foo', 'bar']) == 2000
+    assert r.zinterstore('qux', ['foo', 'bar']) == 500
+    expected = {}
+    for i in range(0, 3000, 2):
+        expected[b'm%d' % i] = i
+    for i in range(0, 3000, 3):
+        expected[b'm%d' % i] = expected.get(b'm%d' % i, 0) + i
+    expected = sorted(expected.items(), key=lambda item: (item[1], item[0]))
+    assert r.zrange('baz', 0, -1, withscores=True) == expected
+    assert r.zrange('qux', 0, 2, withscores=True) == [(b'm0', 0), (b'm6', 12), (b'm12', 24)]
+    assert r.zrank('qux', 'm2994') == 499
+
+
 def test_empty_zset(r):
     testtools.zadd(r, 'foo', {'one': 1})
     r.zrem('foo', 'one')
@@ -3229,6 +3452,18 @@ def test_ping(r):
     assert raw_command(r, 'ping', 'test') == b'test'
 
 
+def test_command_name_case_insensitive(r):
+    assert raw_command(r, 'SeT', 'foo', 'bar') == b'OK'
+    assert raw_command(r, 'GET', 'foo') == b'bar'
+
+
+def test_unknown_command(r):
+    with pytest.raises(redis.ResponseError, match="unknown command 'nosuchcommand'"):
+        raw_command(r, 'nosuchcommand')
+    with pytest.raises(redis.ResponseError, match='unknown command'):
+        raw_command(r, '_blocking')
+
+
 @testtools.run_test_if_redispy_ver('above', '3')
 def test_ping_pubsub(r):
     p = r.pubsub()
@@ -3344,6 +3579,30 @@ def test_pubsub_psubscribe(r):
     assert message == expected_message
 
 
+@pytest.mark.slow
+def test_pubsub_psubscribe_matching(r):
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.psubscribe('news.*', 'news.sport', 'new?.*', '*.sport', 'weather.*')
+    assert r.publish('news.sport', 'goal') == 4
+    assert r.publish('news', 'nothing') == 0
+    assert r.publish('newt.x', 'spell') == 1
+    pubsub.punsubscribe('news.*', '*.sport')
+    assert r.publish('news.sport', 'goal') == 2
+    assert r.publish('weather.today', 'sun') == 1
+    messages = []
+    # Subscription messages are read as None
+    for _ in range(15):
+        message = pubsub.get_message(timeout=0.1)
+        if message is not None:
+            messages.append((message['pattern'], message['data']))
+    assert sorted(messages) == sorted([
+        (b'news.*', b'goal'), (b'news.sport', b'goal'), (b'new?.*', b'goal'), (b'*.sport', b'goal'),
+        (b'new?.*', b'spell'),
+        (b'news.sport', b'goal'), (b'new?.*', b'goal'),
+        (b'weather.*', b'sun'),
+    ])
+
+
 @pytest.mark.slow
 def test_pubsub_unsubscribe(r):
     pubsub = r.pubsub()
@@ -3616,6 +3875,42 @@ def test_pubsub_timeout(r, timeout_value):
         assert message is None
 
 
+@pytest.mark.slow
+def test_pubsub_wakes_on_publish(r):
+    def publish():
+        sleep(0.1)
+        r.publish('channel', 'hello')
+
+    p = r.pubsub()
+    p.subscribe('channel')
+    p.parse_response()  # Drains the subscribe message
+    publish_thread = threading.Thread(target=publish)
+    publish_thread.start()
+    start = time()
+    message = p.get_message(timeout=10)
+    # The reader must return once the message is published, not at the timeout
+    assert time() - start < 0.5
+    assert message['data'] == b'hello'
+    publish_thread.join()
+
+
+@pytest.mark.fake
+def test_pubsub_get_message_does_not_poll(fake_server, mocker):
+    r1 = fakeredis.FakeStrictRedis(server=fake_server)
+    r2 = fakeredis.FakeStrictRedis(server=fake_server)
+    p = r1.pubsub()
+    p.subscribe('channel')
+    p.parse_response()  # Drains the subscribe message
+    publish_thread = threading.Thread(target=lambda: (sleep(0.1), r2.publish('channel', 'hello')))
+    sleep_spy = mocker.spy(fakeredis._helpers.time, 'sleep')
+    publish_thread.start()
+    message = p.get_message(timeout=10)
+    publish_thread.join()
+    assert message['data'] == b'hello'
+    # The reader waits to be woken up, rather than sleeping between polls
+    sleep_spy.assert_not_called()
+
+
 def test_pfadd(r):
     key = "hll-pfadd"
     assert r.pfadd(key, "a", "b", "c", "d", "e", "f", "g") == 1
@@ -3649,6 +3944,43 @@ def test_pfmerge(r):
     assert r.pfcount(key3) == 6
 
 
+def test_pfadd_string_encoding(r):
+    key = "hll-encoding"
+    assert r.pfadd(key) == 1
+    assert r.type(key) == b'string'
+    assert r.get(key).startswith(b'HYLL')
+    assert r.pfadd(key, *range(100)) == 1
+    sparse_size = len(r.get(key))
+    assert sparse_size < 3000
+    # Switching to the dense encoding makes the size constant
+    assert r.pfadd(key, *range(100, 10000)) == 1
+    dense_size = len(r.get(key))
+    assert dense_size > sparse_size
+    r.pfadd(key, *range(10000, 20000))
+    assert len(r.get(key)) == dense_size
+    assert abs(r.pfcount(key) - 20000) < 20000 * 0.02
+
+
+def test_pfmerge_registers(r):
+    r.pfadd('hll1', *range(0, 5000))
+    r.pfadd('hll2', *range(2500, 7500))
+    r.pfadd('hll3', *range(0, 7500))
+    assert r.pfmerge('hll4', 'hll1', 'hll2')
+    assert r.pfcount('hll4') == r.pfcount('hll1', 'hll2') == r.pfcount('hll3')
+    assert abs(r.pfcount('hll4') - 7500) < 7500 * 0.02
+
+
+def test_pf_wrong_type(r):
+    r.set('foo', 'bar')
+    with pytest.raises(redis.ResponseError, match='not a valid HyperLogLog'):
+        r.pfadd('foo', 'a')
+    with pytest.raises(redis.ResponseError, match='not a valid HyperLogLog'):
+        r.pfcount('foo')
+    r.sadd('set', 'a')
+    with pytest.raises(redis.ResponseError, match='wrong kind of value'):
+        r.pfadd('set', 'a')
+
+
 def test_scan(r):
     # Setup the data
     for ix in range(20):
@@ -3683,6 +4015,48 @@ def test_scan(r):
     assert len(results) == 2
 
 
+def test_scan_with_modifications(r):
+    for ix in range(100):
+        r.set('scan-test:%s' % ix, 'value')
+    results = []
+    cursor, data = r.scan(0, count=10)
+    results.extend(data)
+    ix = 0
+    while cursor != 0:
+        # Delete and add keys on every page
+        r.delete('scan-test:%s' % (99 - ix))
+        r.set('scan-new:%s' % ix, 'value')
+        ix += 1
+        cursor, data = r.scan(cursor, count=10)
+        results.extend(data)
+    # Keys present during the whole scan are returned
+    assert {b'scan-test:%d' % i for i in range(100 - ix)} <= set(results)
+
+
+def test_scan_many_interleaved(r):
+    # More scans in progress than the server remembers
+    for ix in range(50):
+        r.set('scan-test:%s' % ix, 'value')
+        r.sadd('set-test:%s' % (ix % 5), ix)
+    scans = [[r.scan, None, 0, []] for _ in range(150)]
+    scans += [[r.sscan, 'set-test:%s' % i, 0, []] for i in list(range(5)) * 30]
+    while any(scan[2] is not None for scan in scans):
+        for scan in scans:
+            func, name, cursor, results = scan
+            if cursor is None:
+                continue
+            cursor, data = func(cursor, count=3) if name is None else func(name, cursor, count=3)
+            results.extend(data)
+            scan[2] = cursor or None
+    expected_keys = [b'scan-test:%d' % i for i in range(50)] + [b'set-test:%d' % i for i in range(5)]
+    for func, name, cursor, results in scans:
+        if name is None:
+            assert sorted(results) == sorted(expected_keys)
+        else:
+            i = int(name.split(':')[1])
+            assert sorted(results, key=int) == [b'%d' % j for j in range(i, 50, 5)]
+
+
 def test_sscan(r):
     # Setup the data
     name = 'sscan-test'
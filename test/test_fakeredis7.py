@@ -47,6 +47,46 @@ def test_set_get_nx(r):
     assert raw_command(r, 'set', 'foo', 'bar', 'NX', 'GET') is None
 
 
+def test_zintercard(r):
+    testtools.zadd(r, 'foo', {'m{}'.format(i): i for i in range(0, 300, 2)})
+    testtools.zadd(r, 'bar', {'m{}'.format(i): i for i in range(0, 300, 3)})
+    r.sadd('baz', 'm0', 'm6', 'm7')
+    assert r.zintercard(2, ['foo', 'bar']) == 50
+    assert r.zintercard(2, ['foo', 'bar'], limit=10) == 10
+    assert r.zintercard(2, ['foo', 'bar'], limit=0) == 50
+    assert r.zintercard(3, ['foo', 'bar', 'baz']) == 2
+    assert r.zintercard(2, ['foo', 'missing']) == 0
+    with pytest.raises(redis.ResponseError, match="LIMIT can't be negative"):
+        r.zintercard(2, ['foo', 'bar'], limit=-1)
+    with pytest.raises(redis.ResponseError):
+        raw_command(r, 'zintercard', 0, 'foo')
+    with pytest.raises(redis.ResponseError):
+        raw_command(r, 'zintercard', 3, 'foo', 'bar')
+
+
+def test_zmpop(r):
+    testtools.zadd(r, 'bar', {'one': 1, 'two': 2, 'three': 3})
+    assert r.zmpop(2, ['foo', 'bar'], min=True) == [b'bar', [[b'one', b'1']]]
+    assert r.zmpop(2, ['foo', 'bar'], max=True, count=5) == [b'bar', [[b'three', b'3'], [b'two', b'2']]]
+    assert not r.exists('bar')
+    assert r.zmpop(2, ['foo', 'bar'], min=True) is None
+    with pytest.raises(redis.ResponseError, match='numkeys should be greater than 0'):
+        raw_command(r, 'zmpop', 0, 'foo', 'min')
+    with pytest.raises(redis.ResponseError, match='count should be greater than 0'):
+        raw_command(r, 'zmpop', 1, 'foo', 'min', 'count', 0)
+    with pytest.raises(redis.ResponseError):
+        raw_command(r, 'zmpop', 1, 'foo', 'avg')
+    with pytest.raises(redis.ResponseError):
+        raw_command(r, 'zmpop', 2, 'foo', 'min')
+
+
+def test_bzmpop(r):
+    testtools.zadd(r, 'bar', {'one': 1, 'two': 2, 'three': 3})
+    assert r.bzmpop(1, 2, ['foo', 'bar'], max=True, count=2) == [b'bar', [[b'three', b'3'], [b'two', b'2']]]
+    assert r.bzmpop(1, 1, ['bar'], min=True) == [b'bar', [[b'one', b'1']]]
+    assert r.bzmpop(1, 1, ['bar'], min=True) is None
+
+
 def test_zadd_minus_zero(r):
     testtools.zadd(r, 'foo', {'a': -0.0})
     testtools.zadd(r, 'foo', {'a': 0.0})
@@ -2,6 +2,8 @@
 Tests will run only if module lupa is installed.
 """
 import logging
+import threading
+import time
 
 import pytest
 import redis
@@ -226,6 +228,69 @@ def test_eval_global_and_return_ok(r):
         )
 
 
+def test_eval_global_after_redis_call(r):
+    with pytest.raises(ResponseError):
+        r.eval('redis.call("SET", KEYS[1], "bar")\nfunction f() end', 1, 'foo')
+    assert r.get('foo') == b'bar'
+    assert r.eval('local a = 1\nreturn a', 0) == 1
+
+
+def test_eval_global_variable_not_kept(r):
+    with pytest.raises(ResponseError):
+        r.eval('a=10', 0)
+    assert r.eval("return rawget(_G, 'a')", 0) is None
+
+
+@pytest.mark.min_server('7')
+def test_eval_cannot_change_library_tables(r):
+    with pytest.raises(ResponseError, match='readonly table'):
+        r.eval('string.rep = nil', 0)
+    with pytest.raises(ResponseError, match='readonly table'):
+        r.eval("rawset(string, 'rep', nil)", 0)
+    assert r.eval('return type(string.rep)', 0) == b'function'
+    assert r.eval("return string.rep('a', 3)", 0) == b'aaa'
+
+
+@pytest.mark.min_server('7')
+def test_eval_cannot_change_globals(r):
+    with pytest.raises(ResponseError, match='readonly table'):
+        r.eval("tostring = function() return 'hacked' end", 0)
+    assert r.eval('return tostring(5)', 0) == b'5'
+
+
+@pytest.mark.min_server('7')
+def test_eval_cannot_replace_redis(r):
+    with pytest.raises(ResponseError, match='readonly table'):
+        r.eval("redis = {call = function() return 'hacked' end}", 0)
+    with pytest.raises(ResponseError, match='readonly table'):
+        r.eval("redis.call = function() return 'hacked' end", 0)
+    r.set('foo', 'bar')
+    assert r.eval("return redis.call('GET', KEYS[1])", 1, 'foo') == b'bar'
+
+
+@pytest.mark.max_server('6.2.7')
+def test_eval_can_change_globals_redis6(r):
+    try:
+        assert r.eval("tostring = function() return 'changed' end return tostring(5)", 0) == b'changed'
+        assert r.eval('string.rep = nil return type(string.rep)', 0) == b'nil'
+    finally:
+        r.script_flush()
+    assert r.eval("return string.rep('a', 3)", 0) == b'aaa'
+
+
+@fake_only
+def test_eval_reuses_runtime(r, fake_server):
+    script = 'return {KEYS[1], ARGV[1]}'
+    assert r.eval(script, 1, 'foo', 'bar') == [b'foo', b'bar']
+    sha1 = r.script_load(script)
+    assert r.evalsha(sha1, 1, 'baz', 'qux') == [b'baz', b'qux']
+    assert r.eval(script, 0) == []
+    assert len(fake_server.lua_runtimes) == 1
+    assert sha1.encode() in fake_server.lua_runtimes[0].scripts
+    r.script_flush()
+    assert fake_server.lua_runtimes == []
+
+
 def test_eval_convert_number(r):
     # Redis forces all Lua numbers to integer
     val = r.eval('return 3.2', 0)
@@ -511,3 +576,277 @@ def test_hscan_cursors_are_bytes(r):
 
     assert result == b'0'
     assert isinstance(result, bytes)
+
+
+@pytest.mark.fake
+@pytest.mark.slow
+def test_script_kill_busy_script():
+    server = fakeredis.FakeServer(lua_time_limit=100)
+    r = fakeredis.FakeStrictRedis(server=server)
+    with pytest.raises(ResponseError, match='No scripts in execution right now'):
+        r.script_kill()
+    errors = []
+
+    def run_script():
+        try:
+            fakeredis.FakeStrictRedis(server=server).eval('while true do end', 0)
+        except ResponseError as exc:
+            errors.append(str(exc))
+
+    thread = threading.Thread(target=run_script)
+    thread.start()
+    time.sleep(0.3)
+    with pytest.raises(ResponseError, match='only call SCRIPT KILL'):
+        r.get('foo')
+    with pytest.raises(ResponseError, match='only call SCRIPT KILL'):
+        r.function_kill()
+    assert r.script_kill()
+    thread.join()
+    assert len(errors) == 1 and 'Script killed by user' in errors[0]
+    assert r.set('foo', 'bar')
+
+
+@pytest.mark.fake
+@pytest.mark.slow
+@pytest.mark.parametrize('script', [
+    'while true do pcall(function() end) end',
+    'while true do pcall(function() while true do end end) end',
+])
+def test_script_kill_pcall_loop(script):
+    server = fakeredis.FakeServer(lua_time_limit=100)
+    r = fakeredis.FakeStrictRedis(server=server)
+    errors = []
+
+    def run_script():
+        try:
+            fakeredis.FakeStrictRedis(server=server).eval(script, 0)
+        except ResponseError as exc:
+            errors.append(str(exc))
+
+    thread = threading.Thread(target=run_script)
+    thread.start()
+    time.sleep(0.3)
+    assert r.script_kill()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert len(errors) == 1 and 'Script killed by user' in errors[0]
+    assert r.set('foo', 'bar')
+    # The runtime is reused without the kill check on every instruction
+    assert r.eval('local n = 0 for i = 1, 1000 do n = n + i end return n', 0) == 500500
+
+
+@pytest.mark.fake
+@pytest.mark.slow
+def test_script_kill_after_write():
+    server = fakeredis.FakeServer(lua_time_limit=100)
+    r = fakeredis.FakeStrictRedis(server=server)
+    script = """
+        redis.call('SET', KEYS[1], 'bar')
+        local start = os.clock()
+        while os.clock() < start + 1 do end
+        return 'done'
+    """
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(fakeredis.FakeStrictRedis(server=server).eval(script, 1, 'foo')))
+    thread.start()
+    time.sleep(0.3)
+    with pytest.raises(ResponseError, match='Sorry the script already executed write commands'):
+        r.script_kill()
+    thread.join()
+    assert results == [b'done']
+    assert r.get('foo') == b'bar'
+
+
+@pytest.mark.fake
+@pytest.mark.slow
+def test_script_kill_does_not_affect_function_load():
+    server = fakeredis.FakeServer(lua_time_limit=100)
+    r = fakeredis.FakeStrictRedis(server=server)
+    errors = []
+
+    def run_script():
+        try:
+            fakeredis.FakeStrictRedis(server=server).eval('while true do end', 0)
+        except ResponseError as exc:
+            errors.append(str(exc))
+
+    thread = threading.Thread(target=run_script)
+    thread.start()
+    time.sleep(0.3)
+    assert r.script_kill()
+    thread.join()
+    assert len(errors) == 1 and 'Script killed by user' in errors[0]
+    code = '#!lua name=slowlib\n' \
+           'for i = 1, 300000 do end\n' \
+           "redis.register_function('noop', function() return 1 end)"
+    assert r.function_load(code) == b'slowlib'
+    assert r.fcall('noop', 0) == 1
+
+
+LIBRARY = """#!lua name=mylib
+local function myset(keys, args)
+    return redis.call('SET', keys[1], args[1])
+end
+redis.register_function('myset', myset)
+redis.register_function{
+    function_name='myget',
+    callback=function(keys, args) return redis.call('GET', keys[1]) end,
+    flags={'no-writes'},
+    description='get a key'
+}
+"""
+
+
+@pytest.mark.min_server('7')
+def test_function_load_fcall(r):
+    r.function_flush()
+    assert r.function_load(LIBRARY) == b'mylib'
+    assert r.fcall('myset', 1, 'foo', 'bar') == b'OK'
+    assert r.fcall('myget', 1, 'foo') == b'bar'
+    assert r.fcall_ro('myget', 1, 'foo') == b'bar'
+    with pytest.raises(ResponseError, match='Can not execute a script with write flag'):
+        r.fcall_ro('myset', 1, 'foo', 'baz')
+    with pytest.raises(ResponseError, match='Function not found'):
+        r.fcall('nofunc', 0)
+    r.function_flush()
+
+
+@pytest.mark.min_server('7')
+def test_function_no_writes(r):
+    r.function_flush()
+    r.function_load("""#!lua name=lib
+        redis.register_function{
+            function_name='f', callback=function() return redis.call('SET', 'foo', 'bar') end, flags={'no-writes'}}
+    """)
+    with pytest.raises(ResponseError, match='Write commands are not allowed from read-only scripts'):
+        r.fcall('f', 0)
+    assert r.get('foo') is None
+    r.function_flush()
+
+
+@pytest.mark.min_server('7')
+def test_function_load_replace_delete(r):
+    r.function_flush()
+    r.function_load(LIBRARY)
+    with pytest.raises(ResponseError, match="Library 'mylib' already exists"):
+        r.function_load(LIBRARY)
+    with pytest.raises(ResponseError, match='Function myset already exists'):
+        r.function_load("#!lua name=other\nredis.register_function('myset', function() return 1 end)")
+    r.function_load("#!lua name=mylib\nredis.register_function('myset', function() return 1 end)", replace=True)
+    assert r.fcall('myset', 0) == 1
+    with pytest.raises(ResponseError, match='Function not found'):
+        r.fcall('myget', 1, 'foo')
+    assert r.function_delete('mylib')
+    with pytest.raises(ResponseError, match='Library not found'):
+        r.function_delete('mylib')
+    with pytest.raises(ResponseError, match='Function not found'):
+        r.fcall('myset', 0)
+
+
+@pytest.mark.min_server('7')
+@pytest.mark.parametrize('code, error', [
+    ('return 1', 'Missing library metadata'),
+    ('#!js name=lib\n', "Engine 'js' not found"),
+    ('#!lua\n', 'Library name was not given'),
+    ('#!lua name=lib foo=bar\n', 'Invalid metadata value given'),
+    ('#!lua name=lib\nreturn 1', 'No functions registered'),
+    ('#!lua name=lib\nredis.call("SET", "foo", "bar")', 'attempt to call'),
+])
+def test_function_load_errors(r, code, error):
+    r.function_flush()
+    with pytest.raises(ResponseError, match=error):
+        r.function_load(code)
+    assert r.function_list() == []
+
+
+@pytest.mark.min_server('7')
+def test_function_list_dump_restore(r):
+    r.function_flush()
+    r.function_load(LIBRARY)
+    r.function_load("#!lua name=other\nredis.register_function('f', function() return 1 end)")
+    libraries = r.function_list(library='my*', withcode=True)
+    assert len(libraries) == 1
+    library = dict(zip(libraries[0][::2], libraries[0][1::2]))
+    assert library[b'library_name'] == b'mylib'
+    assert library[b'library_code'] == LIBRARY.encode()
+    functions = sorted((dict(zip(f[::2], f[1::2])) for f in library[b'functions']), key=lambda f: f[b'name'])
+    assert functions == [
+        {b'name': b'myget', b'description': b'get a key', b'flags': [b'no-writes']},
+        {b'name': b'myset', b'description': None, b'flags': []},
+    ]
+
+    dump = r.function_dump()
+    r.function_delete('mylib')
+    with pytest.raises(ResponseError, match="Library 'other' already exists"):
+        r.function_restore(dump)
+    assert r.function_restore(dump, 'REPLACE')
+    assert r.fcall_ro('myget', 1, 'foo') is None
+    r.function_flush()
+    assert r.function_list() == []
+    assert r.function_restore(dump)
+    assert len(r.function_list()) == 2
+    r.function_flush()
+
+
+@pytest.mark.fake
+@pytest.mark.slow
+def test_function_kill_busy_function():
+    server = fakeredis.FakeServer(lua_time_limit=100)
+    r = fakeredis.FakeStrictRedis(server=server)
+    r.function_load("#!lua name=lib\nredis.register_function('spin', function() while true do end end)")
+    errors = []
+
+    def run_function():
+        try:
+            fakeredis.FakeStrictRedis(server=server).fcall('spin', 0)
+        except ResponseError as exc:
+            errors.append(str(exc))
+
+    thread = threading.Thread(target=run_function)
+    thread.start()
+    time.sleep(0.3)
+    with pytest.raises(ResponseError, match='only call FUNCTION KILL'):
+        r.get('foo')
+    with pytest.raises(ResponseError, match='only call FUNCTION KILL'):
+        r.script_kill()
+    assert r.function_kill()
+    thread.join()
+    assert len(errors) == 1 and 'Script killed by user' in errors[0]
+    assert r.set('foo', 'bar')
+
+
+@pytest.mark.min_server('7')
+def test_eval_ro(r):
+    r.set('foo', 'bar')
+    script = "return redis.call('GET', KEYS[1])"
+    assert r.eval_ro(script, 1, 'foo') == b'bar'
+    sha1 = r.script_load(script)
+    assert r.evalsha_ro(sha1, 1, 'foo') == b'bar'
+    with pytest.raises(ResponseError, match='Write commands are not allowed from read-only scripts'):
+        r.eval_ro("return redis.call('SET', KEYS[1], 'baz')", 1, 'foo')
+    assert r.get('foo') == b'bar'
+
+
+@pytest.mark.fake
+@pytest.mark.slow
+def test_eval_ro_concurrent_reads():
+    server = fakeredis.FakeServer(concurrent_reads=True)
+    r = fakeredis.FakeStrictRedis(server=server)
+    r.set('foo', 'bar')
+    script = """
+        local start = os.clock()
+        while os.clock() < start + 0.5 do end
+        return redis.call('GET', KEYS[1])
+    """
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(fakeredis.FakeStrictRedis(server=server).eval_ro(script, 1, 'foo')))
+    thread.start()
+    time.sleep(0.1)
+    # Readers run alongside the script, while writers wait for it
+    assert r.get('foo') == b'bar'
+    assert not results
+    assert r.set('foo', 'baz')
+    assert results == [b'bar']
+    thread.join()
@@ -0,0 +1,167 @@
+import random
+import threading
+
+import pytest
+
+import fakeredis
+from fakeredis import _zset
+from fakeredis._commands import BeforeAny, AfterAny
+from fakeredis._zset import ZSet, LISTPACK_MAX_ENTRIES
+
+pytestmark = [pytest.mark.fake]
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    """Use tiny blocks and listpacks, so that blocks are split and merged often."""
+    monkeypatch.setattr(_zset, '_LOAD', 4)
+    monkeypatch.setattr(_zset, 'LISTPACK_MAX_ENTRIES', 8)
+
+
+def check_zset(zset, reference):
+    """Check a ZSet against a dict mapping its members to their scores."""
+    expected = sorted((score, member) for member, score in reference.items())
+    assert len(zset) == len(expected)
+    assert list(zset.islice_score(0, len(zset))) == expected
+    assert list(zset.islice_score(0, len(zset), reverse=True)) == expected[::-1]
+    assert sorted(zset.items()) == sorted(reference.items())
+    for rank, (score, member) in enumerate(expected):
+        assert member in zset
+        assert zset[member] == score
+        assert zset.rank(member) == rank
+    assert all(zset._members)
+    assert sum(len(block) for block in zset._members) == len(zset)
+    assert list(zset._max_members) == [block[-1] for block in zset._members]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_zset_random_operations(small_blocks, seed):
+    rnd = random.Random(seed)
+    zset = ZSet()
+    reference = {}
+    for _ in range(rnd.randint(1, 400)):
+        op = rnd.random()
+        expected = sorted((score, member) for member, score in reference.items())
+        if op < 0.55:
+            member = b'm%d' % rnd.randint(0, 100)
+            score = float(rnd.randint(0, 20))
+            zset.add(member, score)
+            reference[member] = score
+        elif op < 0.75:
+            member = b'm%d' % rnd.randint(0, 100)
+            zset.discard(member)
+            reference.pop(member, None)
+        elif op < 0.85:
+            start = rnd.randint(-len(expected) - 2, len(expected) + 2)
+            stop = rnd.randint(-len(expected) - 2, len(expected) + 2)
+            removed = expected[slice(start, stop)]
+            assert zset.remove_range(start, stop) == len(removed)
+            for score, member in removed:
+                del reference[member]
+        elif op < 0.92:
+            count = rnd.randint(-1, 10)
+            reverse = rnd.random() < 0.5
+            popped = (expected[::-1] if reverse else expected)[:max(0, count)]
+            assert zset.pop(count, reverse) == popped
+            for score, member in popped:
+                del reference[member]
+        else:
+            low, high = sorted(rnd.randint(0, 20) for _ in range(2))
+            removed = [member for member, score in reference.items() if low <= score <= high]
+            assert zset.remove_range_score((low, BeforeAny()), (high, AfterAny())) == len(removed)
+            for member in removed:
+                del reference[member]
+        if rnd.random() < 0.1:
+            check_zset(zset, reference)
+    check_zset(zset, reference)
+    check_zset(ZSet.from_dict(dict(reference)), reference)
+
+
+def test_zset_remove_range_keeps_index(mocker):
+    reference = {b'm%d' % i: float(i) for i in range(10000)}
+    zset = ZSet.from_dict(dict(reference))
+    build_index = mocker.spy(zset, '_build_index')
+    # Cuts that leave every block in place only update the index
+    assert zset.remove_range(5000, 5001) == 1
+    assert zset.remove_range_score((100.0, BeforeAny()), (109.0, AfterAny())) == 10
+    build_index.assert_not_called()
+    del reference[b'm5000']
+    for i in range(100, 110):
+        del reference[b'm%d' % i]
+    check_zset(zset, reference)
+
+
+@pytest.mark.parametrize('size', [3, LISTPACK_MAX_ENTRIES + 1])
+def test_zset_items(size):
+    zset = ZSet()
+    for i in range(size):
+        zset[b'm%d' % i] = float(i)
+    items = zset.items()
+    assert isinstance(items, list)
+    assert sorted(items, key=lambda item: item[1]) == [(b'm%d' % i, float(i)) for i in range(size)]
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_zset_pop_negative_count(reverse):
+    zset = ZSet()
+    for i in range(5):
+        zset[b'm%d' % i] = float(i)
+    assert zset.pop(-2, reverse) == []
+    assert len(zset) == 5
+    assert zset.pop(2, reverse) == ([(4.0, b'm4'), (3.0, b'm3')] if reverse else [(0.0, b'm0'), (1.0, b'm1')])
+    assert len(zset) == 3
+
+
+def test_zset_pop_large(mocker):
+    reference = {b'm%d' % i: float(i) for i in range(20000)}
+    zset = ZSet.from_dict(dict(reference))
+    build_index = mocker.spy(zset, '_build_index')
+    for i in range(3000):
+        reverse = i % 2 == 1
+        for score, member in zset.pop(1 + i % 3, reverse):
+            assert reference.pop(member) == score
+    # Blocks are only merged, and the index rebuilt, once in a while
+    assert build_index.call_count < 100
+    check_zset(zset, reference)
+
+
+def test_concurrent_reads_zset_ranks():
+    server = fakeredis.FakeServer(concurrent_reads=True)
+    r = fakeredis.FakeStrictRedis(server=server)
+    n = 3000
+    r.zadd('zset', {'m{}'.format(i): i for i in range(n)})
+    errors = []
+
+    def write():
+        client = fakeredis.FakeStrictRedis(server=server)
+        try:
+            for step in range(5):
+                extra = {'x{}'.format(i): i + 0.5 for i in range(step, n, 7)}
+                client.zadd('zset', extra)
+                client.zrem('zset', *extra)
+        except Exception as exc:
+            errors.append(exc)
+
+    def read(offset):
+        client = fakeredis.FakeStrictRedis(server=server)
+        try:
+            for i in range(offset, n, 11):
+                member = 'm{}'.format(i).encode()
+                rank = client.zrank('zset', member)
+                assert i <= rank <= 2 * i + 1
+                assert client.zrangebyscore('zset', i, i) == [member]
+                assert client.zrangebyscore('zset', i, '+inf', start=0, num=1) == [member]
+                assert client.zcount('zset', 0, i) >= i + 1
+                assert len(client.zrange('zset', rank, rank + 1)) == 2
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=write)]
+    threads += [threading.Thread(target=read, args=(offset,)) for offset in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert r.zcard('zset') == n
+    assert r.zrange('zset', 0, -1) == [b'm%d' % i for i in range(n)]